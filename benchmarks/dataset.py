@@ -0,0 +1,642 @@
+"""Seed a database with a large synthetic dataset, for performance testing.
+
+Run ``python -m benchmarks.dataset --database-url postgresql:///iu-perf``
+from the repository root, against an empty database.  Tables missing from
+it are created from the models, like the test suite does.  Queries that
+are only slow with production data sizes, such as order and trade listings,
+candles and reconciliation by ``verify_balance.py``, can then be tested
+locally.
+
+Each market is generated by a worker process of its own from ``--seed`` and
+its pair, so the same arguments produce the same rows.  The history spans
+``--days`` up to now, at an even pace.  Takers fill one or more makers in
+full, some orders are canceled, and ``--open-orders`` orders per market rest
+on the book at the end.  Trade ledger rows come from the same functions the
+order book uses, so ``--compact-ledger`` seeds the compact ledger instead.
+Candles of every unit are aggregated from the trades.  After the markets are
+generated, users are funded so that balances match their ledger exactly
+and cover their open orders.
+
+Rows are written with ``COPY ... FROM STDIN``, which is an order of
+magnitude faster than ``INSERT``; each worker commits after every chunk of
+about ``--chunk-size`` bytes.  Generating rows takes most of the time, and
+runtime type checks triple it, so seed with :envvar:`IU_TYPECHECK` off::
+
+    IU_TYPECHECK=off python -m benchmarks.dataset \\
+        --database-url postgresql:///iu-perf --trades 10000000
+
+"""
+import argparse
+import collections
+import datetime
+import decimal
+import enum
+import io
+import math
+import multiprocessing
+import operator
+import random
+import time
+import types
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from iu.candle import Candle, CandleUnitType
+from iu.order import OrderSide
+from iu.order_book.book import (
+    create_ledger_transactions, fee_user_id, get_trade_legs,
+)
+from iu.transaction import TransactionType
+
+from .matching import MAXIMUM_VOLUME_RATIO, MINIMUM_VOLUME, VOLUME_QUANTUM
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('--database-url', required=True)
+parser.add_argument('-s', '--seed', type=int, default=0)
+parser.add_argument('-p', '--pair', dest='pairs', action='append',
+                    help='market to seed, created if missing; repeatable '
+                         '(default: BTC/USDT, ETH/USDT and ETH/BTC)')
+parser.add_argument('--users', type=int, default=10000)
+parser.add_argument('--trades', type=int, default=1000000,
+                    help='trades per market')
+parser.add_argument('--days', type=float, default=90)
+parser.add_argument('--open-orders', type=int, default=10000,
+                    help='orders resting on the book per market')
+parser.add_argument('--cancel-ratio', type=float, default=0.3,
+                    help='canceled orders per taker order')
+parser.add_argument('--compact-ledger', action='store_true',
+                    help='seed compact ledger rows instead of six '
+                         'transactions per trade')
+parser.add_argument('--funding', type=decimal.Decimal,
+                    default=decimal.Decimal(1000),
+                    help='spare amount of every currency each user holds')
+parser.add_argument('-j', '--workers', type=int,
+                    default=multiprocessing.cpu_count())
+parser.add_argument('--chunk-size', type=int, default=16 * 1024 * 1024,
+                    help='bytes to buffer before each COPY')
+
+DEFAULT_PAIRS = ('BTC/USDT', 'ETH/USDT', 'ETH/BTC')
+#: Starting prices of new markets, or of markets without a current price.
+DEFAULT_PRICES = {'BTC/USDT': 10000, 'ETH/USDT': 200, 'ETH/BTC': 0.02}
+DEFAULT_PRICE = 100
+#: Significant digits of prices.
+PRICE_DIGITS = 6
+#: Standard deviation of the log return of the price per taker order.
+DRIFT = 0.0005
+PASSWORD = 'iu-exchange!'
+
+#: Columns of each table, in the order rows have to be copied to satisfy
+#: foreign keys.
+COLUMNS = {
+    'user': ('id', 'created_at', 'email', 'password'),
+    'order': (
+        'id', 'created_at', 'side', 'user_id', 'base_currency',
+        'quote_currency', 'volume', 'remaining_volume', 'price', 'filled_at',
+        'canceled_at',
+    ),
+    'trade': (
+        'id', 'created_at', 'buy_order_id', 'sell_order_id', 'side',
+        'volume', 'price', 'index', 'base_currency', 'quote_currency',
+    ),
+    'transaction': (
+        'id', 'created_at', 'type', 'user_id', 'currency', 'amount',
+        'trade_id',
+    ),
+    'trade_transaction': ('id', 'trade_id'),
+    'blockchain_transaction': ('id', 'tx_id'),
+    'candle': (
+        'base_currency', 'quote_currency', 'unit', 'unit_type', 'timestamp',
+        'updated_at', 'open', 'high', 'low', 'close', 'volume',
+        'quote_volume',
+    ),
+    'balance': (
+        'user_id', 'currency', 'amount', 'locked_amount', 'deposit_address',
+    ),
+}
+
+Sink = Callable[[str, Sequence[Any]], None]
+BalanceKey = Tuple[uuid.UUID, str]
+
+
+@dataclass
+class MarketResult:
+    pair: str
+    orders: int = 0
+    trades: int = 0
+    transactions: int = 0
+    candles: int = 0
+    last_price: decimal.Decimal = decimal.Decimal(0)
+    #: Ledger amounts by user and currency.
+    amounts: Dict[BalanceKey, decimal.Decimal] = field(
+        default_factory=lambda: collections.defaultdict(decimal.Decimal),
+    )
+    #: Amounts locked by open orders, by user and currency.
+    locked_amounts: Dict[BalanceKey, decimal.Decimal] = field(
+        default_factory=lambda: collections.defaultdict(decimal.Decimal),
+    )
+    elapsed: float = 0.0
+
+
+def uuid7_at(timestamp: float, rng: random.Random) -> uuid.UUID:
+    """Like :func:`iu.uuid7.uuid7`, but of a past ``timestamp`` and random
+    bits from ``rng``, so seeded keys are reproducible and ordered by time.
+
+    """
+    rand = rng.getrandbits(74)
+    return uuid.UUID(int=(
+        (int(timestamp * 1000) & ((1 << 48) - 1)) << 80 |
+        0x7 << 76 |
+        (rand >> 62) << 64 |
+        0b10 << 62 |
+        rand & ((1 << 62) - 1)
+    ))
+
+
+def create_user_ids(
+    seed: int, count: int, created_at: float,
+) -> List[uuid.UUID]:
+    rng = random.Random(f'{seed}:users')
+    return [uuid7_at(created_at + i, rng) for i in range(count)]
+
+
+def to_datetime(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def round_price(price: float) -> decimal.Decimal:
+    return decimal.Decimal(f'{price:.{PRICE_DIGITS}g}')
+
+
+def draw_volume(rng: random.Random) -> decimal.Decimal:
+    ratio = min(rng.paretovariate(1.5), MAXIMUM_VOLUME_RATIO)
+    return (MINIMUM_VOLUME * decimal.Decimal(ratio)).quantize(VOLUME_QUANTUM)
+
+
+def generate_market(
+    pair: str,
+    sink: Sink,
+    *,
+    seed: int,
+    user_ids: Sequence[uuid.UUID],
+    trades: int,
+    start: float,
+    end: float,
+    price: decimal.Decimal,
+    maker_fee: decimal.Decimal,
+    taker_fee: decimal.Decimal,
+    open_orders: int = 0,
+    cancel_ratio: float = 0.3,
+    compact_ledger: bool = False,
+) -> MarketResult:
+    """Generate the orders, trades, ledger rows and candles of a market,
+    passing each row to ``sink`` with its table.
+
+    """
+    rng = random.Random(f'{seed}:{pair}')
+    # Keys have a generator of their own, so the flow is the same whichever
+    # ledger is seeded.
+    keys = random.Random(f'{seed}:{pair}:keys')
+    base_currency, quote_currency = pair.split('/')
+    result = MarketResult(pair=pair)
+    # Minutely candles, rolled up into the other units at the end.
+    minutes: Dict[int, List[Any]] = {}
+    mid = float(price)
+    at = start
+
+    def add_order(side, user_id, volume, price, created_at, *,
+                  filled_at=None, canceled_at=None):
+        order_id = uuid7_at(created_at, keys)
+        sink('order', (
+            order_id, to_datetime(created_at), side, user_id, base_currency,
+            quote_currency, volume,
+            decimal.Decimal(0) if filled_at else volume, price,
+            filled_at and to_datetime(filled_at),
+            canceled_at and to_datetime(canceled_at),
+        ))
+        result.orders += 1
+        return types.SimpleNamespace(id=order_id, user_id=user_id)
+
+    def add_transaction(transaction, created_at, trade_id=None):
+        transaction_id = uuid7_at(created_at, keys)
+        sink('transaction', (
+            transaction_id, to_datetime(created_at), transaction['type'],
+            transaction['user_id'], transaction['currency'],
+            transaction['amount'], transaction.get('trade_id'),
+        ))
+        if trade_id:
+            sink('trade_transaction', (transaction_id, trade_id))
+        result.amounts[
+            transaction['user_id'], transaction['currency']
+        ] += transaction['amount']
+        result.transactions += 1
+
+    while result.trades < trades:
+        # Spread over the history by progress, so no two takers trade at
+        # the same time and the last one trades before the end.
+        at = start + (end - start) * (result.trades + rng.random()) / trades
+        mid *= math.exp(rng.gauss(0, DRIFT))
+        side = OrderSide.buy if rng.random() < 0.5 else OrderSide.sell
+        tick = mid / 10000
+        taker_id = rng.choice(user_ids)
+        makers = []
+        while len(makers) < 1 or rng.random() < 1 / 3:
+            maker_price = round_price(
+                mid + side.choice(buy=1, sell=-1) * tick * len(makers),
+            )
+            makers.append((rng.choice(user_ids), maker_price,
+                           draw_volume(rng)))
+            if result.trades + len(makers) >= trades:
+                break
+        taker_volume = sum(volume for _, _, volume in makers)
+        maker_orders = [
+            add_order(~side, user_id, volume, maker_price,
+                      at - rng.expovariate(1 / 600), filled_at=at)
+            for user_id, maker_price, volume in makers
+        ]
+        taker_order = add_order(
+            side, taker_id, taker_volume, makers[-1][1], at, filled_at=at,
+        )
+        batch = []
+        for index, ((_, maker_price, volume), maker_order) in enumerate(
+            zip(makers, maker_orders),
+        ):
+            buy_order, sell_order = side.choice(
+                buy=(taker_order, maker_order),
+                sell=(maker_order, taker_order),
+            )
+            trade = {
+                'id': uuid7_at(at, keys),
+                'buy_order': buy_order,
+                'sell_order': sell_order,
+                'side': side,
+                'volume': volume,
+                'price': maker_price,
+                'base_currency': base_currency,
+                'quote_currency': quote_currency,
+                'index': index,
+            }
+            sink('trade', (
+                trade['id'], to_datetime(at), buy_order.id, sell_order.id,
+                side, volume, maker_price, index, base_currency,
+                quote_currency,
+            ))
+            batch.append(trade)
+            minute = int(at) - int(at) % 60
+            candle = minutes.get(minute)
+            if candle is None:
+                minutes[minute] = [
+                    maker_price, maker_price, maker_price, maker_price,
+                    volume, volume * maker_price, at,
+                ]
+            else:
+                candle[1] = max(candle[1], maker_price)
+                candle[2] = min(candle[2], maker_price)
+                candle[3] = maker_price
+                candle[4] += volume
+                candle[5] += volume * maker_price
+                candle[6] = at
+            result.last_price = maker_price
+        result.trades += len(batch)
+        if compact_ledger:
+            for transaction in create_ledger_transactions(
+                batch, maker_fee=maker_fee, taker_fee=taker_fee,
+                now=to_datetime(at),
+            ):
+                add_transaction(transaction, at)
+        else:
+            for trade in batch:
+                for transaction in get_trade_legs(
+                    trade, maker_fee=maker_fee, taker_fee=taker_fee,
+                ):
+                    transaction['type'] = TransactionType.trade
+                    add_transaction(transaction, at, trade_id=trade['id'])
+        if rng.random() < cancel_ratio:
+            canceled_side = (
+                OrderSide.buy if rng.random() < 0.5 else OrderSide.sell
+            )
+            created_at = at - rng.expovariate(1 / 600)
+            add_order(
+                canceled_side, rng.choice(user_ids), draw_volume(rng),
+                round_price(mid * (1 + canceled_side.choice(
+                    buy=-1, sell=1,
+                ) * rng.expovariate(100))),
+                created_at,
+                canceled_at=min(created_at + rng.expovariate(1 / 60), end),
+            )
+    mid = float(result.last_price or price)
+    for _ in range(open_orders):
+        side = OrderSide.buy if rng.random() < 0.5 else OrderSide.sell
+        user_id = rng.choice(user_ids)
+        volume = draw_volume(rng)
+        order_price = round_price(
+            mid * (1 + side.choice(buy=-1, sell=1) * rng.expovariate(100)),
+        )
+        add_order(side, user_id, volume, order_price,
+                  end - rng.uniform(0, 3600))
+        result.locked_amounts[
+            user_id, side.choice(buy=quote_currency, sell=base_currency)
+        ] += side.choice(buy=volume * order_price, sell=volume)
+    candles = {(1, CandleUnitType.minutes): minutes}
+    for unit, unit_type in Candle.available_units[1:]:
+        rolled_up = candles[unit, unit_type] = {}
+        for minute, (open_, high, low, close, volume, quote_volume,
+                     updated_at) in sorted(minutes.items()):
+            timestamp = minute - minute % (unit * 60)
+            candle = rolled_up.get(timestamp)
+            if candle is None:
+                rolled_up[timestamp] = [
+                    open_, high, low, close, volume, quote_volume, updated_at,
+                ]
+            else:
+                candle[1] = max(candle[1], high)
+                candle[2] = min(candle[2], low)
+                candle[3] = close
+                candle[4] += volume
+                candle[5] += quote_volume
+                candle[6] = updated_at
+    for (unit, unit_type), buckets in candles.items():
+        for timestamp, (open_, high, low, close, volume, quote_volume,
+                        updated_at) in sorted(buckets.items()):
+            sink('candle', (
+                base_currency, quote_currency, unit, unit_type,
+                to_datetime(timestamp), to_datetime(updated_at),
+                open_, high, low, close, volume, quote_volume,
+            ))
+            result.candles += 1
+    return result
+
+
+#: Formatters of values for the text format of ``COPY`` by type, filled in
+#: by :func:`format_value` for other types.
+FORMATTERS: Dict[type, Callable[[Any], str]] = {
+    type(None): lambda value: '\\N',
+    str: str,
+    decimal.Decimal: str,
+    uuid.UUID: str,
+    datetime.datetime: datetime.datetime.isoformat,
+    bytes: lambda value: '\\\\x' + value.hex(),
+}
+
+
+def format_value(value: Any) -> str:
+    """Format ``value`` for the text format of ``COPY``."""
+    formatter = FORMATTERS.get(type(value))
+    if formatter is None:
+        if isinstance(value, enum.Enum):
+            formatter = operator.attrgetter('value')
+        else:
+            formatter = str
+        FORMATTERS[type(value)] = formatter
+    return formatter(value)
+
+
+class CopyWriter:
+    """Buffer rows by table, and ``COPY`` them in the order of
+    :data:`COLUMNS` once the buffers reach ``chunk_size`` bytes.
+
+    """
+
+    def __init__(self, connection, chunk_size: int = 16 * 1024 * 1024):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.buffers = {table: io.StringIO() for table in COLUMNS}
+        self.size = 0
+
+    def __call__(self, table: str, row: Sequence[Any]):
+        line = '\t'.join(map(format_value, row)) + '\n'
+        self.buffers[table].write(line)
+        self.size += len(line)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        with self.connection.cursor() as cursor:
+            for table, buffer in self.buffers.items():
+                if not buffer.tell():
+                    continue
+                buffer.seek(0)
+                columns = ', '.join(f'"{c}"' for c in COLUMNS[table])
+                cursor.copy_expert(
+                    f'COPY "{table}" ({columns}) FROM STDIN', buffer,
+                )
+                self.buffers[table] = io.StringIO()
+        self.connection.commit()
+        self.size = 0
+
+
+def seed_market(task: Dict[str, Any]) -> MarketResult:
+    from sqlalchemy import create_engine
+
+    started = time.perf_counter()
+    engine = create_engine(task.pop('database_url'))
+    connection = engine.raw_connection()
+    try:
+        writer = CopyWriter(connection, task.pop('chunk_size'))
+        result = generate_market(task.pop('pair'), writer, **task)
+        writer.flush()
+    finally:
+        connection.close()
+        engine.dispose()
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def create_markets(session, pairs: Sequence[str]) -> Dict[str, Any]:
+    from iu.currency import Currency
+    from iu.market import Market
+
+    for currency in sorted({c for pair in pairs for c in pair.split('/')}):
+        if session.query(Currency).get(currency) is None:
+            session.add(Currency(
+                id=currency,
+                name=currency,
+                decimals=8,
+                confirmations=1,
+                minimum_deposit_amount=decimal.Decimal(0),
+                minimum_withdrawal_amount=decimal.Decimal(0),
+                withdrawal_fee=decimal.Decimal(0),
+                latest_synced_block_number=0,
+            ))
+    session.flush()
+    markets = {}
+    for pair in pairs:
+        market = session.query(Market).get(tuple(pair.split('/')))
+        if market is None:
+            market = Market(
+                pair=pair,
+                current_price=decimal.Decimal(0),
+                maker_fee=decimal.Decimal('0.001'),
+                taker_fee=decimal.Decimal('0.001'),
+                minimum_order_amount=decimal.Decimal(0),
+            )
+            session.add(market)
+        markets[pair] = market
+    session.commit()
+    return markets
+
+
+def seed_users(writer: CopyWriter, user_ids: Sequence[uuid.UUID],
+               created_at: float, *, fee_user: bool):
+    from sqlalchemy.dialects import postgresql
+
+    from iu.user import User
+
+    # Hashing is slow, so every user shares the hash of the same password.
+    password = User.__table__.c.password.type.process_bind_param(
+        PASSWORD, postgresql.dialect(),
+    )
+    if fee_user:
+        writer('user', (
+            fee_user_id, to_datetime(created_at), 'fee@iu.exchange',
+            password,
+        ))
+    for i, user_id in enumerate(user_ids):
+        writer('user', (
+            user_id, to_datetime(created_at + i), f'user{i}@seed.iu.exchange',
+            password,
+        ))
+    writer.flush()
+
+
+def seed_balances(
+    writer: CopyWriter,
+    results: Sequence[MarketResult],
+    user_ids: Sequence[uuid.UUID],
+    currencies: Sequence[str],
+    *,
+    seed: int,
+    funded_at: float,
+    funding: decimal.Decimal,
+):
+    """Fund users with blockchain transactions so that their balances cover
+    their ledger and open orders, and write the balances.
+
+    """
+    rng = random.Random(f'{seed}:balances')
+    amounts = collections.defaultdict(decimal.Decimal)
+    locked_amounts = collections.defaultdict(decimal.Decimal)
+    for result in results:
+        for key, amount in result.amounts.items():
+            amounts[key] += amount
+        for key, amount in result.locked_amounts.items():
+            locked_amounts[key] += amount
+    keys = {(user_id, c) for user_id in user_ids for c in currencies}
+    keys.update(amounts)
+    for user_id, currency in sorted(keys):
+        key = user_id, currency
+        locked_amount = locked_amounts[key]
+        # The fee account only earns, so it needs no funding.
+        deposit = max(locked_amount - amounts[key], decimal.Decimal(0))
+        if user_id != fee_user_id:
+            deposit += funding
+        if deposit:
+            transaction_id = uuid7_at(funded_at, rng)
+            writer('transaction', (
+                transaction_id, to_datetime(funded_at),
+                TransactionType.blockchain, user_id, currency, deposit, None,
+            ))
+            writer('blockchain_transaction', (transaction_id, None))
+        writer('balance', (
+            user_id, currency, amounts[key] + deposit, locked_amount, None,
+        ))
+    writer.flush()
+
+
+def main():
+    args = parser.parse_args()
+    from sqlalchemy import create_engine
+
+    from iu.candle import Candle  # noqa: F401
+    from iu.order import Order
+    from iu.orm import Base, Session
+    from iu.transaction import Transaction  # noqa: F401
+    from iu.user import User
+
+    pairs = args.pairs or list(DEFAULT_PAIRS)
+    currencies = sorted({c for pair in pairs for c in pair.split('/')})
+    engine = create_engine(args.database_url)
+    Base.metadata.create_all(engine)
+    session = Session(bind=engine)
+    if session.query(Order.id).first() is not None:
+        parser.error('the database has orders already; seed an empty one')
+    markets = create_markets(session, pairs)
+    end = time.time()
+    start = end - args.days * 24 * 60 * 60
+    users_created_at = start - 24 * 60 * 60
+    user_ids = create_user_ids(args.seed, args.users, users_created_at)
+    started = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        seed_users(
+            CopyWriter(connection, args.chunk_size), user_ids,
+            users_created_at,
+            fee_user=session.query(User).get(fee_user_id) is None,
+        )
+    finally:
+        connection.close()
+    print(f'{len(user_ids)} users', flush=True)
+    tasks = [
+        {
+            'database_url': args.database_url,
+            'chunk_size': args.chunk_size,
+            'pair': pair,
+            'seed': args.seed,
+            'user_ids': user_ids,
+            'trades': args.trades,
+            'start': start,
+            'end': end,
+            'price': market.current_price or decimal.Decimal(
+                str(DEFAULT_PRICES.get(pair, DEFAULT_PRICE)),
+            ),
+            'maker_fee': market.maker_fee,
+            'taker_fee': market.taker_fee,
+            'open_orders': args.open_orders,
+            'cancel_ratio': args.cancel_ratio,
+            'compact_ledger': args.compact_ledger,
+        }
+        for pair, market in markets.items()
+    ]
+    # Forked workers must not share the connections of this process.
+    session.close()
+    engine.dispose()
+    results = []
+    with multiprocessing.Pool(min(args.workers, len(tasks))) as pool:
+        for result in pool.imap_unordered(seed_market, tasks):
+            print(
+                f'{result.pair}: {result.orders} orders, '
+                f'{result.trades} trades, '
+                f'{result.transactions} transactions, '
+                f'{result.candles} candles in {result.elapsed:.1f}s',
+                flush=True,
+            )
+            results.append(result)
+    connection = engine.raw_connection()
+    try:
+        seed_balances(
+            CopyWriter(connection, args.chunk_size), results, user_ids,
+            currencies,
+            seed=args.seed,
+            funded_at=users_created_at,
+            funding=args.funding,
+        )
+        with connection.cursor() as cursor:
+            for result in results:
+                base_currency, quote_currency = result.pair.split('/')
+                cursor.execute(
+                    'UPDATE market SET current_price = %s '
+                    'WHERE base_currency = %s AND quote_currency = %s',
+                    (result.last_price, base_currency, quote_currency),
+                )
+            # Fresh statistics, so the planner sees the new sizes.
+            cursor.execute('ANALYZE')
+        connection.commit()
+    finally:
+        connection.close()
+    print(f'Seeded in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""Throughput and latency of matching under synthetic order flow.
+
+Run ``python -m benchmarks.matching`` from the repository root.
+
+Orders arrive as a Poisson process, their volumes follow a power law, and
+their prices scatter around a mid price which drifts as a random walk; some
+of them cross the spread and trade right away, and a share of the placed
+orders are canceled later.  The flow is generated from ``--seed`` only, so
+two runs against different versions of :mod:`iu.order_book.book` match the
+same orders, and ``trades`` and ``traded volume`` in the report must agree.
+
+Orders are matched by :meth:`OrderBook.match_order`.  Persistence is
+stubbed out by default, to measure matching alone; with ``--database-url``
+orders, trades and balances are written to that database like the engine
+does, in a transaction which is rolled back at the end.
+
+Latencies are reported per depth of the book, i.e. the number of resting
+orders when an order arrives.  Without ``--rate`` orders are matched back to
+back, and latency is the time to match one.  With ``--rate`` orders arrive
+at their scheduled times, and latency also counts the time an order waits
+for the ones before it, like in a queue.
+
+"""
+import argparse
+import contextlib
+import decimal
+import itertools
+import math
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from iu.metrics import Histogram
+from iu.order import Order, OrderSide
+from iu.order_book.app import EngineApp
+from iu.order_book.book import OrderBook
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-s', '--seed', type=int, default=0)
+parser.add_argument('-n', '--count', type=int, default=100000,
+                    help='orders and cancels to process')
+parser.add_argument('--warmup', type=int, default=1000,
+                    help='events to process before measuring')
+parser.add_argument('--users', type=int, default=100)
+parser.add_argument('--rate', type=float,
+                    help='arrivals per second; as fast as possible if unset')
+parser.add_argument('--cancel-ratio', type=float, default=0.3,
+                    help='share of events which cancel a placed order')
+parser.add_argument('--aggressive-ratio', type=float, default=0.1,
+                    help='share of orders priced across the spread')
+parser.add_argument('--drift', type=float, default=0.000002,
+                    help='standard deviation of the mid price log return '
+                         'per event')
+parser.add_argument('--alpha', type=float, default=1.5,
+                    help='shape of the Pareto distribution of volumes')
+parser.add_argument('--database-url',
+                    help='persist into this database instead of stubbing out')
+
+PAIR = 'BTC/USDT'
+MID_PRICE = decimal.Decimal('10000')
+TICK = decimal.Decimal('0.01')
+MINIMUM_VOLUME = decimal.Decimal('0.001')
+VOLUME_QUANTUM = decimal.Decimal('0.0001')
+#: Volumes are capped at this multiple of :data:`MINIMUM_VOLUME`.
+MAXIMUM_VOLUME_RATIO = 10000
+
+
+@dataclass
+class Event:
+    #: Seconds since the start of the flow.
+    at: float
+    order: Optional[Order] = None
+    #: The order to cancel, which may have been filled already.
+    cancel_id: Optional[uuid.UUID] = None
+
+
+@dataclass
+class Result:
+    elapsed: float = 0.0
+    orders: int = 0
+    cancels: int = 0
+    trades: int = 0
+    traded_volume: decimal.Decimal = decimal.Decimal(0)
+    #: Latencies of placing orders, by the depth bucket of the book.
+    latencies: Dict[str, Histogram] = field(default_factory=dict)
+
+
+class NullSession:
+    """Session which drops everything, to benchmark matching alone."""
+
+    def add(self, instance):
+        pass
+
+    def flush(self):
+        pass
+
+    def execute(self, statement):
+        pass
+
+    def begin_nested(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@dataclass
+class StubbedOrderBook(OrderBook):
+    """Order book without persistence; balances are not locked either."""
+
+    def lock_balances(self, changes):
+        return {}
+
+
+def generate_flow(
+    seed: int,
+    count: int,
+    *,
+    users: int = 100,
+    rate: float = 1000.0,
+    cancel_ratio: float = 0.3,
+    aggressive_ratio: float = 0.1,
+    drift: float = 0.000002,
+    alpha: float = 1.5,
+    pair: str = PAIR,
+) -> Iterator[Event]:
+    """Generate ``count`` events of order flow from ``seed``."""
+    rng = random.Random(seed)
+    user_ids = [uuid.UUID(int=i + 1) for i in range(users)]
+    placed: List[uuid.UUID] = []
+    mid = float(MID_PRICE)
+    at = 0.0
+    for _ in range(count):
+        at += rng.expovariate(rate)
+        if placed and rng.random() < cancel_ratio:
+            i = rng.randrange(len(placed))
+            placed[i], placed[-1] = placed[-1], placed[i]
+            yield Event(at=at, cancel_id=placed.pop())
+            continue
+        mid *= math.exp(rng.gauss(0, drift))
+        side = OrderSide.buy if rng.random() < 0.5 else OrderSide.sell
+        if rng.random() < aggressive_ratio:
+            # Crosses the spread by a few ticks, so trades at once.
+            ticks = -1 - int(rng.expovariate(1 / 5))
+        else:
+            ticks = 1 + int(rng.expovariate(1 / 20))
+        price = decimal.Decimal(mid).quantize(TICK) + side.choice(
+            buy=-ticks, sell=ticks,
+        ) * TICK
+        ratio = min(rng.paretovariate(alpha), MAXIMUM_VOLUME_RATIO)
+        volume = (
+            MINIMUM_VOLUME * decimal.Decimal(ratio)
+        ).quantize(VOLUME_QUANTUM)
+        order = Order(
+            id=uuid.UUID(int=rng.getrandbits(128)),
+            user_id=rng.choice(user_ids),
+            side=side,
+            volume=volume,
+            remaining_volume=volume,
+            price=max(price, TICK),
+            pair=pair,
+        )
+        placed.append(order.id)
+        yield Event(at=at, order=order)
+
+
+def get_depth_bucket(depth: int) -> str:
+    """Bucket depths by order of magnitude, e.g. ``100-999``."""
+    digits = len(str(depth))
+    if digits == 1:
+        return '0-9'
+    return f'{10 ** (digits - 1)}-{10 ** digits - 1}'
+
+
+def place_order(order_book: OrderBook, order: Order) -> Sequence:
+    order_book.session.begin_nested()
+    order_book.session.add(order)
+    trades = order_book.match_order(order)['trades']
+    order_book.session.commit()
+    order_book.apply_effects()
+    return trades
+
+
+def cancel_order(order_book: OrderBook, order_id: uuid.UUID) -> bool:
+    """Cancel in memory like :meth:`OrderBook.process_cancel_order`, which
+    needs a database to tell the canceled orders."""
+    if order_id not in order_book.order_ids:
+        return False
+    for order in itertools.chain(
+        order_book.sell_orders, order_book.buy_orders,
+    ):
+        if order.id == order_id:
+            break
+    order_book.add_to_merged_orders(
+        order.side, order.price, -order.remaining_volume,
+    )
+    order_book.remove(order.side, order_id)
+    order_book.apply_effects()
+    return True
+
+
+def run_benchmark(
+    order_book: OrderBook,
+    events: Sequence[Event],
+    *,
+    rate: Optional[float] = None,
+) -> Result:
+    result = Result()
+    started = time.perf_counter()
+    first_at = events[0].at if events else 0.0
+    for event in events:
+        if rate:
+            scheduled = started + event.at - first_at
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if event.order is None:
+            result.cancels += cancel_order(order_book, event.cancel_id)
+            continue
+        depth = len(order_book.buy_orders) + len(order_book.sell_orders)
+        arrived = scheduled if rate else time.perf_counter()
+        trades = place_order(order_book, event.order)
+        bucket = get_depth_bucket(depth)
+        if bucket not in result.latencies:
+            result.latencies[bucket] = Histogram()
+        result.latencies[bucket].record(time.perf_counter() - arrived)
+        result.orders += 1
+        result.trades += len(trades)
+        result.traded_volume += sum(
+            (trade['volume'] for trade in trades), decimal.Decimal(0),
+        )
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+@contextlib.contextmanager
+def create_order_book(
+    args: argparse.Namespace, user_ids: Sequence[uuid.UUID],
+) -> Iterator[OrderBook]:
+    from iu.market import Market
+
+    market = Market(
+        pair=PAIR,
+        current_price=MID_PRICE,
+        maker_fee=decimal.Decimal('0.001'),
+        taker_fee=decimal.Decimal('0.002'),
+        minimum_order_amount=decimal.Decimal(0),
+    )
+    config = {'database': {'url': args.database_url}}
+    if not args.database_url:
+        yield StubbedOrderBook(
+            EngineApp(config), session=NullSession(), market=market,
+        )
+        return
+    from sqlalchemy import create_engine
+
+    from iu.orm import Session
+
+    connection = create_engine(args.database_url).connect()
+    transaction = connection.begin()
+    session = Session(bind=connection)
+    session.expire_on_commit = False
+    session.autoflush = False
+    try:
+        create_fixtures(session, market, user_ids)
+        yield OrderBook(EngineApp(config), session=session, market=market)
+    finally:
+        session.close()
+        transaction.rollback()
+        connection.close()
+
+
+def create_fixtures(session, market, user_ids: Sequence[uuid.UUID]):
+    """Create the market, and users with plenty of both currencies."""
+    from iu.balance import Balance
+    from iu.currency import Currency
+    from iu.user import User
+
+    for currency in (market.base_currency, market.quote_currency):
+        session.merge(Currency(
+            id=currency,
+            name=currency,
+            decimals=8,
+            confirmations=12,
+            minimum_deposit_amount=decimal.Decimal(0),
+            minimum_withdrawal_amount=decimal.Decimal(0),
+            withdrawal_fee=decimal.Decimal(0),
+            latest_synced_block_number=0,
+        ))
+    session.merge(market)
+    for user_id in user_ids:
+        session.merge(User(
+            id=user_id,
+            email=f'benchmark-{user_id.int}@iu.exchange',
+            password='iu-exchange!',
+        ))
+        for currency in (market.base_currency, market.quote_currency):
+            session.merge(Balance(
+                user_id=user_id,
+                currency=currency,
+                amount=decimal.Decimal(10 ** 12),
+                locked_amount=decimal.Decimal(0),
+            ))
+    session.commit()
+
+
+def main():
+    args = parser.parse_args()
+    events = list(generate_flow(
+        args.seed,
+        args.warmup + args.count,
+        users=args.users,
+        rate=args.rate or 1000.0,
+        cancel_ratio=args.cancel_ratio,
+        aggressive_ratio=args.aggressive_ratio,
+        drift=args.drift,
+        alpha=args.alpha,
+    ))
+    warmup, events = events[:args.warmup], events[args.warmup:]
+    user_ids = [uuid.UUID(int=i + 1) for i in range(args.users)]
+    with create_order_book(args, user_ids) as order_book:
+        run_benchmark(order_book, warmup)
+        result = run_benchmark(order_book, events, rate=args.rate)
+    print(
+        f'{result.orders} orders, {result.cancels} cancels '
+        f'in {result.elapsed:.3f}s: '
+        f'{result.orders / result.elapsed:.0f} orders/s'
+    )
+    print(f'trades: {result.trades}; traded volume: {result.traded_volume}')
+    print(
+        f'{"depth":<14}{"orders":>8}{"p50 µs":>10}{"p90 µs":>10}'
+        f'{"p99 µs":>10}{"p99.9 µs":>10}{"max µs":>10}'
+    )
+    for bucket, histogram in sorted(
+        result.latencies.items(), key=lambda item: int(item[0].split('-')[0]),
+    ):
+        percentiles = histogram.get_percentiles([0.5, 0.9, 0.99, 0.999])
+        print(
+            f'{bucket:<14}{histogram.count:>8}' +
+            ''.join(f'{value * 1e6:>10.0f}' for _, value in percentiles) +
+            f'{histogram.max * 1e6:>10.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
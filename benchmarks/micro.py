@@ -0,0 +1,261 @@
+"""Microbenchmarks of hot functions, compared against a stored baseline.
+
+Run ``python -m benchmarks.micro --save`` on the base revision to store a
+baseline, then ``python -m benchmarks.micro`` on a change to compare with
+it.  The comparison exits with status 1 if any case became slower than
+``--threshold``, so it can gate a branch on the same machine.
+
+Baselines depend on the machine, the Python version and the runtime type
+check policy (:envvar:`IU_TYPECHECK`), so they are not versioned; a
+comparison warns when the latter two differ from the baseline's.
+
+"""
+import argparse
+import datetime
+import decimal
+import functools
+import json
+import pathlib
+import platform
+import sys
+import timeit
+import uuid
+from typing import Any, Callable, Dict, Mapping
+
+from iu.candle import Candle, CandleUnitType
+from iu.market import Market
+from iu.order import Order, OrderSide
+from iu.order_book.app import EngineApp
+from iu.order_book.book import OrderBook, create_transactions
+from iu.order_book.util import parse_order
+from iu.serializer import serialize
+from iu.trade import Trade
+from iu.typecheck import get_policy
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-k', '--filter', default='',
+                    help='only run cases whose name contains this')
+parser.add_argument('-b', '--baseline', type=pathlib.Path,
+                    default=pathlib.Path('.benchmarks/micro.json'))
+parser.add_argument('--save', action='store_true',
+                    help='store the results as the baseline')
+parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                    help='relative slowdown reported as a regression')
+parser.add_argument('-r', '--repeat', type=int, default=5)
+
+#: Set-up functions of cases by name, each returning the function to time.
+CASES: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+#: Price levels per side of the book for ``serialized_merged_orders``.
+BOOK_SIZES = (10, 100, 1000, 10000)
+
+NOW = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def case(name: str):
+    def register(setup: Callable[[], Callable[[], Any]]):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def create_order(side: OrderSide = OrderSide.buy) -> Order:
+    return Order(
+        id=uuid.UUID(int=1),
+        created_at=NOW,
+        user_id=uuid.UUID(int=2),
+        side=side,
+        volume=decimal.Decimal('1.25'),
+        remaining_volume=decimal.Decimal('0.5'),
+        price=decimal.Decimal('10234.56'),
+        pair='BTC/USDT',
+    )
+
+
+@case('serialize[decimal dict]')
+def serialize_decimal_dict():
+    # Like a balance message: currencies of users with their balances.
+    payload = {
+        str(uuid.UUID(int=user)): {
+            currency: {
+                'amount': decimal.Decimal('12345.678900000000000000'),
+                'lockedAmount': decimal.Decimal('100.000000000000000000'),
+            }
+            for currency in ('BTC', 'ETH', 'USDT')
+        }
+        for user in range(10)
+    }
+    return functools.partial(serialize, payload)
+
+
+@case('serialize[Order]')
+def serialize_order():
+    return functools.partial(serialize, create_order())
+
+
+@case('serialize[Trade]')
+def serialize_trade():
+    trade = Trade(
+        id=uuid.UUID(int=1),
+        created_at=NOW,
+        pair='BTC/USDT',
+        side=OrderSide.buy,
+        price=decimal.Decimal('10234.56'),
+        volume=decimal.Decimal('0.75'),
+    )
+    return functools.partial(serialize, trade)
+
+
+@case('parse_order')
+def parse_order_():
+    payload = serialize(create_order())
+    return functools.partial(parse_order, payload)
+
+
+@case('create_transactions')
+def create_transactions_():
+    trade = {
+        'id': uuid.UUID(int=3),
+        'created_at': NOW,
+        'buy_order': create_order(OrderSide.buy),
+        'sell_order': create_order(OrderSide.sell),
+        'side': OrderSide.buy,
+        'volume': decimal.Decimal('0.75'),
+        'price': decimal.Decimal('10234.56'),
+        'base_currency': 'BTC',
+        'quote_currency': 'USDT',
+        'index': 0,
+    }
+    return functools.partial(
+        create_transactions,
+        trade,
+        maker_fee=decimal.Decimal('0.001'),
+        taker_fee=decimal.Decimal('0.002'),
+        now=NOW,
+    )
+
+
+@case('Candle.update')
+def candle_update():
+    candle = Candle(
+        unit_key=(1, CandleUnitType.minutes),
+        timestamp=NOW,
+        updated_at=NOW,
+        open=decimal.Decimal('10000'),
+        high=decimal.Decimal('10000'),
+        low=decimal.Decimal('10000'),
+        close=decimal.Decimal('10000'),
+        volume=decimal.Decimal('1'),
+        quote_volume=decimal.Decimal('10000'),
+    )
+    return functools.partial(
+        candle.update,
+        decimal.Decimal('10234.56'), decimal.Decimal('0.75'), NOW,
+    )
+
+
+@case('Candle.get_timestamp_of')
+def candle_get_timestamp_of():
+    return functools.partial(
+        Candle.get_timestamp_of, NOW, unit_key=(15, CandleUnitType.minutes),
+    )
+
+
+@case('OrderSide.choice')
+def order_side_choice():
+    return functools.partial(OrderSide.sell.choice, buy=1, sell=2)
+
+
+def serialized_merged_orders(levels: int):
+    order_book = OrderBook(
+        EngineApp({}),
+        market=Market(pair='BTC/USDT'),
+    )
+    for i in range(levels):
+        price = decimal.Decimal(10000 + i) / 100
+        order_book.merged_sell_orders[price + 100] = decimal.Decimal('1.5')
+        order_book.merged_buy_orders[price] = decimal.Decimal('2.5')
+    return lambda: order_book.serialized_merged_orders
+
+
+for levels in BOOK_SIZES:
+    case(f'serialized_merged_orders[{levels}]')(
+        functools.partial(serialized_merged_orders, levels)
+    )
+
+
+def measure(func: Callable[[], Any], *, repeat: int = 5) -> float:
+    """Return the fastest of ``repeat`` timings, in nanoseconds per call."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def load_baseline(path: pathlib.Path) -> Mapping[str, Any]:
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def get_environment() -> Dict[str, str]:
+    return {
+        'python': platform.python_version(),
+        'typecheck': get_policy()[0],
+    }
+
+
+def main():
+    args = parser.parse_args()
+    baseline = load_baseline(args.baseline)
+    environment = get_environment()
+    for key, value in baseline.get('environment', {}).items():
+        if environment.get(key) != value:
+            print(
+                f'warning: baseline was taken with {key} {value}, '
+                f'not {environment.get(key)}',
+                file=sys.stderr,
+            )
+    previous = baseline.get('results', {})
+    results = {}
+    regressions = []
+    print(f'{"case":<36}{"baseline ns":>12}{"ns/call":>12}{"change":>9}')
+    for name, setup in CASES.items():
+        if args.filter not in name:
+            continue
+        results[name] = ns = measure(setup(), repeat=args.repeat)
+        line = f'{name:<36}'
+        if name in previous:
+            change = ns / previous[name] - 1
+            line += f'{previous[name]:>12.0f}{ns:>12.0f}{change:>+9.1%}'
+            if change > args.threshold:
+                line += '  regressed'
+                regressions.append(name)
+        else:
+            line += f'{"-":>12}{ns:>12.0f}'
+        print(line, flush=True)
+    if args.save:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        with args.baseline.open('w') as f:
+            json.dump(
+                {
+                    'environment': environment,
+                    'results': {**previous, **results},
+                },
+                f, indent=2, sort_keys=True,
+            )
+        print(f'Saved the baseline to {args.baseline}')
+    elif regressions:
+        print(
+            f'{len(regressions)} case(s) regressed by more than '
+            f'{args.threshold:.0%}',
+            file=sys.stderr,
+        )
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
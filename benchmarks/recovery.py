@@ -0,0 +1,716 @@
+"""Time to recover from faults of the order book process, and what they cost.
+
+Run ``python -m benchmarks.recovery --database-url postgresql:///scratch``
+from the repository root.
+
+An :class:`~run_order_book.OrderBookThread` drains a backlog of synthetic
+order flow from :mod:`benchmarks.matching`, which ends by canceling every
+order of its users.  Commands come from an in-memory :class:`Broker` which
+behaves like RabbitMQ does for the order book: one unacknowledged command
+at a time per consumer, put back at the head of its queue when the channel
+closes.  Every ``--every`` commands one of ``--faults`` is injected in
+turn:
+
+``kill``
+   The process dies while matching an order, before anything is committed.
+``unacked``
+   The process dies after committing a command, before acknowledging it.
+``channel``
+   The broker drops the channel when the command is acknowledged.
+``rollback``
+   A commit fails, e.g. on a database failover, and is rolled back.
+
+A killed order book is restarted after ``--restart-delay`` seconds, like a
+supervisor would; the others recover by themselves.  For each fault the
+report tells the time until the order book consumed commands again, and
+until it acknowledged one again.  Then the database is checked: that every
+acknowledged order which was not rejected is stored, that the filled volume
+of each order adds up to its trades, that balances still match the ledger
+and open orders, and that the order book holds the open orders of the
+database.  The run exits with status 1 if any check fails.
+
+With ``--balance-service`` balances are kept by a
+:class:`~iu.order_book.balance.BalanceService`, whose reservations must be
+released and whose settlements must not be applied twice when a command
+fails to commit.
+
+Commands are committed for real, so use a scratch database.  The market
+must have no open orders, which a completed run leaves none of.
+
+"""
+import argparse
+import collections
+import contextlib
+import dataclasses
+import decimal
+import itertools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import (
+    Any, Deque, Dict, Iterator, List, Mapping, Optional, Sequence, Set,
+    Tuple,
+)
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.functions import sum as sqlsum
+
+from iu.balance import Balance
+from iu.order import Order
+from iu.order_book.app import EngineApp
+from iu.order_book.balance import BalanceService
+from iu.order_book.book import OrderBook, fee_user_id
+from iu.order_book.codec import encode_command
+from iu.order_book.mq import Delivery, Requests, Transport
+from iu.order_book.publisher import WebsocketPublisher
+from iu.orm import Session
+from iu.trade import Trade
+from iu.transaction import Transaction
+from iu.user import User
+from iu.uuid7 import uuid7
+from run_order_book import OrderBookThread
+
+from .dataset import create_markets
+from .matching import PAIR, Event, generate_flow
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('--database-url', required=True,
+                    help='scratch database to run the order book against')
+parser.add_argument('-s', '--seed', type=int, default=0)
+parser.add_argument('-n', '--count', type=int, default=2000,
+                    help='orders and cancels to process')
+parser.add_argument('--users', type=int, default=20)
+parser.add_argument('--cancel-ratio', type=float, default=0.3,
+                    help='share of events which cancel a placed order')
+parser.add_argument('--faults', default='kill,unacked,channel,rollback',
+                    help='comma-separated faults to inject in turn')
+parser.add_argument('--every', type=int, default=100,
+                    help='commands between faults')
+parser.add_argument('--restart-delay', type=float, default=0.0,
+                    help='seconds before a killed order book is restarted')
+parser.add_argument('--encoding', choices=('json', 'binary'),
+                    default='json', help='encoding of the commands')
+parser.add_argument('--balance-service', action='store_true',
+                    help='keep balances in the in-memory balance service')
+parser.add_argument('--timeout', type=float, default=600.0,
+                    help='seconds to wait for the backlog to be drained')
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='show the output of the order book')
+
+FAULTS = ('kill', 'unacked', 'channel', 'rollback')
+#: Sent as ``reply_to``, so the order book replies to placed orders.
+REPLY_TO = 'recovery'
+
+
+class Killed(BaseException):
+    """Stands for the death of the process.
+
+    It is not an :class:`Exception`, so that nothing in the order book
+    catches it, like nothing can catch ``SIGKILL``.
+
+    """
+
+
+class InjectedFault(Exception):
+    """A fault the order book process survives, e.g. a dropped channel."""
+
+
+@dataclass
+class Recovery:
+    fault: str
+    injected_at: float
+    #: When the order book consumed commands again.
+    ready_at: Optional[float] = None
+    #: When the order book acknowledged a command again.
+    resumed_at: Optional[float] = None
+
+
+class FaultInjector:
+    """Arms the next fault every ``every`` deliveries, and fires it at the
+    first place it applies to.
+
+    """
+
+    def __init__(self, faults: Sequence[str], every: int):
+        self.faults = itertools.cycle(faults)
+        self.every = every
+        self.lock = threading.Lock()
+        self.deliveries = 0
+        self.armed: Optional[str] = None
+        self.recoveries: List[Recovery] = []
+
+    def delivered(self):
+        with self.lock:
+            self.deliveries += 1
+            if self.armed is None and self.deliveries % self.every == 0:
+                self.armed = next(self.faults)
+
+    def fire(self, fault: str) -> bool:
+        with self.lock:
+            if self.armed != fault:
+                return False
+            self.armed = None
+            self.recoveries.append(Recovery(fault, time.perf_counter()))
+            return True
+
+    def consumed(self):
+        now = time.perf_counter()
+        with self.lock:
+            for recovery in self.recoveries:
+                if recovery.ready_at is None:
+                    recovery.ready_at = now
+
+    def acked(self):
+        now = time.perf_counter()
+        with self.lock:
+            for recovery in self.recoveries:
+                if recovery.resumed_at is None:
+                    # It never stopped consuming.
+                    if recovery.ready_at is None:
+                        recovery.ready_at = recovery.injected_at
+                    recovery.resumed_at = now
+
+
+class Broker:
+    """In-memory stand-in for the queues of RabbitMQ."""
+
+    def __init__(self, injector: FaultInjector):
+        self.injector = injector
+        self.condition = threading.Condition()
+        self.queues: Dict[str, Deque[Delivery]] = collections.defaultdict(
+            collections.deque,
+        )
+        self.published = 0
+        self.redelivered = 0
+        #: Correlation ids of the acknowledged commands.
+        self.acked: Set[str] = set()
+        #: Last reply to each command, by its correlation id.
+        self.replies: Dict[str, bytes] = {}
+
+    def publish(self, pair: str, body: bytes, *, content_type: str,
+                correlation_id: str):
+        with self.condition:
+            self.queues[pair].append(Delivery(
+                tag=None,
+                body=body,
+                content_type=content_type,
+                correlation_id=correlation_id,
+                reply_to=REPLY_TO,
+                published_at=time.time(),
+            ))
+            self.published += 1
+            self.condition.notify_all()
+
+    def wait_drained(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: len(self.acked) == self.published, timeout,
+            )
+
+
+class BrokerTransport(Transport):
+    """A channel of :class:`Broker` for an order book, which prefetches a
+    single command.
+
+    """
+
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self.unacked: Optional[Tuple[str, Delivery]] = None
+        self.consuming = False
+
+    def close(self):
+        # The broker requeues what the channel has not acknowledged.
+        with self.broker.condition:
+            if self.unacked:
+                pair, delivery = self.unacked
+                self.unacked = None
+                self.broker.queues[pair].appendleft(
+                    dataclasses.replace(delivery, redelivered=True),
+                )
+                self.broker.redelivered += 1
+            self.consuming = False
+            self.broker.condition.notify_all()
+
+    def publish(
+        self,
+        pair: str,
+        body: bytes,
+        *,
+        content_type: str,
+        correlation_id: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ):
+        self.broker.publish(
+            pair, body,
+            content_type=content_type,
+            correlation_id=correlation_id or str(uuid7()),
+        )
+
+    def request(
+        self, requests: Requests, *, timeout: float,
+    ) -> Dict[str, bytes]:
+        correlation_ids = {}
+        for pair, (body, content_type) in requests.items():
+            correlation_id = str(uuid7())
+            correlation_ids[correlation_id] = pair
+            self.publish(
+                pair, body,
+                content_type=content_type, correlation_id=correlation_id,
+            )
+        replies = self.broker.replies
+        with self.broker.condition:
+            self.broker.condition.wait_for(
+                lambda: correlation_ids.keys() <= replies.keys(), timeout,
+            )
+            return {
+                pair: replies[correlation_id]
+                for correlation_id, pair in correlation_ids.items()
+                if correlation_id in replies
+            }
+
+    def consume(
+        self, pair: str, *, inactivity_timeout: float,
+    ) -> Iterator[Optional[Delivery]]:
+        broker = self.broker
+        broker.injector.consumed()
+        self.consuming = True
+        queue = broker.queues[pair]
+        while True:
+            with broker.condition:
+                broker.condition.wait_for(
+                    lambda: not self.consuming or (
+                        queue and self.unacked is None
+                    ),
+                    inactivity_timeout,
+                )
+                if not self.consuming:
+                    return
+                if not queue or self.unacked is not None:
+                    delivery = None
+                else:
+                    delivery = queue.popleft()
+                    self.unacked = pair, delivery
+            if delivery is None:
+                yield None
+                continue
+            broker.injector.delivered()
+            yield delivery
+
+    def ack(self, delivery: Delivery):
+        injector = self.broker.injector
+        if injector.fire('unacked'):
+            raise Killed()
+        if injector.fire('channel'):
+            self.close()
+            raise InjectedFault('the channel was closed by the broker')
+        with self.broker.condition:
+            self.unacked = None
+            self.broker.acked.add(delivery.correlation_id)
+            self.broker.condition.notify_all()
+        injector.acked()
+
+    def reply(self, delivery: Delivery, body: bytes, *, content_type: str):
+        with self.broker.condition:
+            self.broker.replies[delivery.correlation_id] = body
+            self.broker.condition.notify_all()
+
+    def cancel(self):
+        with self.broker.condition:
+            self.consuming = False
+            self.broker.condition.notify_all()
+
+
+class NullPublisher(WebsocketPublisher):
+    """Drops what the order book publishes; websockets are not under test,
+    and a publisher which is never started would only fill its buffer."""
+
+    def __init__(self):
+        super().__init__('ws://127.0.0.1:9/')
+
+    def publish(self, messages):
+        pass
+
+
+@dataclass
+class FaultyOrderBook(OrderBook):
+    broker: Optional[Broker] = None
+
+    def create_transport(self) -> Transport:
+        return BrokerTransport(self.broker)
+
+    def match_order(self, new_order):
+        result = super().match_order(new_order)
+        if self.broker.injector.fire('kill'):
+            raise Killed()
+        return result
+
+
+class SupervisedOrderBookThread(OrderBookThread):
+
+    def __init__(
+        self, app, pair: str, broker: Broker, publisher,
+        balance_service=None,
+    ):
+        super().__init__(app, pair, balance_service, publisher)
+        self.broker = broker
+
+    def create_order_book(self) -> OrderBook:
+        return FaultyOrderBook(
+            self.app,
+            balance_service=self.balance_service,
+            publisher=self.publisher,
+            broker=self.broker,
+        )
+
+    def run(self):
+        try:
+            super().run()
+        except Killed:
+            pass
+
+
+@dataclass
+class Result:
+    commands: int = 0
+    elapsed: float = 0.0
+    redelivered: int = 0
+    recoveries: List[Recovery] = field(default_factory=list)
+    #: Replies to placed orders by status, and reason of rejections.
+    outcomes: Dict[str, int] = field(default_factory=dict)
+    problems: List[str] = field(default_factory=list)
+
+
+def create_commands(
+    events: Sequence[Event], user_ids: Sequence[uuid.UUID],
+) -> List[Dict[str, Any]]:
+    """Turn ``events`` into commands, followed by a ``cancelAll`` of each of
+    ``user_ids``, so that no order is left open.
+
+    Orders get fresh ids, so that a flow can be run again on the same
+    database.
+
+    """
+    ids = {}
+    commands = []
+    for flow_event in events:
+        if flow_event.order is None:
+            commands.append({
+                'type': 'cancel', 'order_ids': [ids[flow_event.cancel_id]],
+            })
+        else:
+            order = flow_event.order
+            ids[order.id] = uuid7()
+            commands.append({'type': 'place', 'order': Order(
+                id=ids[order.id],
+                user_id=order.user_id,
+                side=order.side,
+                volume=order.volume,
+                remaining_volume=order.remaining_volume,
+                price=order.price,
+                pair=order.pair,
+            )})
+    for user_id in user_ids:
+        commands.append({'type': 'cancelAll', 'user_id': user_id})
+    return commands
+
+
+def create_fixtures(session, user_ids: Sequence[uuid.UUID]):
+    """Create the market, the fee account, and users with plenty of both
+    currencies, unless they exist from a previous run.
+
+    Balances are created without a ledger, so only the changes of their
+    discrepancies from it are checked.
+
+    """
+    create_markets(session, [PAIR])
+    for user_id in (fee_user_id, *user_ids):
+        if session.query(User).get(user_id) is None:
+            session.add(User(
+                id=user_id,
+                email=f'recovery-{user_id.int}@iu.exchange',
+                password='iu-exchange!',
+            ))
+    session.flush()
+    balances = Balance.get_or_create_bulk(session, [
+        (user_id, currency)
+        for user_id in user_ids
+        for currency in PAIR.split('/')
+    ])
+    for balance in balances.values():
+        if not balance.amount:
+            balance.amount = decimal.Decimal(10 ** 12)
+            setattr(balance, '_no_orm_events', True)
+    session.commit()
+
+
+def get_discrepancies(
+    session, user_ids: Sequence[uuid.UUID],
+) -> Dict[Tuple[uuid.UUID, str], Tuple[decimal.Decimal, decimal.Decimal]]:
+    """How far the balances of ``user_ids`` are from their ledger, and their
+    locked amounts from their open orders.
+
+    """
+    zero = decimal.Decimal(0)
+    amounts = collections.defaultdict(lambda: [zero, zero])
+    for balance in session.query(Balance).filter(
+        Balance.user_id.in_(user_ids),
+    ):
+        amounts[balance.user_id, balance.currency] = [
+            balance.amount, balance.locked_amount,
+        ]
+    transactions = session.query(
+        Transaction.user_id, Transaction.currency, sqlsum(Transaction.amount),
+    ).filter(
+        Transaction.user_id.in_(user_ids),
+    ).group_by(Transaction.user_id, Transaction.currency)
+    for user_id, currency, amount in transactions:
+        amounts[user_id, currency][0] -= amount
+    orders = session.query(
+        Order.user_id, Order.locking_currency,
+        sqlsum(Order.remaining_locked_amount),
+    ).filter(
+        Order.active, Order.user_id.in_(user_ids),
+    ).group_by(Order.user_id, Order.locking_currency)
+    for user_id, currency, locked_amount in orders:
+        amounts[user_id, currency][1] -= locked_amount
+    return {key: tuple(value) for key, value in amounts.items()}
+
+
+def verify(
+    session,
+    broker: Broker,
+    commands: Mapping[str, Mapping[str, Any]],
+    discrepancies: Mapping[Tuple[uuid.UUID, str], Any],
+    order_ids: Sequence[uuid.UUID],
+) -> Tuple[Dict[str, int], List[str]]:
+    """Check the database after a run.
+
+    :param commands: the published commands by their correlation id
+    :param discrepancies: :func:`get_discrepancies` before the run
+    :param order_ids: ids of the open orders the order book holds
+    :return: counts of the outcomes of placed orders, and the problems found
+
+    """
+    problems = []
+    placed = {
+        command['order'].id: correlation_id
+        for correlation_id, command in commands.items()
+        if command['type'] == 'place'
+    }
+    stored = {
+        order.id: order
+        for order in session.query(Order).filter(Order.id.in_(list(placed)))
+    }
+    outcomes = collections.Counter()
+    for order_id, correlation_id in placed.items():
+        if correlation_id not in broker.acked:
+            problems.append(f'order {order_id} was never acknowledged')
+            continue
+        reply = json.loads(broker.replies[correlation_id])
+        status = reply['status']
+        if 'reason' in reply:
+            status += f' ({reply["reason"]})'
+        outcomes[status] += 1
+        if reply['status'] != 'rejected' and order_id not in stored:
+            problems.append(f'order {order_id} was {status}, but is lost')
+    traded = collections.defaultdict(decimal.Decimal)
+    for column in (Trade.buy_order_id, Trade.sell_order_id):
+        for order_id, volume in session.query(
+            column, sqlsum(Trade.volume),
+        ).filter(column.in_(list(stored))).group_by(column):
+            traded[order_id] += volume
+    for order in stored.values():
+        filled = order.volume - order.remaining_volume
+        if filled != traded[order.id]:
+            problems.append(
+                f'order {order.id} filled {filled}, but traded '
+                f'{traded[order.id]}'
+            )
+    user_ids = sorted({user_id for user_id, _ in discrepancies})
+    for key, value in get_discrepancies(session, user_ids).items():
+        zero = decimal.Decimal(0)
+        if value != discrepancies.get(key, (zero, zero)):
+            user_id, currency = key
+            problems.append(
+                f'balance of {user_id} in {currency} is off the ledger or '
+                f'open orders by {value}'
+            )
+    open_order_ids = {
+        order_id for order_id, in session.query(Order.id).filter(
+            Order.active, Order.pair == PAIR,
+        )
+    }
+    if open_order_ids != set(order_ids):
+        problems.append(
+            f'the order book holds {len(order_ids)} open orders, but the '
+            f'database {len(open_order_ids)}'
+        )
+    return dict(outcomes), problems
+
+
+def run_recovery(
+    database_url: str,
+    events: Sequence[Event],
+    user_ids: Sequence[uuid.UUID],
+    *,
+    faults: Sequence[str] = FAULTS,
+    every: int = 100,
+    restart_delay: float = 0.0,
+    encoding: str = 'json',
+    balance_service: bool = False,
+    timeout: float = 600.0,
+) -> Result:
+    engine = create_engine(database_url)
+    session = Session(bind=engine)
+    config = {
+        'database': {'url': database_url},
+        'order_book': {'command_encoding': encoding},
+    }
+    injector = FaultInjector(faults, every)
+    broker = Broker(injector)
+
+    def on_commit(connection):
+        if injector.fire('rollback'):
+            raise InjectedFault('the commit was rolled back')
+
+    event.listen(Engine, 'commit', on_commit)
+    try:
+        if session.query(Order.id).filter(
+            Order.active, Order.pair == PAIR,
+        ).first() is not None:
+            raise ValueError(f'{PAIR} has open orders; use a scratch database')
+        create_fixtures(session, user_ids)
+        discrepancies = get_discrepancies(
+            session, [fee_user_id, *user_ids],
+        )
+        session.commit()
+        commands = {
+            str(i): command
+            for i, command in enumerate(create_commands(events, user_ids))
+        }
+        for correlation_id, command in commands.items():
+            body, content_type = encode_command(command, encoding=encoding)
+            broker.publish(
+                PAIR, body,
+                content_type=content_type,
+                correlation_id=correlation_id,
+            )
+        app = EngineApp(config)
+        publisher = NullPublisher()
+        balances = BalanceService(app) if balance_service else None
+        # Stopping the balance service flushes it before the checks.
+        with balances or contextlib.nullcontext():
+            started = time.perf_counter()
+            deadline = started + timeout
+            thread = None
+            while not broker.wait_drained(0.01):
+                if time.perf_counter() > deadline:
+                    break
+                if thread and thread.is_alive():
+                    continue
+                if thread:
+                    time.sleep(restart_delay)
+                thread = SupervisedOrderBookThread(
+                    app, PAIR, broker, publisher, balances,
+                )
+                thread.start()
+            elapsed = time.perf_counter() - started
+            order_ids = list(thread.order_book.order_ids)
+            thread.kill()
+            thread.join()
+        outcomes, problems = verify(
+            session, broker, commands, discrepancies, order_ids,
+        )
+    finally:
+        event.remove(Engine, 'commit', on_commit)
+        session.close()
+        engine.dispose()
+    return Result(
+        commands=len(commands),
+        elapsed=elapsed,
+        redelivered=broker.redelivered,
+        recoveries=injector.recoveries,
+        outcomes=outcomes,
+        problems=problems,
+    )
+
+
+def main():
+    args = parser.parse_args()
+    faults = args.faults.split(',')
+    for fault in faults:
+        if fault not in FAULTS:
+            parser.error(f'unknown fault: {fault!r}')
+    events = list(generate_flow(
+        args.seed,
+        args.count,
+        users=args.users,
+        cancel_ratio=args.cancel_ratio,
+    ))
+    user_ids = [uuid.UUID(int=i + 1) for i in range(args.users)]
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            devnull = stack.enter_context(open(os.devnull, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(contextlib.redirect_stderr(devnull))
+        try:
+            result = run_recovery(
+                args.database_url,
+                events,
+                user_ids,
+                faults=faults,
+                every=args.every,
+                restart_delay=args.restart_delay,
+                encoding=args.encoding,
+                balance_service=args.balance_service,
+                timeout=args.timeout,
+            )
+        except ValueError as e:
+            stack.close()
+            parser.error(str(e))
+    print(
+        f'{result.commands} commands in {result.elapsed:.1f}s, '
+        f'{len(result.recoveries)} faults, {result.redelivered} redelivered'
+    )
+    print(
+        f'{"fault":<10}{"count":>7}{"ready p50 ms":>14}{"ready max ms":>14}'
+        f'{"acked p50 ms":>14}{"acked max ms":>14}'
+    )
+    for fault in faults:
+        recoveries = [r for r in result.recoveries if r.fault == fault]
+        line = f'{fault:<10}{len(recoveries):>7}'
+        for durations in (
+            [r.ready_at - r.injected_at for r in recoveries if r.resumed_at],
+            [r.resumed_at - r.injected_at for r in recoveries if r.resumed_at],
+        ):
+            if durations:
+                line += (
+                    f'{statistics.median(durations) * 1e3:>14.0f}'
+                    f'{max(durations) * 1e3:>14.0f}'
+                )
+            else:
+                line += f'{"-":>14}{"-":>14}'
+        print(line)
+    print('placed orders: ' + ', '.join(
+        f'{count} {status}'
+        for status, count in sorted(result.outcomes.items())
+    ))
+    if result.problems:
+        for problem in result.problems:
+            print(problem, file=sys.stderr)
+        print(f'{len(result.problems)} problem(s) found', file=sys.stderr)
+        raise SystemExit(1)
+    print('nothing acknowledged was lost or applied twice')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Cost of each runtime type check policy on hot functions.
+
+Run ``python -m benchmarks.typecheck`` from the repository root.
+
+"""
+import argparse
+import decimal
+import inspect
+import timeit
+
+from iu.order import OrderSide
+from iu.serializer import serialize_decimal
+from iu.typecheck import typechecked
+
+parser = argparse.ArgumentParser(
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-n', '--number', type=int, default=100000,
+                    help='calls per measurement')
+parser.add_argument('-r', '--rate', type=int, default=100,
+                    help='sampling rate of the sampled policy')
+
+
+def get_cases():
+    # Unwrap what the current policy decorated, to decorate it again with
+    # each policy below.
+    return {
+        'OrderSide.choice': (
+            inspect.unwrap(OrderSide.choice),
+            (OrderSide.sell,), {'buy': 1, 'sell': 2},
+        ),
+        'OrderSide.__invert__': (
+            inspect.unwrap(OrderSide.__invert__), (OrderSide.buy,), {},
+        ),
+        'serialize_decimal': (
+            inspect.unwrap(serialize_decimal),
+            (decimal.Decimal('12345.678900000000000000'),), {},
+        ),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    print(f'{"function":<24}{"policy":<10}{"ns/call":>10}{"ratio":>8}')
+    for name, (func, func_args, func_kwargs) in get_cases().items():
+        baseline = None
+        for policy in ('off', 'sampled', 'full'):
+            decorated = typechecked(func, policy=policy, rate=args.rate)
+            seconds = min(timeit.repeat(
+                lambda: decorated(*func_args, **func_kwargs),
+                number=args.number,
+                repeat=3,
+            ))
+            baseline = baseline or seconds
+            print(
+                f'{name:<24}{policy:<10}'
+                f'{seconds / args.number * 1e9:>10.0f}'
+                f'{seconds / baseline:>7.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
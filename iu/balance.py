@@ -15,10 +15,10 @@ from sqlalchemy.schema import (
 from sqlalchemy.sql.expression import tuple_
 from sqlalchemy.types import Numeric, Unicode
 from sqlalchemy_utils.types.uuid import UUIDType
-from typeguard import typechecked
 
 from .currency import Currency
 from .orm import Base, SessionType
+from .typecheck import typechecked
 
 
 class Balance(Base):
@@ -6,12 +6,11 @@ import time
 from dataclasses import dataclass
 from typing import Dict, Iterable, List, Union
 
-from typeguard import typechecked
-
 from ..balance import Balance
 from ..currency import Currency
 from ..orm import SessionType, create_session
 from ..transaction import Deposit
+from ..typecheck import typechecked
 
 
 @dataclass
@@ -51,6 +50,8 @@ class BaseBlockchain:
             f'{self.__class__.__module__}.{self.__class__.__qualname__}'
         )
         self.alive = False
+        #: Blocks seen since :meth:`sync` started, to detect reorganizations.
+        self.blocks: List[BaseBlock] = []
 
     @contextlib.contextmanager
     def context(self):
@@ -219,7 +220,7 @@ class BaseBlockchain:
         from concurrent.futures.thread import ThreadPoolExecutor
 
         sync_count = 10
-        blocks = []
+        blocks = self.blocks = []
         for index in range(start_number, latest_block.number + 1, sync_count):
             if not self.alive:
                 return
@@ -5,8 +5,8 @@ import uuid
 
 from pycoin.key.BIP32Node import BIP32Node
 from requests import post
-from typeguard import typechecked
 
+from ..typecheck import typechecked
 from .base import BaseBlock, BaseBlockchain, BaseTransaction
 from .util import uuid_to_bip44_path
 
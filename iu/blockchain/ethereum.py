@@ -6,10 +6,10 @@ from typing import List, Union
 
 from ecdsa import SECP256k1, SigningKey
 from pycoin.key.BIP32Node import BIP32Node
-from typeguard import typechecked
 from web3 import HTTPProvider, WebsocketProvider, Web3
 from web3.utils.filters import Filter
 
+from ..typecheck import typechecked
 from .base import BaseBlock, BaseBlockchain, BaseTransaction
 from .util import uuid_to_bip44_path
 
@@ -3,6 +3,7 @@ from __future__ import annotations
 import datetime
 import decimal
 import enum
+import operator
 from typing import List, Optional, Dict, Tuple
 
 from sqlalchemy.schema import CheckConstraint, Column
@@ -11,11 +12,11 @@ from sqlalchemy.sql.functions import func
 from sqlalchemy.types import Integer, Numeric
 from sqlalchemy_enum34 import EnumType
 from sqlalchemy_utc.sqltypes import UtcDateTime
-from typeguard import typechecked
 
 from .mixin import PrimaryKeyPairMixin
 from .trade import Trade
 from .orm import Base, SessionType
+from .typecheck import typechecked
 
 
 class CandleUnitType(enum.Enum):
@@ -42,7 +43,14 @@ class Candle(Base, PrimaryKeyPairMixin):
 
     unit = Column(Integer, primary_key=True)
     unit_type = Column(
-        EnumType(CandleUnitType, name='candle_unit_type'), primary_key=True,
+        EnumType(
+            CandleUnitType,
+            name='candle_unit_type',
+            # Flushes sort instances by primary key, which the default key
+            # of EnumType fails on with its own members.
+            sort_key_function=operator.attrgetter('value'),
+        ),
+        primary_key=True,
     )
     timestamp = Column(UtcDateTime, nullable=False, primary_key=True)
     updated_at = Column(UtcDateTime, nullable=False)
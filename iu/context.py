@@ -1,10 +1,10 @@
 from typing import Any, List, Mapping
 
 from flask import current_app, request
-from typeguard import typechecked
 from werkzeug.local import LocalProxy
 
 from .orm import SessionType, create_session
+from .typecheck import typechecked
 
 
 @LocalProxy
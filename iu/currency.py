@@ -2,9 +2,9 @@ from sqlalchemy.orm import validates
 from sqlalchemy.schema import CheckConstraint, Column
 from sqlalchemy.sql.functions import func
 from sqlalchemy.types import Integer, Numeric, Unicode
-from typeguard import typechecked
 
 from .orm import Base
+from .typecheck import typechecked
 
 
 class Currency(Base):
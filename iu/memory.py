@@ -0,0 +1,137 @@
+"""Memory reports of long-running processes, taken on demand.
+
+:class:`MemoryTracker` counts the objects in the structures a process
+registers with :meth:`~MemoryTracker.track`, and takes :mod:`tracemalloc`
+snapshots to find where memory is allocated.  Tracing slows allocations
+down, so it is only started by the first report, and stays on until it is
+stopped.  Each report after the first lists the allocation sites which grew
+most since the report before, so a leak stands out after a few reports::
+
+    curl -X POST http://127.0.0.1:9101/memory
+    curl -X POST 'http://127.0.0.1:9101/memory?limit=20'
+    curl -X POST 'http://127.0.0.1:9101/memory?stop=1'
+
+"""
+import threading
+import tracemalloc
+from typing import (
+    Callable, Dict, List, Mapping, Optional, Sequence, Union,
+)
+
+from .typecheck import typechecked
+
+
+#: Frames kept for each traced allocation.
+TRACEBACK_LIMIT = 10
+
+
+class MemoryTracker:
+
+    def __init__(self, nframes: int = TRACEBACK_LIMIT):
+        self.nframes = nframes
+        self.lock = threading.Lock()
+        self.structures: Dict[str, Callable[[], int]] = {}
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+
+    @typechecked
+    def track(self, name: str, count: Callable[[], int]) -> None:
+        """Report ``count()`` as the number of objects in ``name``."""
+        self.structures[name] = count
+
+    @typechecked
+    def count_structures(self) -> Dict[str, int]:
+        counts = {}
+        for name, count in sorted(self.structures.items()):
+            try:
+                counts[name] = count()
+            except Exception:
+                # A structure may be replaced while it is being counted.
+                counts[name] = -1
+        return counts
+
+    @typechecked
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+
+    @typechecked
+    def report(self, limit: int = 10) -> str:
+        """Report the tracked structures and the top allocation sites.
+
+        The first report starts tracing, so it has no allocation sites yet.
+
+        """
+        with self.lock:
+            lines = ['# Structures']
+            for name, count in self.count_structures().items():
+                lines.append(f'{name} {count}')
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.nframes)
+                self.snapshot = self.take_snapshot()
+                lines.append('# Started tracing allocations')
+                return '\n'.join(lines) + '\n'
+            snapshot = self.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(
+                f'# Traced memory: {current / 1024:.1f} KiB, '
+                f'peak {peak / 1024:.1f} KiB'
+            )
+            lines.append('# Top allocation sites')
+            lines.extend(format_statistics(
+                snapshot.statistics('lineno')[:limit],
+            ))
+            if self.snapshot is not None:
+                lines.append('# Growth since the last report')
+                lines.extend(format_statistics([
+                    stat
+                    for stat in snapshot.compare_to(self.snapshot, 'lineno')
+                    if stat.size_diff > 0
+                ][:limit]))
+            self.snapshot = snapshot
+        return '\n'.join(lines) + '\n'
+
+    def stop(self) -> str:
+        with self.lock:
+            tracemalloc.stop()
+            self.snapshot = None
+        return 'Stopped tracing allocations\n'
+
+
+@typechecked
+def format_statistics(
+    statistics: Sequence[
+        Union[tracemalloc.Statistic, tracemalloc.StatisticDiff]
+    ],
+) -> List[str]:
+    lines = []
+    for stat in statistics:
+        frame = stat.traceback[0]
+        line = (
+            f'{frame.filename}:{frame.lineno}'
+            f' size={stat.size / 1024:.1f} KiB count={stat.count}'
+        )
+        if isinstance(stat, tracemalloc.StatisticDiff):
+            line += (
+                f' size_diff={stat.size_diff / 1024:+.1f} KiB'
+                f' count_diff={stat.count_diff:+d}'
+            )
+        lines.append(line)
+    return lines
+
+
+@typechecked
+def create_memory_command(
+    tracker: MemoryTracker,
+) -> Callable[[Mapping[str, str]], str]:
+    """Return the ``memory`` admin command of :func:`~.metrics.serve_metrics`,
+    which reports by ``tracker``, or stops tracing if ``stop`` is given.
+
+    """
+    def memory(parameters: Mapping[str, str]) -> str:
+        if parameters.get('stop'):
+            return tracker.stop()
+        return tracker.report(limit=int(parameters.get('limit', 10)))
+    return memory
@@ -0,0 +1,226 @@
+"""In-process metrics and a plain text endpoint to scrape them.
+
+Metrics are kept in a :class:`Registry` by name and labels, and rendered in
+the Prometheus text exposition format by :func:`serve_metrics`.  Latencies
+are recorded into :class:`Histogram`\\ s, which report percentiles rather
+than averages, so tail regressions are visible.  The same endpoint also
+runs admin commands of the process, e.g. taking a profile, by ``POST``
+requests.
+
+"""
+import http.server
+import threading
+import urllib.parse
+from typing import (
+    Callable, Dict, Iterable, List, Mapping, Optional, Tuple,
+)
+
+from .typecheck import typechecked
+
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    """Histogram of durations with log-linear buckets, like HdrHistogram.
+
+    Durations are recorded in microseconds.  Each power of two is split
+    into ``2 ** (precision - 1)`` buckets of equal width, so a percentile is
+    reported within a relative error of ``2 ** (1 - precision)``, while the
+    number of buckets only grows with the logarithm of the range.
+
+    """
+
+    def __init__(self, precision: int = 7):
+        self.precision = precision
+        self.lock = threading.Lock()
+        #: Counts by the lower bound of each bucket, in microseconds.
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def get_bucket_width(self, lower: int) -> int:
+        return 1 << max(0, lower.bit_length() - self.precision)
+
+    def record(self, seconds: float):
+        value = int(seconds * 1e6)
+        shift = max(0, value.bit_length() - self.precision)
+        lower = value >> shift << shift
+        with self.lock:
+            self.counts[lower] = self.counts.get(lower, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def get_percentiles(
+        self, quantiles: Iterable[float] = QUANTILES,
+    ) -> List[Tuple[float, float]]:
+        """Return the duration in seconds at each of ``quantiles``.
+
+        Each is the upper bound of the bucket it falls in.
+
+        """
+        with self.lock:
+            counts = sorted(self.counts.items())
+            count = self.count
+        result = []
+        for quantile in quantiles:
+            if not count:
+                result.append((quantile, 0.0))
+                continue
+            rank = quantile * count
+            seen = 0
+            for lower, bucket_count in counts:
+                seen += bucket_count
+                if seen >= rank:
+                    break
+            upper = lower + self.get_bucket_width(lower)
+            result.append((quantile, upper / 1e6))
+        return result
+
+
+class Counter:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def increment(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Dict[LabelsKey, Histogram]] = {}
+        self.counters: Dict[str, Dict[LabelsKey, Counter]] = {}
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            metrics = self.histograms.setdefault(name, {})
+            if key not in metrics:
+                metrics[key] = Histogram()
+            return metrics[key]
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            metrics = self.counters.setdefault(name, {})
+            if key not in metrics:
+                metrics[key] = Counter()
+            return metrics[key]
+
+    def render(self) -> str:
+        with self.lock:
+            counters = {
+                name: dict(metrics) for name, metrics in self.counters.items()
+            }
+            histograms = {
+                name: dict(metrics)
+                for name, metrics in self.histograms.items()
+            }
+        lines = []
+        for name, metrics in sorted(counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for key, counter in sorted(metrics.items()):
+                lines.append(f'{name}{format_labels(key)} {counter.value}')
+        for name, metrics in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} summary')
+            for key, histogram in sorted(metrics.items()):
+                for quantile, value in histogram.get_percentiles():
+                    labels = format_labels(key, quantile=str(quantile))
+                    lines.append(f'{name}{labels} {value:.6f}')
+                labels = format_labels(key)
+                lines.append(f'{name}_count{labels} {histogram.count}')
+                lines.append(f'{name}_sum{labels} {histogram.sum:.6f}')
+                lines.append(f'{name}_max{labels} {histogram.max:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+@typechecked
+def format_labels(key: LabelsKey, **extra: str) -> str:
+    labels = list(key) + list(extra.items())
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name, value.replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+#: Metrics of the process.
+registry = Registry()
+
+
+#: Admin command, which takes the query parameters of its request and
+#: returns a plain text result.
+#:
+#: :raise ValueError: on invalid parameters
+Command = Callable[[Mapping[str, str]], str]
+
+
+@typechecked
+def serve_metrics(
+    address: Tuple[str, int],
+    registry: Registry = registry,
+    *,
+    commands: Optional[Mapping[str, Command]] = None,
+) -> http.server.HTTPServer:
+    """Serve ``registry`` at ``GET /metrics`` from a daemon thread.
+
+    :param address: host and port to listen on; keep the host local, since
+                    nothing is authenticated
+    :param commands: admin commands run by ``POST /<name>?<parameters>``
+
+    """
+    commands = dict(commands or {})
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            self.send_text(200, registry.render())
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            command = commands.get(url.path.strip('/'))
+            if not command:
+                self.send_error(404)
+                return
+            parameters = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                result = command(parameters)
+            except (KeyError, ValueError) as e:
+                self.send_text(400, f'{type(e).__name__}: {e}\n')
+                return
+            self.send_text(200, result)
+
+        def send_text(self, status: int, text: str):
+            encoded = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name='MetricsServer', daemon=True,
+    ).start()
+    return server
@@ -7,7 +7,8 @@ from iu.currency import Currency
 
 from sqlalchemy.sql.functions import concat
 from sqlalchemy.ext.hybrid import Comparator, hybrid_property
-from typeguard import typechecked
+
+from .typecheck import typechecked
 
 
 class PairComparator(Comparator):
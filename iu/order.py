@@ -3,7 +3,6 @@ from __future__ import annotations
 import decimal
 import enum
 import operator
-import uuid
 from typing import Any, Callable, TypeVar, Union
 
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -19,10 +18,11 @@ from sqlalchemy_enum34 import EnumType
 from sqlalchemy_utc.now import utcnow
 from sqlalchemy_utc.sqltypes import UtcDateTime
 from sqlalchemy_utils.types.uuid import UUIDType
-from typeguard import typechecked
 
 from .mixin import PairMixin
 from .orm import Base
+from .typecheck import typechecked
+from .uuid7 import uuid7
 
 
 T = TypeVar('T')
@@ -54,7 +54,7 @@ class OrderSide(enum.Enum):
 
 
 class Order(Base, PairMixin):
-    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDType, primary_key=True, default=uuid7)
     created_at = Column(
         UtcDateTime, nullable=False, index=True, default=utcnow(),
     )
@@ -187,6 +187,14 @@ class Order(Base, PairMixin):
     def cancel(self) -> None:
         self.canceled_at = utcnow()
 
+    @typechecked
+    def mark_as_filled(self) -> None:
+        assert self.remaining_volume == 0
+        # The validator of remaining_volume may have set it to utcnow()
+        # already, which has no truth value.
+        if self.filled_at is None:
+            self.filled_at = utcnow()
+
     @hybrid_property
     @typechecked
     def active(self) -> bool:
@@ -0,0 +1,33 @@
+"""Bootstrap of order book processes without the web application.
+
+Order books only need the configuration, which the rest of the code reads
+as ``app.config['APP_CONFIG']``, to open database sessions and transports.
+Building the Flask application for that imports every blueprint and their
+dependencies, so order book processes use :class:`EngineApp` instead.
+
+"""
+import os
+from typing import Any, Mapping
+
+from ..typecheck import typechecked
+# Models refer to User by name in their relationships, which only resolve
+# once it is mapped; the web application used to import it for us.
+from ..user import User  # noqa: F401
+
+
+class EngineApp:
+    """Stand-in for the Flask application which carries only its config."""
+
+    @typechecked
+    def __init__(self, config: Mapping[str, Any]):
+        self.config = {'APP_CONFIG': config}
+
+
+@typechecked
+def create_engine_app(config: Mapping[str, Any]) -> EngineApp:
+    config = dict(config)
+    config['database'] = dict(config['database'])
+    config['database']['url'] = (
+        os.environ.get('DATABASE_URL') or config['database']['url']
+    )
+    return EngineApp(config)
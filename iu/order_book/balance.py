@@ -0,0 +1,433 @@
+import concurrent.futures
+import decimal
+import logging
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import (
+    Any, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple,
+)
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import bindparam, tuple_
+
+from ..balance import Balance
+from ..exc import NotEnoughBalance
+from ..orm import SessionType, create_session
+from ..typecheck import typechecked
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+BalanceKey = Tuple[uuid.UUID, str]
+BalanceDelta = Tuple[decimal.Decimal, decimal.Decimal]
+
+
+@dataclass
+class BalanceEntry:
+    amount: decimal.Decimal
+    locked_amount: decimal.Decimal
+    loaded_at: float
+    persisted: bool
+
+    @property
+    def usable_amount(self) -> decimal.Decimal:
+        return self.amount - self.locked_amount
+
+
+class BalancePartition(threading.Thread):
+    """Single writer of the balances of the users hashed to this partition.
+
+    Every read and write of :attr:`entries` happens on this thread; other
+    threads talk to it by :meth:`submit`-ting commands.  Applied deltas are
+    accumulated in :attr:`pending` and written back to the ``balance`` table
+    as relative updates every ``flush_interval`` seconds, busy or not, so
+    changes made to the table by other processes (deposits, withdrawals)
+    are never overwritten.
+
+    Checked deltas, i.e. reservations, are checked against the rows locked
+    ``FOR UPDATE`` instead, and written back at once, as other processes
+    lock funds in the table too, e.g. withdrawals.  Unchecked deltas never
+    decrease usable amounts, so the table never shows more usable funds
+    than there are.
+
+    """
+
+    def __init__(
+        self, app, index: int, *,
+        flush_interval: float, refresh_interval: float,
+    ):
+        super().__init__(name=f'BalancePartition-{index}', daemon=True)
+        self.app = app
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.commands = queue.Queue()
+        self.entries: Dict[BalanceKey, BalanceEntry] = {}
+        self.pending: Dict[BalanceKey, List[decimal.Decimal]] = {}
+        #: Orders whose changes are pending, by balance.
+        self.pending_order_ids: Dict[BalanceKey, Set[uuid.UUID]] = {}
+        #: Balances whose pending deltas the table refused on the last
+        #: flush, which are retried each on their own.
+        self.refused: Set[BalanceKey] = set()
+        self.session: Optional[SessionType] = None
+
+    def submit(
+        self, fn: Callable, *args, **kwargs,
+    ) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.commands.put((future, fn, args, kwargs))
+        return future
+
+    def stop(self):
+        self.commands.put(None)
+
+    def run(self):
+        self.session = create_session(self.app)
+        flushed_at = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if now - flushed_at >= self.flush_interval:
+                    self.flush()
+                    flushed_at = now
+                try:
+                    command = self.commands.get(
+                        timeout=flushed_at + self.flush_interval - now,
+                    )
+                except queue.Empty:
+                    continue
+                if command is None:
+                    break
+                future, fn, args, kwargs = command
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    # Or the session refuses every later query, e.g. after
+                    # a failed commit in load().
+                    self.session.rollback()
+                    future.set_exception(e)
+            self.flush()
+        finally:
+            self.session.close()
+            self.session = None
+
+    def load(self, keys, *, lock: bool = False):
+        """Load the entries of ``keys`` which are stale, or all of them
+        locked ``FOR UPDATE`` until the session commits if ``lock``."""
+        now = time.monotonic()
+        stale_keys = {
+            key for key in keys
+            if lock or key not in self.entries or
+            now - self.entries[key].loaded_at >= self.refresh_interval
+        }
+        if not stale_keys:
+            return
+        query = self.session.query(
+            Balance.user_id, Balance.currency,
+            Balance.amount, Balance.locked_amount,
+        ).filter(
+            tuple_(Balance.user_id, Balance.currency).in_(stale_keys)
+        )
+        if lock:
+            rows = query.with_for_update().all()
+        else:
+            rows = query.all()
+            self.session.commit()
+        zero = decimal.Decimal(0)
+        loaded = {
+            (user_id, currency): BalanceEntry(
+                amount=amount, locked_amount=locked_amount,
+                loaded_at=now, persisted=True,
+            )
+            for user_id, currency, amount, locked_amount in rows
+        }
+        for key in stale_keys:
+            entry = loaded.get(key)
+            if not entry:
+                # Not in the table yet; an unflushed new entry is kept as is
+                # since its whole value still lives in pending.
+                entry = self.entries.get(key) or BalanceEntry(
+                    amount=zero, locked_amount=zero,
+                    loaded_at=now, persisted=False,
+                )
+                entry.loaded_at = now
+            elif key in self.pending:
+                amount, locked_amount = self.pending[key]
+                entry.amount += amount
+                entry.locked_amount += locked_amount
+            self.entries[key] = entry
+
+    @typechecked
+    def apply(
+        self,
+        changes: Mapping[BalanceKey, BalanceDelta],
+        *,
+        check: bool = True,
+        order_ids: Iterable[uuid.UUID] = (),
+    ) -> Dict[BalanceKey, Mapping[str, Any]]:
+        self.load(changes.keys(), lock=check)
+        written = {}
+        if check:
+            zero = decimal.Decimal(0)
+            for key, (amount, locked_amount) in changes.items():
+                entry = self.entries[key]
+                new_amount = entry.amount + amount
+                new_locked_amount = entry.locked_amount + locked_amount
+                if not 0 <= new_locked_amount <= new_amount:
+                    raise NotEnoughBalance()
+                pending_amount, pending_locked_amount = self.pending.get(
+                    key, (zero, zero),
+                )
+                written[key] = [
+                    pending_amount + amount,
+                    pending_locked_amount + locked_amount,
+                ]
+            # Releases the row locks.
+            self.write(written)
+            self.session.commit()
+        result = {}
+        for key, (amount, locked_amount) in changes.items():
+            entry = self.entries[key]
+            entry.amount += amount
+            entry.locked_amount += locked_amount
+            if key in written:
+                entry.persisted = True
+                self.pending.pop(key, None)
+                self.pending_order_ids.pop(key, None)
+            else:
+                pending = self.pending.setdefault(
+                    key, [decimal.Decimal(0), decimal.Decimal(0)],
+                )
+                pending[0] += amount
+                pending[1] += locked_amount
+                self.pending_order_ids.setdefault(key, set()).update(
+                    order_ids,
+                )
+            user_id, currency = key
+            result[key] = {
+                'user_id': user_id,
+                'currency': currency,
+                'amount': entry.amount,
+                'locked_amount': entry.locked_amount,
+            }
+        return result
+
+    def write(self, pending: Mapping[BalanceKey, List[decimal.Decimal]]):
+        """Add ``pending`` deltas to the table, without committing."""
+        inserts = []
+        updates = []
+        for (user_id, currency), (amount, locked_amount) in pending.items():
+            if self.entries[user_id, currency].persisted:
+                updates.append({
+                    '_user_id': user_id,
+                    '_currency': currency,
+                    '_amount': amount,
+                    '_locked_amount': locked_amount,
+                })
+            else:
+                inserts.append({
+                    'user_id': user_id,
+                    'currency': currency,
+                    'amount': amount,
+                    'locked_amount': locked_amount,
+                })
+        table = Balance.__table__
+        if inserts:
+            self.session.execute(table.insert(), inserts)
+        if updates:
+            self.session.execute(
+                table.update().where(
+                    (table.c.user_id == bindparam('_user_id')) &
+                    (table.c.currency == bindparam('_currency'))
+                ).values({
+                    'amount': table.c.amount + bindparam('_amount'),
+                    'locked_amount': (
+                        table.c.locked_amount + bindparam('_locked_amount')
+                    ),
+                }),
+                updates,
+            )
+
+    def write_isolated(
+        self, pending: Mapping[BalanceKey, List[decimal.Decimal]],
+    ) -> Set[BalanceKey]:
+        """Write ``pending`` deltas in a batch, or each balance on its own
+        if the table refuses the batch, e.g. by ``ck_balance_amount``.
+
+        :return: the balances the table refused
+
+        """
+        batch = {
+            key: delta for key, delta in pending.items()
+            if key not in self.refused
+        }
+        singles = [key for key in pending if key in self.refused]
+        if batch:
+            self.session.begin_nested()
+            try:
+                self.write(batch)
+                self.session.commit()
+            except IntegrityError:
+                self.session.rollback()
+                singles.extend(batch)
+        refused = set()
+        for key in singles:
+            self.session.begin_nested()
+            try:
+                self.write({key: pending[key]})
+                self.session.commit()
+            except IntegrityError:
+                self.session.rollback()
+                refused.add(key)
+        return refused
+
+    def restore(
+        self,
+        pending: Mapping[BalanceKey, List[decimal.Decimal]],
+        order_ids: Mapping[BalanceKey, Set[uuid.UUID]],
+    ):
+        """Put deltas which failed to flush back to :attr:`pending`."""
+        for key, (amount, locked_amount) in pending.items():
+            merged = self.pending.setdefault(
+                key, [decimal.Decimal(0), decimal.Decimal(0)],
+            )
+            merged[0] += amount
+            merged[1] += locked_amount
+            self.pending_order_ids.setdefault(key, set()).update(
+                order_ids.get(key, ()),
+            )
+            # Some other process may have created the row meanwhile.
+            self.entries[key].loaded_at = float('-inf')
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        order_ids, self.pending_order_ids = self.pending_order_ids, {}
+        try:
+            refused = self.write_isolated(pending)
+            self.session.commit()
+        except Exception:
+            logger.exception(f'{self.name}: failed to flush balances')
+            self.session.rollback()
+            self.restore(pending, order_ids)
+            return
+        for key in refused - self.refused:
+            (user_id, currency), (amount, locked_amount) = key, pending[key]
+            orders = ', '.join(str(id_) for id_ in order_ids.get(key, ()))
+            logger.error(
+                f'{self.name}: the balance of {user_id} in {currency} '
+                f'refused {amount} and {locked_amount} locked, changed by '
+                f'orders {orders or "unknown"}; retrying it alone'
+            )
+        self.refused = refused
+        self.restore(
+            {key: pending[key] for key in refused},
+            {key: order_ids.get(key, set()) for key in refused},
+        )
+        for key in pending.keys() - refused:
+            self.entries[key].persisted = True
+
+
+class BalanceService:
+    """In-memory balance authority shared by every order book of a process.
+
+    Balances are partitioned by user id, and each partition is owned by a
+    single :class:`BalancePartition` thread, so order books of different
+    markets never wait on each other's row locks.  The ``transaction`` table
+    stays the ledger of record: if the process dies before the pending
+    deltas are flushed, ``sync_balance.py`` rebuilds the ``balance`` table
+    from it.
+
+    """
+
+    @typechecked
+    def __init__(
+        self, app, *,
+        partitions: int = 4,
+        flush_interval: float = 0.05,
+        refresh_interval: float = 1.0,
+    ):
+        self.partitions = [
+            BalancePartition(
+                app, index,
+                flush_interval=flush_interval,
+                refresh_interval=refresh_interval,
+            )
+            for index in range(partitions)
+        ]
+
+    def __enter__(self):
+        for partition in self.partitions:
+            partition.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for partition in self.partitions:
+            partition.stop()
+        for partition in self.partitions:
+            partition.join()
+
+    @typechecked
+    def partition_of(self, user_id: uuid.UUID) -> BalancePartition:
+        return self.partitions[user_id.int % len(self.partitions)]
+
+    @typechecked
+    def apply(
+        self,
+        changes: Mapping[BalanceKey, BalanceDelta],
+        *,
+        check: bool = True,
+        order_ids: Iterable[uuid.UUID] = (),
+    ) -> Dict[BalanceKey, Mapping[str, Any]]:
+        """Apply ``(amount, locked_amount)`` deltas atomically.
+
+        :param order_ids: the orders the changes come from, to report if
+                          the table refuses them
+
+        :raise NotEnoughBalance: when ``check`` is on and any balance would
+                                 end up with a negative usable or locked
+                                 amount.  Nothing is applied in that case,
+                                 nor when any partition fails otherwise.
+
+        """
+        order_ids = frozenset(order_ids)
+        partition_changes = {}
+        for key, delta in changes.items():
+            user_id, _ = key
+            partition = self.partition_of(user_id)
+            partition_changes.setdefault(partition, {})[key] = delta
+        futures = {
+            partition: partition.submit(
+                partition.apply, c, check=check, order_ids=order_ids,
+            )
+            for partition, c in partition_changes.items()
+        }
+        result = {}
+        error = None
+        applied = []
+        for partition, future in futures.items():
+            try:
+                result.update(future.result())
+            except BaseException as e:
+                error = error or e
+            else:
+                applied.append(partition)
+        if error:
+            for partition in applied:
+                partition.submit(
+                    partition.apply,
+                    {
+                        key: (-amount, -locked_amount)
+                        for key, (amount, locked_amount)
+                        in partition_changes[partition].items()
+                    },
+                    check=False,
+                ).result()
+            raise error
+        return result
@@ -1,52 +1,97 @@
-import asyncio
-import concurrent.futures.thread
 import contextlib
 import datetime
 import decimal
+import heapq
 import itertools
 import json
 import logging
+import struct
+import time
 import uuid
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Mapping, Set, Tuple
-
-from flask.app import Flask
-from pika.adapters.blocking_connection import (
-    BlockingChannel, BlockingConnection,
+from typing import (
+    Any, Dict, List, Mapping, Optional, Sequence, Set, Tuple,
 )
+
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import FlushError
+from sqlalchemy.sql.dml import Update
 from sqlalchemy.sql.expression import tuple_
 from sqlalchemy_utc.now import utcnow
-from typeguard import typechecked
-from websockets import connect
 
 from ..balance import Balance
 from ..candle import Candle, CandleUnitKey
 from ..exc import NotEnoughBalance
 from ..market import Market
+from ..metrics import Histogram, registry
 from ..order import Order, OrderSide
 from ..orm import SessionType, create_session
 from ..serializer import serialize
+from ..trace import Trace, record_trace, stamp
 from ..trade import Trade
 from ..transaction import TradeTransaction, Transaction, TransactionType
-from .mq import get_mq_channel, get_mq_connection, get_mq_queue_name
-from .util import parse_order
+from ..typecheck import typechecked
+from ..uuid7 import uuid7
+from .balance import BalanceDelta, BalanceKey, BalanceService
+from .capture import CaptureWriter, create_capture_writer
+from .codec import JSON_CONTENT_TYPE, decode_command
+from .depth import (
+    DEFAULT_DIRECTORY, HEARTBEAT_INTERVAL, DepthSegment, Level,
+)
+from .mq import Delivery, Transport, get_transport
+from .publisher import WebsocketPublisher, create_websocket_publisher
+from .util import RecentIds
 
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
+fee_user_id = uuid.UUID(int=0)
+
+
+@dataclass
+class CommandEffects:
+    """What a command changes outside of the database, which must only take
+    effect once its transaction commits."""
+
+    #: Deltas already applied to the balance service, to revert if the
+    #: transaction fails.
+    reservations: Dict[BalanceKey, BalanceDelta] = field(
+        default_factory=dict
+    )
+    #: Deltas to apply to the balance service after the commit.
+    balance_changes: Dict[BalanceKey, BalanceDelta] = field(
+        default_factory=dict
+    )
+    #: Balances to publish, by key.  The ones of the balance service are
+    #: replaced by their settled values.
+    balances: Dict[BalanceKey, Any] = field(default_factory=dict)
+    #: Orders filled, canceled or rejected, which join
+    #: :attr:`OrderBook.completed_order_ids` after the commit.
+    completed_order_ids: Set[uuid.UUID] = field(default_factory=set)
+    #: Orders the balance changes come from, reported by the balance
+    #: service if the table refuses them.
+    order_ids: Set[uuid.UUID] = field(default_factory=set)
+    #: The trace of a placed order, stamped ``committed`` and recorded
+    #: after the commit.
+    trace: Optional[Trace] = None
+    websocket_messages: List[Mapping[str, Any]] = field(default_factory=list)
+
 
 @dataclass
 class OrderBook:
-    app: Flask
+    #: The web application or an :class:`~.app.EngineApp`; only its config
+    #: is read.
+    app: Any
     session: SessionType = None
     market: Market = None
-    mq_channel: BlockingChannel = None
-    mq_connection: BlockingConnection = None
-    executor: concurrent.futures.thread.ThreadPoolExecutor = None
+    transport: Optional[Transport] = None
+    publisher: Optional[WebsocketPublisher] = None
+    balance_service: Optional[BalanceService] = None
+    depth_segment: Optional[DepthSegment] = None
+    #: Records the consumed commands when ``capture_directory`` is set.
+    capture: Optional[CaptureWriter] = None
     # FIXME: Use builtin priority queue
     sell_orders: List[Order] = field(default_factory=list)
     buy_orders: List[Order] = field(default_factory=list)
@@ -57,7 +102,19 @@ class OrderBook:
         default_factory=dict
     )
     order_ids: Set[uuid.UUID] = field(default_factory=set)
+    #: Orders which were filled, canceled or rejected lately, to drop
+    #: redelivered commands for them before touching the database.
+    completed_order_ids: RecentIds = field(default_factory=RecentIds)
+    user_orders: Dict[uuid.UUID, Dict[uuid.UUID, Order]] = field(
+        default_factory=dict
+    )
     candles: Dict[CandleUnitKey, Candle] = None
+    #: Last published best bid and ask.
+    bbo: Optional[Tuple[Optional[Level], Optional[Level]]] = None
+    #: Latencies of the stages of processing commands, by stage name.
+    stage_histograms: Dict[str, Histogram] = field(default_factory=dict)
+    #: Effects of the command being processed.
+    effects: CommandEffects = field(default_factory=CommandEffects)
 
     @property
     def pair(self):
@@ -68,8 +125,10 @@ class OrderBook:
         orders = side.choice(buy=self.buy_orders, sell=self.sell_orders)
         for i in range(len(orders) - 1, -1, -1):
             if orders[i].id == order_id:
+                self.unindex_user_order(orders[i])
                 del orders[i]
                 self.order_ids.remove(order_id)
+                self.effects.completed_order_ids.add(order_id)
                 break
 
     @typechecked
@@ -86,6 +145,39 @@ class OrderBook:
         orders.insert(i, order)
         self.add_to_merged_orders(order.side, order.price, order.volume)
         self.order_ids.add(order.id)
+        self.user_orders.setdefault(order.user_id, {})[order.id] = order
+
+    @typechecked
+    def unindex_user_order(self, order: Order):
+        orders = self.user_orders.get(order.user_id)
+        if orders is None:
+            return
+        orders.pop(order.id, None)
+        if not orders:
+            del self.user_orders[order.user_id]
+
+    @typechecked
+    def get_open_orders(self, user_id: uuid.UUID) -> List[Mapping[str, Any]]:
+        orders = sorted(
+            self.user_orders.get(user_id, {}).values(),
+            key=lambda o: o.created_at, reverse=True,
+        )
+        # Built by hand so that no unloaded attribute is refreshed from
+        # the database.
+        return serialize([
+            {
+                'id': order.id,
+                'created_at': order.created_at,
+                'side': order.side,
+                'user_id': order.user_id,
+                'volume': order.volume,
+                'remaining_volume': order.remaining_volume,
+                'price': order.price,
+                'base_currency': order.base_currency,
+                'quote_currency': order.quote_currency,
+            }
+            for order in orders
+        ])
 
     @typechecked
     def add_to_merged_orders(
@@ -111,6 +203,71 @@ class OrderBook:
             'buy': [[str(p), str(buy_orders[p])] for p in buy_prices],
         }
 
+    @typechecked
+    def get_depth(self, limit: int) -> Tuple[List[Level], List[Level]]:
+        """Return the best ``limit`` levels of each side, best first."""
+        sell_orders = self.merged_sell_orders
+        buy_orders = self.merged_buy_orders
+        return (
+            [(p, sell_orders[p]) for p in heapq.nsmallest(limit, sell_orders)],
+            [(p, buy_orders[p]) for p in heapq.nlargest(limit, buy_orders)],
+        )
+
+    def get_bbo_message(self) -> Optional[Mapping[str, Any]]:
+        """Return a ``bbo`` message if the top of the book has changed
+        since the last one."""
+        sell, buy = self.get_depth(1)
+        bbo = (buy[0] if buy else None, sell[0] if sell else None)
+        if bbo == self.bbo:
+            return None
+        self.bbo = bbo
+        bid, ask = bbo
+        return {
+            'type': 'bbo',
+            'data': serialize({
+                'pair': self.pair,
+                'bid': list(bid) if bid else None,
+                'ask': list(ask) if ask else None,
+            }),
+        }
+
+    def observe(self, stage: str, started: float) -> float:
+        """Record the time since ``started`` as a latency of ``stage``.
+
+        :return: the current time, to start timing the next stage from
+
+        """
+        now = time.perf_counter()
+        histogram = self.stage_histograms.get(stage)
+        if histogram is None:
+            histogram = self.stage_histograms[stage] = registry.histogram(
+                'iu_order_book_stage_seconds', pair=self.pair, stage=stage,
+            )
+        histogram.record(now - started)
+        return now
+
+    def refresh_depth(self):
+        """Refresh the depth segment while the book is unchanged, so that
+        readers can tell an idle order book from a stopped one."""
+        if self.depth_segment and (
+            time.time() - self.depth_segment.updated_at >= HEARTBEAT_INTERVAL
+        ):
+            self.depth_segment.touch()
+
+    def publish_depth(self):
+        if not self.depth_segment:
+            return
+        sell, buy = self.get_depth(self.depth_segment.capacity)
+        self.depth_segment.write(sell, buy, self.market.current_price)
+
+    @property
+    def config(self) -> Mapping[str, Any]:
+        return self.app.config['APP_CONFIG'].get('order_book', {})
+
+    @property
+    def compact_ledger(self) -> bool:
+        return self.config.get('compact_ledger', False)
+
     @property
     def base_currency(self):
         return self.market.base_currency
@@ -119,14 +276,12 @@ class OrderBook:
     def quote_currency(self):
         return self.market.quote_currency
 
-    @property
-    def mq_queue_name(self):
-        return get_mq_queue_name(self.pair)
-
     def fetch_orders(self):
         self.sell_orders = []
         self.buy_orders = []
         self.order_ids = set()
+        self.user_orders = {}
+        self.bbo = None
         self.merged_sell_orders = {}
         self.merged_buy_orders = {}
         orders = self.session.query(Order).filter(
@@ -144,10 +299,30 @@ class OrderBook:
                 order.side, order.price, order.remaining_volume,
             )
             self.order_ids.add(order.id)
+            self.user_orders.setdefault(order.user_id, {})[order.id] = order
         self.sell_orders.sort(key=lambda key: key.created_at)
         self.sell_orders.sort(key=lambda key: key.price, reverse=True)
         self.buy_orders.sort(key=lambda key: key.created_at)
         self.buy_orders.sort(key=lambda key: key.price)
+        self.publish_depth()
+
+    def fetch_completed_order_ids(self):
+        """Add the orders placed within the window of
+        :attr:`completed_order_ids` which are complete already, so that
+        their commands redelivered after a restart are dropped too.
+
+        The window itself is kept across reconnects.
+
+        """
+        window = datetime.timedelta(seconds=self.completed_order_ids.window)
+        since = datetime.datetime.now(datetime.timezone.utc) - window
+        self.completed_order_ids.update(
+            order_id for order_id, in self.session.query(Order.id).filter(
+                Order.pair == self.pair,
+                Order.created_at >= since,
+                ~Order.active,
+            )
+        )
 
     def fetch_candles(self):
         Candle.update_lack_candles(session=self.session, pair=self.pair)
@@ -161,6 +336,8 @@ class OrderBook:
 
     @contextlib.contextmanager
     def context(self, pair: str):
+        # Order books of a process share the publisher passed to them.
+        owns_publisher = self.publisher is None
         try:
             self.session = create_session(self.app)
             self.session.expire_on_commit = False
@@ -174,105 +351,244 @@ class OrderBook:
             ).first()
             if not self.market:
                 raise ValueError(f'OrderBook {pair} has been locked')
-            print(f'Market: {self.pair}')
-            print(f'Market: {self.pair}; Fetching orders…')
+            if self.config.get('depth_segment'):
+                self.depth_segment = DepthSegment.create(
+                    self.pair,
+                    directory=self.config.get(
+                        'depth_directory', DEFAULT_DIRECTORY,
+                    ),
+                )
+            logger.info(f'Market: {self.pair}; Fetching orders…')
             self.fetch_orders()
-            print(f'Market: {self.pair}; Fetching candles…')
+            self.fetch_completed_order_ids()
+            logger.info(f'Market: {self.pair}; Fetching candles…')
             self.fetch_candles()
-            print(f'Market: {self.pair}; Ready')
-            self.mq_connection = get_mq_connection(self.app)
-            self.mq_channel = get_mq_channel(
-                self.mq_connection, self.mq_queue_name,
-            )
-            self.executor = concurrent.futures.thread.ThreadPoolExecutor(1)
+            if self.config.get('capture_directory'):
+                self.capture = create_capture_writer(
+                    self.config['capture_directory'], self.pair,
+                )
+                logger.info(
+                    f'Market: {self.pair}; Capturing to {self.capture.path}'
+                )
+            logger.info(f'Market: {self.pair}; Ready')
+            self.transport = self.create_transport()
+            if owns_publisher:
+                self.publisher = create_websocket_publisher(self.app)
+                self.publisher.start()
             yield
         finally:
             if self.session:
                 self.session.close()
                 self.session = None
             self.market = None
-            if self.executor:
-                self.executor.shutdown(wait=False)
-                self.executor = None
-            if self.mq_channel:
-                self.mq_channel.close()
-                self.mq_channel = None
-            if self.mq_connection:
-                self.mq_connection.close()
-                self.mq_connection = None
+            if self.depth_segment:
+                self.depth_segment.close()
+                self.depth_segment = None
+            if self.capture:
+                self.capture.close()
+                self.capture = None
+            if owns_publisher and self.publisher:
+                self.publisher.close()
+                self.publisher = None
+            if self.transport:
+                self.transport.close()
+                self.transport = None
+
+    def create_transport(self) -> Transport:
+        return get_transport(self.app)
 
     def run(self):
-        import time
-        t = time.time()
-        i = 0
-        times = []
-        p = 0
-        import cProfile
-        profile = cProfile.Profile()
-        while True:
-            consumer = self.mq_channel.consume(
-                self.mq_queue_name, inactivity_timeout=1
-            )
-            for method, properties, body in consumer:
-                if not body:
-                    break
-                if p == 0:
-                    profile.enable()
-                _t = time.time()
-                self.session.begin_nested()
-                payload = json.loads(body)
-                type_ = payload['type']
-                if type_ == 'cancel':
-                    order_ids = [uuid.UUID(id_) for id_ in payload['order_ids']]
-                    self.process_cancel_order(order_ids=order_ids)
-                else:
-                    order = parse_order(payload['order'])
-                    self.process_place_order(order=order)
+        reported_at = time.perf_counter()
+        processed = 0
+        consumer = self.transport.consume(self.pair, inactivity_timeout=1)
+        for delivery in consumer:
+            self.refresh_depth()
+            if delivery is None:
+                continue
+            started = time.perf_counter()
+            # A redelivered command has been captured already when it was
+            # first delivered.
+            if self.capture and not delivery.redelivered:
+                self.capture.write(
+                    delivery.published_at or time.time(),
+                    delivery.body, delivery.content_type,
+                )
+            self.effects = CommandEffects()
+            self.session.begin_nested()
+            try:
+                type_ = self.process(delivery, started)
+                committing = time.perf_counter()
+                if self.session.transaction.nested:
+                    # Release the savepoint, unless the command did.
+                    self.session.commit()
+                # The only commit of the command, after which its effects
+                # are applied.
                 self.session.commit()
-                self.mq_channel.basic_ack(delivery_tag=method.delivery_tag)
-                i += 1
-                times.append(time.time() - _t)
-                if time.time() - t >= 1:
-                    speed = i * (time.time() - t)
-                    high_t = max(times)
-                    low_t = min(times)
-                    avg_t = sum(times) / len(times)
-                    actual_speed = 1 / avg_t
-                    times = []
-                    print(
-                        f'Order processing speed: '
-                        f'{speed:.2f}/s ({actual_speed:.2f}/s), '
-                        f'highest {high_t:.4f}, '
-                        f'lowest {low_t:.4f}, '
-                        f'average {avg_t:.4f}'
-                    )
-                    t = time.time()
-                    i = 0
-                p += 1
-                if p % 100 == 0:
-                    profile.create_stats()
-                    # profile.print_stats('cumtime')
-            else:
-                break
+            except BaseException:
+                self.discard_effects()
+                raise
+            self.observe('commit', committing)
+            if self.effects.trace is not None:
+                stamp(self.effects.trace, 'committed')
+                record_trace(self.effects.trace)
+            self.apply_effects()
+            acking = time.perf_counter()
+            self.transport.ack(delivery)
+            finished = self.observe('ack', acking)
+            self.observe('command', started)
+            registry.counter(
+                'iu_order_book_commands_total', pair=self.pair, type=type_,
+            ).increment()
+            processed += 1
+            if finished - reported_at >= 1:
+                logger.info(
+                    f'Market: {self.pair}; '
+                    f'{processed / (finished - reported_at):.2f} commands/s'
+                )
+                reported_at = finished
+                processed = 0
+
+    def process(self, delivery: Delivery, started: float) -> str:
+        """Process the command of ``delivery`` without committing it.
+
+        :return: the type of the command
+
+        """
+        try:
+            command = decode_command(delivery.body, delivery.content_type)
+        except (
+            LookupError, TypeError, ValueError, decimal.InvalidOperation,
+            struct.error,
+        ):
+            # It would fail the same way however many times it is
+            # redelivered, and hold up every command behind it; drop it.
+            # A synchronous sender times out, as its type is unknown.
+            logger.exception(
+                f'Market: {self.pair}; dropped an undecodable command'
+            )
+            return 'undecodable'
+        self.observe('decode', started)
+        type_ = command['type']
+        if type_ == 'cancel':
+            self.process_cancel_order(order_ids=command['order_ids'])
+        elif type_ == 'cancelAll':
+            self.process_cancel_all_orders(user_id=command['user_id'])
+        elif type_ == 'openOrders':
+            self.reply(delivery, self.get_open_orders(command['user_id']))
+        else:
+            trace = command.get('trace')
+            stamp(trace, 'dequeued')
+            outcome = self.process_place_order(
+                order=command['order'], trace=trace,
+            )
+            self.effects.trace = trace
+            if delivery.reply_to:
+                self.reply(delivery, serialize(outcome))
+        return type_
+
+    def apply_effects(self):
+        """Apply what the command just committed changes outside of the
+        database: settle its balances and publish its messages."""
+        effects, self.effects = self.effects, CommandEffects()
+        self.completed_order_ids.update(effects.completed_order_ids)
+        balances = effects.balances
+        if effects.balance_changes:
+            started = time.perf_counter()
+            balances.update(self.balance_service.apply(
+                effects.balance_changes, check=False,
+                order_ids=effects.order_ids,
+            ))
+            self.observe('balance_settle', started)
+        messages = effects.websocket_messages
+        if balances:
+            balance_map = {}
+            for (user_id, currency), balance in balances.items():
+                balance_map.setdefault(user_id, {})[currency] = balance
+            messages.append({
+                'type': 'balance',
+                'data': serialize(balance_map),
+            })
+        if messages:
+            started = time.perf_counter()
+            self.send_websocket_messages(messages)
+            self.observe('publish', started)
+
+    def discard_effects(self):
+        """Revert what the command being processed has changed outside of
+        the database, as its transaction is rolled back."""
+        effects, self.effects = self.effects, CommandEffects()
+        if effects.reservations:
+            self.balance_service.apply(
+                {
+                    key: (-amount, -locked_amount)
+                    for key, (amount, locked_amount)
+                    in effects.reservations.items()
+                },
+                check=False,
+                order_ids=effects.order_ids,
+            )
 
     @typechecked
     def process_place_order(
         self,
         order: Order,
-    ):
+        trace: Optional[Trace] = None,
+    ) -> Dict[str, Any]:
+        """Place ``order`` and match it.
+
+        :param trace: the :mod:`~iu.trace` of the order, which is stamped
+                      and sent along with its ``orderStatus`` message
+
+        :return: the outcome to reply to a synchronous placement; see
+                 :func:`create_place_order_reply`
+
+        """
+        if order.id in self.order_ids or order.id in self.completed_order_ids:
+            return create_place_order_reply(order, 'duplicate')
         if order.volume * order.price < self.market.minimum_order_amount:
-            return
-        if order.id in self.order_ids:
-            return
+            self.effects.completed_order_ids.add(order.id)
+            return create_place_order_reply(
+                order, 'rejected', reason='minimumOrderAmount',
+            )
+        if self.balance_service:
+            started = time.perf_counter()
+            reservation = {
+                (order.user_id, order.locking_currency):
+                    (decimal.Decimal(0), order.locked_amount),
+            }
+            try:
+                reserved = self.balance_service.apply(
+                    reservation, order_ids=(order.id,),
+                )
+            except NotEnoughBalance:
+                self.effects.completed_order_ids.add(order.id)
+                return create_place_order_reply(
+                    order, 'rejected', reason='notEnoughBalance',
+                )
+            finally:
+                self.observe('balance_lock', started)
+            merge_balance_changes(self.effects.reservations, reservation)
+            self.effects.order_ids.add(order.id)
+            self.effects.balances.update(reserved)
         self.session.add(order)
         try:
             result = self.match_order(order)
+            stamp(trace, 'matched')
             trades = result['trades']
-            balances = result['balances']
+            started = time.perf_counter()
             self.session.commit()
-            balance_map = {}
-            for (user_id, currency), balance in balances.items():
-                balance_map.setdefault(user_id, {})[currency] = balance
+            self.observe('flush', started)
+            if self.balance_service:
+                # Settled once the command commits; see apply_effects().
+                merge_balance_changes(
+                    self.effects.balance_changes, result['balance_changes'],
+                )
+                self.effects.order_ids.add(order.id)
+                for trade in trades:
+                    self.effects.order_ids.add(trade['buy_order_id'])
+                    self.effects.order_ids.add(trade['sell_order_id'])
+            else:
+                self.effects.balances.update(result['balances'])
             websocket_messages = [
                 {
                     'type': 'order',
@@ -282,10 +598,14 @@ class OrderBook:
                     },
                 },
                 {
-                    'type': 'balance',
-                    'data': serialize(balance_map),
+                    'type': 'orderStatus',
+                    'data': serialize(
+                        group_order_events(result['order_events'])
+                    ),
                 },
             ]
+            if trace is not None:
+                websocket_messages[-1]['trace'] = trace
             if trades:
                 websocket_messages.append({
                     'type': 'trade',
@@ -310,24 +630,47 @@ class OrderBook:
                             'currentPrice': self.market.current_price,
                         }]),
                     })
-                    self.session.commit()
+                    self.session.flush()
                 self.process_candles(trades)
-            self.send_websocket_messages(websocket_messages)
-        except NotEnoughBalance as e:
-            print('NotEnoughBalance')
+            self.publish_depth()
+            bbo_message = self.get_bbo_message()
+            if bbo_message:
+                websocket_messages.insert(0, bbo_message)
+            self.effects.websocket_messages += websocket_messages
+        except NotEnoughBalance:
             self.session.rollback()
+            self.discard_effects()
+            self.effects.completed_order_ids.add(order.id)
             self.fetch_orders()
-            return
-        except (FlushError, IntegrityError) as e:
-            print(type(e), str(e))
+            self.fetch_candles()
+            return create_place_order_reply(
+                order, 'rejected', reason='notEnoughBalance',
+            )
+        except (FlushError, IntegrityError):
+            logger.exception(
+                f'Market: {self.pair}; rejected {order.id} on a conflict'
+            )
             self.session.rollback()
+            self.discard_effects()
+            self.effects.completed_order_ids.add(order.id)
             self.fetch_orders()
-            return
-        except Exception as e:
-            print(type(e), str(e))
+            self.fetch_candles()
+            return create_place_order_reply(
+                order, 'rejected', reason='conflict',
+            )
+        except Exception:
+            logger.exception(
+                f'Market: {self.pair}; rejected {order.id} on an error'
+            )
             self.session.rollback()
+            self.discard_effects()
+            self.effects.completed_order_ids.add(order.id)
             self.fetch_orders()
-            return
+            self.fetch_candles()
+            return create_place_order_reply(order, 'rejected', reason='error')
+        return create_place_order_reply(
+            order, 'accepted', order_events=result['order_events'],
+        )
 
     @typechecked
     def process_candles(self, trades: List[Mapping[str, Any]]):
@@ -337,7 +680,7 @@ class OrderBook:
                 cumulative_count = getattr(candle, '_cumulative_count', 0) + 1
                 if cumulative_count >= 100:
                     self.session.add(candle)
-                    self.session.commit()
+                    self.session.flush()
                     self.session.expunge(candle)
                     cumulative_count = 0
                 setattr(candle, '_cumulative_count', cumulative_count)
@@ -354,7 +697,7 @@ class OrderBook:
                     )
                     if candle:
                         self.session.add(candle)
-                        self.session.commit()
+                        self.session.flush()
                         self.session.expunge(candle)
                     candle = Candle(
                         pair=self.pair, unit_key=unit_key,
@@ -369,47 +712,54 @@ class OrderBook:
         order_ids: List[uuid.UUID],
     ) -> None:
         result = self.session.execute(
-            Order.__table__.update().where(
-                Order.active &
-                Order.id.in_(order_ids),
-            ).values({
-                'canceled_at': utcnow(),
-            }).returning(
-                Order.user_id,
-                Order.locking_currency,
-                Order.remaining_locked_amount,
-            )
+            create_cancel_statement(order_ids)
         ).fetchall()
-        balance_keys = {
-            (user_id, locking_currency)
-            for user_id, locking_currency, _ in result
-        }
-        balances = {
-            (t.user_id, t.currency): t
-            for t in self.session.query(Balance).filter(
-                tuple_(Balance.user_id, Balance.currency).in_(balance_keys)
-            ).with_for_update()
-        }
-        for user_id, locking_currency, locked_amount in result:
-            balance = balances.get((user_id, locking_currency))
-            balance.locked_amount -= locked_amount
-            setattr(balance, '_no_orm_events', True)
-        self.session.commit()
+        canceled_order_ids = {order_id for *_, order_id in result}
+        # The book may hold thousands of orders, so don't scan the list.
+        order_ids = set(order_ids)
+        self.order_ids -= order_ids
+        self.effects.completed_order_ids.update(canceled_order_ids)
+        if self.balance_service:
+            zero = decimal.Decimal(0)
+            self.effects.order_ids.update(canceled_order_ids)
+            for user_id, locking_currency, locked_amount, _ in result:
+                merge_balance_changes(self.effects.balance_changes, {
+                    (user_id, locking_currency): (zero, -locked_amount),
+                })
+        else:
+            balance_keys = {
+                (user_id, locking_currency)
+                for user_id, locking_currency, *_ in result
+            }
+            balances = {
+                (t.user_id, t.currency): t
+                for t in self.session.query(Balance).filter(
+                    tuple_(Balance.user_id, Balance.currency).in_(balance_keys)
+                ).with_for_update()
+            }
+            for user_id, locking_currency, locked_amount, _ in result:
+                balance = balances.get((user_id, locking_currency))
+                balance.locked_amount -= locked_amount
+                setattr(balance, '_no_orm_events', True)
+            self.session.commit()
+            self.effects.balances.update(balances)
+        order_events = []
         for order in itertools.chain(self.sell_orders, self.buy_orders):
             if order.id in order_ids:
                 self.add_to_merged_orders(
                     order.side, order.price, -order.remaining_volume,
                 )
+                self.unindex_user_order(order)
+            if order.id in canceled_order_ids:
+                order_events.append(create_order_event(order, 'canceled'))
         self.buy_orders = [
             o for o in self.buy_orders if o.id not in order_ids
         ]
         self.sell_orders = [
             o for o in self.sell_orders if o.id not in order_ids
         ]
-        balance_map = {}
-        for (user_id, currency), balance in balances.items():
-            balance_map.setdefault(user_id, {})[currency] = balance
-        self.send_websocket_messages([
+        self.publish_depth()
+        websocket_messages = [
             {
                 'type': 'order',
                 'data': {
@@ -418,21 +768,37 @@ class OrderBook:
                 },
             },
             {
-                'type': 'balance',
-                'data': serialize(balance_map),
+                'type': 'orderStatus',
+                'data': serialize(group_order_events(order_events)),
             },
-        ])
-        print(f'Canceled {list(map(str, order_ids))}')
+        ]
+        bbo_message = self.get_bbo_message()
+        if bbo_message:
+            websocket_messages.insert(0, bbo_message)
+        self.effects.websocket_messages += websocket_messages
+        logger.info(
+            f'Market: {self.pair}; Canceled {", ".join(map(str, order_ids))}'
+        )
+
+    @typechecked
+    def process_cancel_all_orders(self, user_id: uuid.UUID) -> None:
+        order_ids = list(self.user_orders.get(user_id, {}))
+        if order_ids:
+            self.process_cancel_order(order_ids=order_ids)
 
     def match_order(self, new_order: Order):
+        started = time.perf_counter()
         orders = list(
             new_order.side.choice(buy=self.sell_orders, sell=self.buy_orders)
         )
+        now = datetime.datetime.now(datetime.timezone.utc)
+        new_order.created_at = now
         self.insert(new_order)
+        order_events = [create_order_event(new_order, 'accepted')]
         trades = []
         transactions = []
         trade_transactions = []
-        now = datetime.datetime.now(datetime.timezone.utc)
+        compact_ledger = self.compact_ledger
         for order in reversed(orders):
             if not (~new_order.side).compare_op(order.price, new_order.price):
                 break
@@ -447,7 +813,7 @@ class OrderBook:
             else:
                 buy_order, sell_order = order, new_order
             trade = {
-                'id': uuid.uuid4(),
+                'id': uuid7(),
                 'created_at': now,
                 'buy_order': buy_order,
                 'sell_order': sell_order,
@@ -459,16 +825,27 @@ class OrderBook:
                 'index': len(trades),
             }
             trades.append(trade)
-            new_transactions, new_trade_transactions = create_transactions(
-                trade,
-                maker_fee=self.market.maker_fee,
-                taker_fee=self.market.taker_fee,
-                now=now,
-            )
-            transactions += new_transactions
-            trade_transactions += new_trade_transactions
+            if not compact_ledger:
+                new_transactions, new_trade_transactions = (
+                    create_transactions(
+                        trade,
+                        maker_fee=self.market.maker_fee,
+                        taker_fee=self.market.taker_fee,
+                        now=now,
+                    )
+                )
+                transactions += new_transactions
+                trade_transactions += new_trade_transactions
             new_order.remaining_volume -= trade_volume
             order.remaining_volume -= trade_volume
+            for filled_order in (order, new_order):
+                order_events.append(create_order_event(
+                    filled_order,
+                    'filled' if filled_order.remaining_volume == 0
+                    else 'partiallyFilled',
+                    fill_volume=trade_volume,
+                    fill_price=order.price,
+                ))
             self.add_to_merged_orders(
                 new_order.side, new_order.price, -trade_volume
             )
@@ -482,31 +859,24 @@ class OrderBook:
                 new_order.mark_as_filled()
                 self.remove(new_order.side, new_order.id)
                 break
-        balance_keys = {(t['user_id'], t['currency']) for t in transactions}
-        balance_keys.add((new_order.user_id, new_order.locking_currency))
-        balances = Balance.get_or_create_bulk(
-            self.session, balance_keys, lock=True,
+        if compact_ledger:
+            transactions = create_ledger_transactions(
+                trades,
+                maker_fee=self.market.maker_fee,
+                taker_fee=self.market.taker_fee,
+                now=now,
+            )
+        balance_changes = self.get_balance_changes(
+            new_order, trades, transactions,
         )
-        balance = balances[(new_order.user_id, new_order.locking_currency)]
-        balance.locked_amount += new_order.locked_amount
-        for balance in balances.values():
-            setattr(balance, '_no_orm_events', True)
         for trade in trades:
-            buy_order = trade.pop('buy_order')
-            sell_order = trade.pop('sell_order')
-            trade['buy_order_id'] = buy_order.id
-            trade['sell_order_id'] = sell_order.id
-            buyer_balance = balances[
-                (buy_order.user_id, new_order.quote_currency)
-            ]
-            buyer_balance.locked_amount -= trade['volume'] * buy_order.price
-            seller_balance = balances[
-                (sell_order.user_id, new_order.base_currency)]
-            seller_balance.locked_amount -= trade['volume']
-        for transaction in transactions:
-            balance = balances[
-                (transaction['user_id'], transaction['currency'])]
-            balance.amount += transaction['amount']
+            trade['buy_order_id'] = trade.pop('buy_order').id
+            trade['sell_order_id'] = trade.pop('sell_order').id
+        started = self.observe('match', started)
+        balances = None
+        if not self.balance_service:
+            balances = self.lock_balances(balance_changes)
+            started = self.observe('balance_lock', started)
         if trades:
             self.session.flush()
             inserts = [
@@ -515,29 +885,109 @@ class OrderBook:
                 (TradeTransaction, trade_transactions),
             ]
             for table, values in inserts:
+                if not values:
+                    continue
                 self.session.execute(table.__table__.insert().values(values))
-        return {'trades': trades, 'balances': balances}
+            self.observe('insert', started)
+        return {
+            'trades': trades,
+            'balances': balances,
+            'balance_changes': balance_changes,
+            'order_events': order_events,
+        }
+
+    def get_balance_changes(
+        self,
+        new_order: Order,
+        trades: List[Mapping[str, Any]],
+        transactions: List[Mapping[str, Any]],
+    ) -> Dict[BalanceKey, BalanceDelta]:
+        zero = decimal.Decimal(0)
+        deltas = []
+        if not self.balance_service:
+            # The balance service reserves it before matching instead.
+            deltas.append((
+                new_order.user_id, new_order.locking_currency,
+                zero, new_order.locked_amount,
+            ))
+        for trade in trades:
+            buy_order = trade['buy_order']
+            sell_order = trade['sell_order']
+            deltas.append((
+                buy_order.user_id, trade['quote_currency'],
+                zero, -trade['volume'] * buy_order.price,
+            ))
+            deltas.append((
+                sell_order.user_id, trade['base_currency'],
+                zero, -trade['volume'],
+            ))
+        for transaction in transactions:
+            deltas.append((
+                transaction['user_id'], transaction['currency'],
+                transaction['amount'], zero,
+            ))
+        changes = {}
+        for user_id, currency, amount, locked_amount in deltas:
+            previous_amount, previous_locked_amount = changes.get(
+                (user_id, currency), (zero, zero),
+            )
+            changes[user_id, currency] = (
+                previous_amount + amount,
+                previous_locked_amount + locked_amount,
+            )
+        return changes
 
-    async def async_send_websocket_messages(self, messages):
-        websocket_url = self.app.config['APP_CONFIG']['websocket']['url']
-        async with connect(websocket_url) as websocket:
-            await websocket.send(json.dumps(messages))
+    def lock_balances(
+        self, changes: Mapping[BalanceKey, BalanceDelta],
+    ) -> Dict[BalanceKey, Balance]:
+        balances = Balance.get_or_create_bulk(
+            self.session, set(changes), lock=True,
+        )
+        for key, (amount, locked_amount) in changes.items():
+            balance = balances[key]
+            setattr(balance, '_no_orm_events', True)
+            if amount > 0:
+                balance.amount += amount
+                balance.locked_amount += locked_amount
+            else:
+                balance.locked_amount += locked_amount
+                balance.amount += amount
+        return balances
 
-    def _send_websocket_messages(self, messages):
-        asyncio.run(self.async_send_websocket_messages(messages))
+    def reply(self, delivery: Delivery, payload: Any):
+        self.transport.reply(
+            delivery,
+            json.dumps(payload).encode(),
+            content_type=JSON_CONTENT_TYPE,
+        )
 
     def send_websocket_messages(self, messages):
-        self.executor.submit(self._send_websocket_messages, messages)
+        self.publisher.publish(messages)
 
 
 @typechecked
-def create_transactions(
+def merge_balance_changes(
+    changes: Dict[BalanceKey, BalanceDelta],
+    more: Mapping[BalanceKey, BalanceDelta],
+) -> None:
+    """Add the deltas of ``more`` to ``changes``."""
+    zero = decimal.Decimal(0)
+    for key, (amount, locked_amount) in more.items():
+        previous_amount, previous_locked_amount = changes.get(
+            key, (zero, zero),
+        )
+        changes[key] = (
+            previous_amount + amount, previous_locked_amount + locked_amount,
+        )
+
+
+@typechecked
+def get_trade_legs(
     trade: Mapping[str, Any],
     *,
     maker_fee: decimal.Decimal,
     taker_fee: decimal.Decimal,
-    now: datetime.datetime,
-) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+) -> List[Dict[str, Any]]:
     fee = {
         'sell': trade['side'].choice(sell=taker_fee, buy=maker_fee),
         'buy': trade['side'].choice(buy=taker_fee, sell=maker_fee),
@@ -549,7 +999,7 @@ def create_transactions(
             'amount': trade['volume'] * trade['price'] * (1 - fee['sell']),
         },
         {
-            'user_id': uuid.UUID(int=0),
+            'user_id': fee_user_id,
             'currency': trade['quote_currency'],
             'amount': trade['volume'] * trade['price'] * fee['sell'],
         },
@@ -569,13 +1019,27 @@ def create_transactions(
             'amount': trade['volume'] * (1 - fee['buy']),
         },
         {
-            'user_id': uuid.UUID(int=0),
+            'user_id': fee_user_id,
             'currency': trade['base_currency'],
             'amount': trade['volume'] * fee['buy'],
         },
     ]
+    return transactions
+
+
+@typechecked
+def create_transactions(
+    trade: Mapping[str, Any],
+    *,
+    maker_fee: decimal.Decimal,
+    taker_fee: decimal.Decimal,
+    now: datetime.datetime,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    transactions = get_trade_legs(
+        trade, maker_fee=maker_fee, taker_fee=taker_fee,
+    )
     for transaction in transactions:
-        transaction['id'] = uuid.uuid4()
+        transaction['id'] = uuid7()
         transaction['created_at'] = now
         transaction['type'] = TransactionType.trade
     trade_transactions = [
@@ -583,3 +1047,139 @@ def create_transactions(
         for transaction in transactions
     ]
     return transactions, trade_transactions
+
+
+@typechecked
+def create_ledger_transactions(
+    trades: List[Mapping[str, Any]],
+    *,
+    maker_fee: decimal.Decimal,
+    taker_fee: decimal.Decimal,
+    now: datetime.datetime,
+) -> List[Dict[str, Any]]:
+    """Compact counterpart of :func:`create_transactions` for a whole batch
+    of trades: one :class:`LedgerTransaction` row per trade, user and
+    currency, plus one fee row per currency for the whole batch.
+
+    """
+    amounts = {}
+    fee_amounts = {}
+    for trade in trades:
+        legs = get_trade_legs(trade, maker_fee=maker_fee, taker_fee=taker_fee)
+        for leg in legs:
+            if leg['user_id'] == fee_user_id:
+                currency = leg['currency']
+                fee_amounts[currency] = (
+                    fee_amounts.get(currency, 0) + leg['amount']
+                )
+            else:
+                key = (trade['id'], leg['user_id'], leg['currency'])
+                amounts[key] = amounts.get(key, 0) + leg['amount']
+    rows = [
+        (trade_id, user_id, currency, amount)
+        for (trade_id, user_id, currency), amount in amounts.items()
+    ]
+    rows.extend(
+        (None, fee_user_id, currency, amount)
+        for currency, amount in fee_amounts.items()
+    )
+    return [
+        {
+            'id': uuid7(),
+            'created_at': now,
+            'type': TransactionType.ledger,
+            'user_id': user_id,
+            'currency': currency,
+            'amount': amount,
+            'trade_id': trade_id,
+        }
+        for trade_id, user_id, currency, amount in rows
+        # Self-trades without fees net to zero, which the ledger rejects.
+        if amount
+    ]
+
+
+@typechecked
+def create_cancel_statement(order_ids: List[uuid.UUID]) -> Update:
+    """Cancel the active orders of ``order_ids``, returning the owner,
+    locking currency, remaining locked amount and id of each.
+
+    """
+    return Order.__table__.update().where(
+        Order.active &
+        Order.id.in_(order_ids),
+    ).values({
+        'canceled_at': utcnow(),
+    }).returning(
+        Order.user_id,
+        Order.locking_currency,
+        Order.remaining_locked_amount,
+        Order.id,
+    )
+
+
+@typechecked
+def create_order_event(
+    order: Order,
+    status: str,
+    *,
+    fill_volume: Optional[decimal.Decimal] = None,
+    fill_price: Optional[decimal.Decimal] = None,
+) -> Dict[str, Any]:
+    """Snapshot an order for the ``orderStatus`` message of its owner.
+
+    :param status: one of ``'accepted'``, ``'partiallyFilled'``,
+                   ``'filled'`` and ``'canceled'``
+
+    """
+    event = {
+        'userId': order.user_id,
+        'id': order.id,
+        'pair': order.pair,
+        'side': order.side,
+        'price': order.price,
+        'volume': order.volume,
+        'remainingVolume': order.remaining_volume,
+        'status': status,
+    }
+    if fill_volume is not None:
+        event['fillVolume'] = fill_volume
+        event['fillPrice'] = fill_price
+    return event
+
+
+@typechecked
+def create_place_order_reply(
+    order: Order,
+    status: str,
+    *,
+    reason: Optional[str] = None,
+    order_events: Sequence[Mapping[str, Any]] = (),
+) -> Dict[str, Any]:
+    """Describe the outcome of placing ``order`` to its synchronous sender.
+
+    :param status: ``'accepted'``, ``'rejected'``, or ``'duplicate'`` when
+                   the order had already been processed
+    :param reason: why the order was rejected: ``'minimumOrderAmount'``,
+                   ``'notEnoughBalance'``, ``'conflict'`` or ``'error'``
+    :param order_events: events of the matching; those of ``order`` are
+                         included as its immediate fills
+
+    """
+    reply = {'id': order.id, 'status': status}
+    if reason:
+        reply['reason'] = reason
+    reply['events'] = [
+        event for event in order_events if event['id'] == order.id
+    ]
+    return reply
+
+
+@typechecked
+def group_order_events(
+    order_events: List[Mapping[str, Any]],
+) -> Dict[str, List[Mapping[str, Any]]]:
+    grouped = {}
+    for event in order_events:
+        grouped.setdefault(str(event['userId']), []).append(event)
+    return grouped
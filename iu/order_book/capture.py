@@ -0,0 +1,173 @@
+"""Recording of the commands order books consume, and their replay.
+
+When ``order_book.capture_directory`` is configured, each order book writes
+every command it takes from its queue, with the time the gateway published
+it, to a gzipped capture file of its own.  Redelivered commands are left
+out, as they were captured on their first delivery.  :func:`replay_captures`
+publishes the commands of capture files to the queues of their pairs again,
+in the order and at the pace they arrived, or faster, e.g. into an order
+book run against a scratch database restored from the time the capture
+started::
+
+    ./run_order_book.py -c scratch.toml
+    ./replay_order_book.py -c scratch.toml --speed 10 iu-capture-*.gz
+
+A capture file starts with :data:`MAGIC` and the pair, followed by a record
+per command: its arrival time, i.e. when it was published, content type
+and body.
+
+"""
+import gzip
+import heapq
+import pathlib
+import struct
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+
+from ..typecheck import typechecked
+from .codec import JSON_CONTENT_TYPE
+from .mq import Transport
+
+
+MAGIC = b'IUCAP\x01'
+#: pair length
+HEADER = struct.Struct('<H')
+#: arrival time, content type length, body length
+RECORD = struct.Struct('<dHI')
+#: Seconds between flushes of a capture file, so a crashed order book loses
+#: at most this much of its capture.
+FLUSH_INTERVAL = 1.0
+
+
+@dataclass
+class CapturedCommand:
+    pair: str
+    #: Wall clock time the gateway published the command, or the order book
+    #: took it from its queue if the gateway did not tell.
+    arrived_at: float
+    body: bytes
+    content_type: Optional[str]
+
+    def __lt__(self, other: 'CapturedCommand') -> bool:
+        return self.arrived_at < other.arrived_at
+
+
+class CaptureWriter:
+
+    @typechecked
+    def __init__(self, path: Union[str, pathlib.Path], pair: str):
+        self.path = pathlib.Path(path)
+        self.file: BinaryIO = gzip.open(self.path, 'wb')
+        encoded_pair = pair.encode()
+        self.file.write(MAGIC + HEADER.pack(len(encoded_pair)) + encoded_pair)
+        self.flushed_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @typechecked
+    def write(
+        self, arrived_at: float, body: bytes, content_type: Optional[str],
+    ) -> None:
+        encoded_content_type = (content_type or '').encode()
+        self.file.write(b''.join([
+            RECORD.pack(arrived_at, len(encoded_content_type), len(body)),
+            encoded_content_type,
+            body,
+        ]))
+        now = time.monotonic()
+        if now - self.flushed_at >= FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed_at = now
+
+    def close(self):
+        self.file.close()
+
+
+@typechecked
+def create_capture_writer(
+    directory: Union[str, pathlib.Path], pair: str,
+) -> CaptureWriter:
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    name = pair.replace('/', '-').lower()
+    return CaptureWriter(
+        pathlib.Path(directory) / f'iu-capture-{name}-{timestamp}.gz', pair,
+    )
+
+
+@typechecked
+def read_capture(
+    path: Union[str, pathlib.Path],
+) -> Iterator[CapturedCommand]:
+    """Read the commands of a capture file.
+
+    A capture cut short, e.g. by a crash, ends at its last complete record.
+
+    :raise ValueError: when ``path`` is not a capture file
+
+    """
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        length, = HEADER.unpack(f.read(HEADER.size))
+        pair = f.read(length).decode()
+        while True:
+            try:
+                header = f.read(RECORD.size)
+            except EOFError:
+                return
+            if len(header) < RECORD.size:
+                return
+            arrived_at, content_type_length, body_length = RECORD.unpack(
+                header,
+            )
+            content_type = f.read(content_type_length).decode()
+            body = f.read(body_length)
+            if len(body) < body_length:
+                return
+            yield CapturedCommand(
+                pair=pair,
+                arrived_at=arrived_at,
+                body=body,
+                content_type=content_type or None,
+            )
+
+
+@typechecked
+def replay_captures(
+    transport: Transport,
+    paths: Iterable[Union[str, pathlib.Path]],
+    *,
+    speed: float = 1.0,
+) -> int:
+    """Publish the commands of capture files in the order they arrived.
+
+    :param speed: how many times as fast as they arrived to publish them;
+                  0 publishes them as fast as possible
+    :return: the number of published commands
+
+    """
+    commands = heapq.merge(*(read_capture(path) for path in paths))
+    started = time.monotonic()
+    first_arrived_at = None
+    count = 0
+    for command in commands:
+        if first_arrived_at is None:
+            first_arrived_at = command.arrived_at
+        if speed:
+            due = started + (command.arrived_at - first_arrived_at) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        # Commands without a content type are JSON; see decode_command().
+        transport.publish(
+            command.pair,
+            command.body,
+            content_type=command.content_type or JSON_CONTENT_TYPE,
+        )
+        count += 1
+    return count
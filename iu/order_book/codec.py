@@ -0,0 +1,210 @@
+"""Encoding of the commands sent from the web gateway to order books.
+
+Each command is a dictionary with a ``type`` key and already parsed values,
+e.g. ``{'type': 'place', 'order': Order(...)}``.  It travels either as
+JSON, the fallback every order book understands, or as a compact binary
+message whose layout is fixed per command type.  The encoding of a message
+is told by its AMQP ``content_type`` property.
+
+Binary messages start with a version and a command code, followed by the
+fields of the command: UUIDs as their 16 raw bytes, and volumes and prices
+as scaled integers by :func:`~.util.encode_decimal`.  A ``place`` command
+may end with the timestamps of its :mod:`~iu.trace`, which decoders that
+predate them ignore.
+
+"""
+import json
+import struct
+import uuid
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from ..order import Order, OrderSide
+from ..serializer import serialize
+from ..trace import HOPS
+from ..typecheck import typechecked
+from .util import decode_decimal, encode_decimal, parse_order
+
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/vnd.iu.command'
+
+VERSION = 1
+
+#: version, command
+HEADER = struct.Struct('<BB')
+#: id, user_id, flags, volume, remaining_volume, price,
+#: base_currency length, quote_currency length
+PLACE = struct.Struct('<16s16sB16s16s16sBB')
+#: count of trace hops
+TRACE = struct.Struct('<B')
+#: hop index of :data:`~iu.trace.HOPS`, timestamp
+TRACE_HOP = struct.Struct('<Bd')
+#: count
+CANCEL = struct.Struct('<I')
+#: user_id
+USER = struct.Struct('<16s')
+
+COMMAND_CODES = {
+    'place': 1,
+    'cancel': 2,
+    'cancelAll': 3,
+    'openOrders': 4,
+}
+COMMAND_TYPES = {code: type_ for type_, code in COMMAND_CODES.items()}
+
+FLAG_SELL = 1
+FLAG_USER_ID = 2
+
+
+@typechecked
+def encode_binary(command: Mapping[str, Any]) -> bytes:
+    type_ = command['type']
+    header = HEADER.pack(VERSION, COMMAND_CODES[type_])
+    if type_ == 'place':
+        order = command['order']
+        base_currency = order.base_currency.encode()
+        quote_currency = order.quote_currency.encode()
+        flags = FLAG_SELL if order.side == OrderSide.sell else 0
+        if order.user_id:
+            flags |= FLAG_USER_ID
+        trace = command.get('trace') or {}
+        return b''.join([
+            header,
+            PLACE.pack(
+                order.id.bytes,
+                order.user_id.bytes if order.user_id else bytes(16),
+                flags,
+                encode_decimal(order.volume),
+                encode_decimal(order.remaining_volume),
+                encode_decimal(order.price),
+                len(base_currency),
+                len(quote_currency),
+            ),
+            base_currency,
+            quote_currency,
+            TRACE.pack(len(trace)) if trace else b'',
+            *(
+                TRACE_HOP.pack(HOPS.index(hop), timestamp)
+                for hop, timestamp in trace.items()
+            ),
+        ])
+    elif type_ == 'cancel':
+        order_ids = command['order_ids']
+        return b''.join([
+            header,
+            CANCEL.pack(len(order_ids)),
+            *(id_.bytes for id_ in order_ids),
+        ])
+    return header + USER.pack(command['user_id'].bytes)
+
+
+@typechecked
+def decode_binary(body: bytes) -> Dict[str, Any]:
+    """Decode a binary command.
+
+    :raise ValueError: when the message was encoded by another version
+
+    """
+    version, code = HEADER.unpack_from(body)
+    if version != VERSION:
+        raise ValueError(f'unsupported command version: {version}')
+    type_ = COMMAND_TYPES[code]
+    offset = HEADER.size
+    if type_ == 'place':
+        (
+            id_, user_id, flags, volume, remaining_volume, price,
+            base_currency_length, quote_currency_length,
+        ) = PLACE.unpack_from(body, offset)
+        offset += PLACE.size
+        base_currency = body[offset:offset + base_currency_length]
+        offset += base_currency_length
+        quote_currency = body[offset:offset + quote_currency_length]
+        offset += quote_currency_length
+        order = Order(
+            id=uuid.UUID(bytes=id_),
+            user_id=(
+                uuid.UUID(bytes=user_id) if flags & FLAG_USER_ID else None
+            ),
+            side=OrderSide.sell if flags & FLAG_SELL else OrderSide.buy,
+            volume=decode_decimal(volume),
+            remaining_volume=decode_decimal(remaining_volume),
+            price=decode_decimal(price),
+            base_currency=base_currency.decode(),
+            quote_currency=quote_currency.decode(),
+        )
+        command = {'type': type_, 'order': order}
+        if offset < len(body):
+            count, = TRACE.unpack_from(body, offset)
+            offset += TRACE.size
+            trace = {}
+            for _ in range(count):
+                hop, timestamp = TRACE_HOP.unpack_from(body, offset)
+                offset += TRACE_HOP.size
+                trace[HOPS[hop]] = timestamp
+            command['trace'] = trace
+        return command
+    elif type_ == 'cancel':
+        count, = CANCEL.unpack_from(body, offset)
+        offset += CANCEL.size
+        return {
+            'type': type_,
+            'order_ids': [
+                uuid.UUID(bytes=body[i:i + 16])
+                for i in range(offset, offset + count * 16, 16)
+            ],
+        }
+    user_id, = USER.unpack_from(body, offset)
+    return {'type': type_, 'user_id': uuid.UUID(bytes=user_id)}
+
+
+@typechecked
+def encode_json(command: Mapping[str, Any]) -> bytes:
+    return json.dumps(serialize(dict(command))).encode()
+
+
+@typechecked
+def decode_json(body: bytes) -> Dict[str, Any]:
+    payload = json.loads(body)
+    type_ = payload['type']
+    if type_ == 'cancel':
+        return {
+            'type': type_,
+            'order_ids': [uuid.UUID(id_) for id_ in payload['order_ids']],
+        }
+    elif type_ in ('cancelAll', 'openOrders'):
+        return {'type': type_, 'user_id': uuid.UUID(payload['user_id'])}
+    command = {'type': type_, 'order': parse_order(payload['order'])}
+    if 'trace' in payload:
+        command['trace'] = payload['trace']
+    return command
+
+
+@typechecked
+def encode_command(
+    command: Mapping[str, Any], encoding: str = 'json',
+) -> Tuple[bytes, str]:
+    """Encode ``command`` as ``encoding``, either ``json`` or ``binary``.
+
+    :return: the message body and its content type
+
+    """
+    if encoding == 'binary':
+        return encode_binary(command), BINARY_CONTENT_TYPE
+    elif encoding == 'json':
+        return encode_json(command), JSON_CONTENT_TYPE
+    raise ValueError(f'unknown command encoding: {encoding!r}')
+
+
+@typechecked
+def decode_command(
+    body: bytes, content_type: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Decode a message body by its content type.
+
+    Messages without a content type are JSON, as every command was before
+    the binary encoding was introduced.
+
+    """
+    if content_type == BINARY_CONTENT_TYPE:
+        return decode_binary(body)
+    return decode_json(body)
@@ -0,0 +1,226 @@
+"""Shared-memory publication of each market's depth.
+
+The order book writes the top levels of both sides and the last price of
+its market to a file on a memory filesystem, and co-located processes map
+the same file to read them without querying the database.  Writes follow
+a seqlock: the sequence number is odd while a write is in progress, and a
+reader retries until it sees the same even sequence before and after
+copying the segment.
+
+Prices and volumes are stored as scaled integers by :func:`encode_decimal`.
+
+The order book refreshes ``updated_at`` at least every
+:data:`HEARTBEAT_INTERVAL` even while its market is idle, and resets it to
+zero and removes the file when it stops, so that readers can tell a stale
+segment from a quiet one.
+
+"""
+import decimal
+import mmap
+import os
+import pathlib
+import struct
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+from ..typecheck import typechecked
+from .util import decode_decimal, encode_decimal
+
+
+Level = Tuple[decimal.Decimal, decimal.Decimal]
+
+MAGIC = b'IUDB'
+VERSION = 1
+DEFAULT_DIRECTORY = '/dev/shm'
+#: Seconds between refreshes of ``updated_at`` by an idle order book.
+HEARTBEAT_INTERVAL = 1.0
+
+#: magic, version, sequence
+HEADER = struct.Struct('<4sIQ')
+#: updated_at, capacity, sell_count, buy_count, last_price
+BODY = struct.Struct('<dIII16s')
+#: price, volume
+LEVEL = struct.Struct('<16s16s')
+SEQUENCE_OFFSET = 8
+UPDATED_AT = struct.Struct('<d')
+
+
+@typechecked
+def get_segment_path(
+    pair: str, directory: Union[str, pathlib.Path] = DEFAULT_DIRECTORY,
+) -> pathlib.Path:
+    name = pair.replace('/', '-').lower()
+    return pathlib.Path(directory) / f'iu-depth-{name}'
+
+
+@dataclass
+class DepthSnapshot:
+    sequence: int
+    updated_at: float
+    last_price: Optional[decimal.Decimal]
+    #: Best first, i.e. ascending prices.
+    sell: List[Level]
+    #: Best first, i.e. descending prices.
+    buy: List[Level]
+
+
+class DepthSegment:
+
+    def __init__(self, path: pathlib.Path, capacity: int, *, writable: bool):
+        self.path = path
+        self.capacity = capacity
+        self.writable = writable
+        self.size = HEADER.size + BODY.size + 2 * capacity * LEVEL.size
+        self.sequence = 0
+        #: When the writer last wrote or refreshed the segment.
+        self.updated_at = 0.0
+        self.mmap = None
+
+    @classmethod
+    @typechecked
+    def create(
+        cls,
+        pair: str,
+        *,
+        capacity: int = 10,
+        directory: Union[str, pathlib.Path] = DEFAULT_DIRECTORY,
+    ) -> 'DepthSegment':
+        segment = cls(
+            get_segment_path(pair, directory), capacity, writable=True,
+        )
+        fd = os.open(segment.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, segment.size)
+            segment.mmap = mmap.mmap(fd, segment.size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(segment.mmap, 0, MAGIC, VERSION, 0)
+        BODY.pack_into(
+            segment.mmap, HEADER.size, 0.0, capacity, 0, 0, bytes(16),
+        )
+        return segment
+
+    @classmethod
+    @typechecked
+    def open(
+        cls,
+        pair: str,
+        *,
+        directory: Union[str, pathlib.Path] = DEFAULT_DIRECTORY,
+    ) -> 'DepthSegment':
+        """Map the segment of ``pair`` read-only.
+
+        :raise FileNotFoundError: when no order book has published it yet
+        :raise ValueError: when it was written by an incompatible version
+
+        """
+        path = get_segment_path(pair, directory)
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _ = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            mapped.close()
+            raise ValueError(f'{path} is not a depth segment of v{VERSION}')
+        _, capacity, *_ = BODY.unpack_from(mapped, HEADER.size)
+        segment = cls(path, capacity, writable=False)
+        segment.mmap = mapped
+        return segment
+
+    def close(self):
+        """Unmap the segment.  The writer invalidates and removes it first,
+        so that readers stop serving it."""
+        if self.mmap:
+            if self.writable:
+                self.invalidate()
+                try:
+                    self.path.unlink()
+                except FileNotFoundError:
+                    pass
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @typechecked
+    def write(
+        self,
+        sell: Sequence[Level],
+        buy: Sequence[Level],
+        last_price: Optional[decimal.Decimal],
+    ) -> None:
+        assert self.writable
+        sell = sell[:self.capacity]
+        buy = buy[:self.capacity]
+        self.sequence += 1
+        struct.pack_into('<Q', self.mmap, SEQUENCE_OFFSET, self.sequence)
+        updated_at = time.time()
+        BODY.pack_into(
+            self.mmap, HEADER.size,
+            updated_at, self.capacity, len(sell), len(buy),
+            encode_decimal(last_price or decimal.Decimal(0)),
+        )
+        offset = HEADER.size + BODY.size
+        for levels in (sell, buy):
+            for price, volume in levels:
+                LEVEL.pack_into(
+                    self.mmap, offset,
+                    encode_decimal(price), encode_decimal(volume),
+                )
+                offset += LEVEL.size
+        self.sequence += 1
+        struct.pack_into('<Q', self.mmap, SEQUENCE_OFFSET, self.sequence)
+        self.updated_at = updated_at
+
+    def touch(self) -> None:
+        """Refresh ``updated_at`` without changing the levels."""
+        self.set_updated_at(time.time())
+
+    def invalidate(self) -> None:
+        self.set_updated_at(0.0)
+
+    def set_updated_at(self, updated_at: float) -> None:
+        assert self.writable
+        self.sequence += 1
+        struct.pack_into('<Q', self.mmap, SEQUENCE_OFFSET, self.sequence)
+        UPDATED_AT.pack_into(self.mmap, HEADER.size, updated_at)
+        self.sequence += 1
+        struct.pack_into('<Q', self.mmap, SEQUENCE_OFFSET, self.sequence)
+        self.updated_at = updated_at
+
+    @typechecked
+    def read(self) -> DepthSnapshot:
+        while True:
+            sequence, = struct.unpack_from('<Q', self.mmap, SEQUENCE_OFFSET)
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            data = self.mmap[:self.size]
+            if struct.unpack_from(
+                '<Q', self.mmap, SEQUENCE_OFFSET,
+            )[0] == sequence:
+                break
+        updated_at, _, sell_count, buy_count, last_price = BODY.unpack_from(
+            data, HEADER.size,
+        )
+        levels = [
+            (decode_decimal(price), decode_decimal(volume))
+            for price, volume in LEVEL.iter_unpack(
+                data[
+                    HEADER.size + BODY.size:
+                    HEADER.size + BODY.size +
+                    (sell_count + buy_count) * LEVEL.size
+                ]
+            )
+        ]
+        return DepthSnapshot(
+            sequence=sequence,
+            updated_at=updated_at,
+            last_price=decode_decimal(last_price) if any(last_price) else None,
+            sell=levels[:sell_count],
+            buy=levels[sell_count:],
+        )
@@ -1,14 +1,509 @@
-import json
-from typing import List
+"""Transports carrying commands from web gateways to order books.
+
+A :class:`Transport` delivers encoded commands to the order book of a pair
+and carries replies back to the gateway.  Two backends exist:
+
+:class:`AmqpTransport`
+   A durable queue per pair on RabbitMQ.  The default.
+
+:class:`LocalTransport`
+   A UNIX socket stream per pair, for a gateway and an order book on the
+   same host.  There is no broker hop, but nothing is persisted either:
+   commands sent while the order book is down fail to be sent, and those
+   in flight when it stops are lost.
 
-from pika.adapters.blocking_connection import (
-    BlockingChannel, BlockingConnection,
+The backend is chosen by ``order_book.transport`` of the configuration.
+Gateways share a bounded pool of open transports per process; see
+:class:`TransportPool`.
+
+"""
+import abc
+import contextlib
+import json
+import os
+import pathlib
+import selectors
+import socket
+import struct
+import threading
+import time
+import uuid
+import weakref
+from dataclasses import dataclass
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple,
+    TypeVar,
 )
+
+from pika.adapters.blocking_connection import BlockingConnection
 from pika.connection import URLParameters
-from typeguard import typechecked
+from pika.exceptions import AMQPError
+from pika.spec import BasicProperties
 
 from ..order import Order
-from ..serializer import serialize
+from ..trace import Trace, stamp
+from ..typecheck import typechecked
+from ..uuid7 import uuid7
+from .codec import encode_command
+
+#: RabbitMQ's pseudo-queue for direct reply-to, which needs no queue to be
+#: declared for the replies.
+REPLY_TO_QUEUE_NAME = 'amq.rabbitmq.reply-to'
+
+#: Tells the order book to reply on the connection a local command came from.
+LOCAL_REPLY_TO = 'connection'
+
+DEFAULT_LOCAL_DIRECTORY = '/tmp'
+
+#: published_at, content_type length, correlation_id length,
+#: reply_to length, body length
+FRAME = struct.Struct('<dHHHI')
+
+#: AMQP header of the publishing time in microseconds, as the timestamp
+#: property has only seconds and headers take no floats.
+PUBLISHED_AT_HEADER = 'published_at'
+
+#: Encoded commands and their content type by pair.
+Requests = Mapping[str, Tuple[bytes, str]]
+
+T = TypeVar('T')
+
+#: Transport pools of gateways by application, and the process which opened
+#: them, as a forked child must not share the parent's connections.
+transport_pools: 'weakref.WeakKeyDictionary[Any, TransportPool]' = (
+    weakref.WeakKeyDictionary()
+)
+transport_pools_lock = threading.Lock()
+
+
+@dataclass
+class Delivery:
+    """A command received by an order book."""
+
+    #: Backend-specific handle to acknowledge or reply to the command.
+    tag: Any
+    body: bytes
+    content_type: Optional[str] = None
+    correlation_id: Optional[str] = None
+    reply_to: Optional[str] = None
+    #: Wall clock time the gateway published the command, if it told.
+    published_at: Optional[float] = None
+    #: Whether the command may have been delivered before, e.g. to an order
+    #: book which stopped before acknowledging it.
+    redelivered: bool = False
+
+
+class Transport(abc.ABC):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def publish(
+        self,
+        pair: str,
+        body: bytes,
+        *,
+        content_type: str,
+        correlation_id: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def request(
+        self, requests: Requests, *, timeout: float,
+    ) -> Dict[str, bytes]:
+        """Send each request and wait for the replies.
+
+        :return: reply bodies by pair.  Pairs whose order book did not
+                 answer in ``timeout`` seconds are missing.
+
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def consume(
+        self, pair: str, *, inactivity_timeout: float,
+    ) -> Iterator[Optional[Delivery]]:
+        """Yield commands sent to ``pair`` until :meth:`cancel` is called.
+
+        ``None`` is yielded whenever nothing has arrived for
+        ``inactivity_timeout`` seconds.
+
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, delivery: Delivery):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reply(self, delivery: Delivery, body: bytes, *, content_type: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def cancel(self):
+        raise NotImplementedError
+
+
+class AmqpTransport(Transport):
+
+    def __init__(self, app):
+        self.connection = get_mq_connection(app)
+        self.channel = self.connection.channel()
+        self.declared_queue_names = set()
+        #: Replies by correlation id, for the requests waiting for them.
+        #: None until replies are consumed on the channel.
+        self.replies: Optional[Dict[str, Optional[bytes]]] = None
+
+    def close(self):
+        if self.channel.is_open:
+            self.channel.close()
+        if self.connection.is_open:
+            self.connection.close()
+
+    def declare(self, pair: str) -> str:
+        mq_queue_name = get_mq_queue_name(pair)
+        if mq_queue_name not in self.declared_queue_names:
+            self.channel.queue_declare(queue=mq_queue_name, durable=True)
+            self.declared_queue_names.add(mq_queue_name)
+        return mq_queue_name
+
+    def publish(
+        self,
+        pair: str,
+        body: bytes,
+        *,
+        content_type: str,
+        correlation_id: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ):
+        published_at = time.time()
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=self.declare(pair),
+            properties=BasicProperties(
+                content_type=content_type,
+                correlation_id=correlation_id,
+                reply_to=reply_to,
+                timestamp=int(published_at),
+                headers={
+                    PUBLISHED_AT_HEADER: int(published_at * 1_000_000),
+                },
+            ),
+            body=body,
+        )
+
+    def on_reply(self, channel, method, properties, body):
+        # Replies to requests which timed out are dropped.
+        if properties.correlation_id in self.replies:
+            self.replies[properties.correlation_id] = body
+
+    def request(
+        self, requests: Requests, *, timeout: float,
+    ) -> Dict[str, bytes]:
+        if self.replies is None:
+            # Direct reply-to requires consuming before publishing, and
+            # allows only one consumer per channel.
+            self.channel.basic_consume(
+                self.on_reply, REPLY_TO_QUEUE_NAME, no_ack=True,
+            )
+            self.replies = {}
+        correlation_ids = {}
+        try:
+            for pair, (body, content_type) in requests.items():
+                correlation_id = str(uuid7())
+                correlation_ids[correlation_id] = pair
+                self.replies[correlation_id] = None
+                self.publish(
+                    pair, body,
+                    content_type=content_type,
+                    correlation_id=correlation_id,
+                    reply_to=REPLY_TO_QUEUE_NAME,
+                )
+            deadline = time.monotonic() + timeout
+            while any(self.replies[c] is None for c in correlation_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.connection.process_data_events(time_limit=remaining)
+            return {
+                pair: self.replies[correlation_id]
+                for correlation_id, pair in correlation_ids.items()
+                if self.replies[correlation_id] is not None
+            }
+        finally:
+            for correlation_id in correlation_ids:
+                self.replies.pop(correlation_id, None)
+
+    def consume(
+        self, pair: str, *, inactivity_timeout: float,
+    ) -> Iterator[Optional[Delivery]]:
+        self.channel.basic_qos(prefetch_count=1)
+        consumer = self.channel.consume(
+            self.declare(pair), inactivity_timeout=inactivity_timeout,
+        )
+        for method, properties, body in consumer:
+            if method is None:
+                yield None
+                continue
+            published_at = (properties.headers or {}).get(
+                PUBLISHED_AT_HEADER,
+            )
+            if published_at is not None:
+                published_at /= 1_000_000
+            elif properties.timestamp is not None:
+                published_at = float(properties.timestamp)
+            yield Delivery(
+                tag=method.delivery_tag,
+                body=body,
+                content_type=properties.content_type,
+                correlation_id=properties.correlation_id,
+                reply_to=properties.reply_to,
+                published_at=published_at,
+                redelivered=method.redelivered,
+            )
+
+    def ack(self, delivery: Delivery):
+        self.channel.basic_ack(delivery_tag=delivery.tag)
+
+    def reply(self, delivery: Delivery, body: bytes, *, content_type: str):
+        if not delivery.reply_to:
+            return
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=delivery.reply_to,
+            properties=BasicProperties(
+                content_type=content_type,
+                correlation_id=delivery.correlation_id,
+            ),
+            body=body,
+        )
+
+    def cancel(self):
+        self.channel.cancel()
+
+
+@typechecked
+def pack_frame(
+    body: bytes,
+    content_type: Optional[str] = None,
+    correlation_id: Optional[str] = None,
+    reply_to: Optional[str] = None,
+    published_at: Optional[float] = None,
+) -> bytes:
+    fields = [(s or '').encode() for s in (
+        content_type, correlation_id, reply_to,
+    )]
+    return b''.join([
+        FRAME.pack(published_at or 0.0, *(len(f) for f in fields), len(body)),
+        *fields,
+        body,
+    ])
+
+
+@typechecked
+def unpack_frames(buffer: bytearray) -> List[Delivery]:
+    """Take every complete frame out of ``buffer``.
+
+    :return: deliveries of the frames, without :attr:`~Delivery.tag`
+
+    """
+    deliveries = []
+    offset = 0
+    while len(buffer) - offset >= FRAME.size:
+        published_at, *lengths = FRAME.unpack_from(buffer, offset)
+        end = offset + FRAME.size + sum(lengths)
+        if len(buffer) < end:
+            break
+        offset += FRAME.size
+        fields = []
+        for length in lengths:
+            fields.append(bytes(buffer[offset:offset + length]))
+            offset += length
+        content_type, correlation_id, reply_to, body = fields
+        deliveries.append(Delivery(
+            tag=None,
+            body=body,
+            content_type=content_type.decode() or None,
+            correlation_id=correlation_id.decode() or None,
+            reply_to=reply_to.decode() or None,
+            published_at=published_at or None,
+        ))
+    del buffer[:offset]
+    return deliveries
+
+
+class LocalTransport(Transport):
+
+    def __init__(self, directory: str = DEFAULT_LOCAL_DIRECTORY):
+        self.directory = directory
+        #: Gateway side connections by pair.
+        self.sockets: Dict[str, socket.socket] = {}
+        #: Replies received on them which are not complete frames yet.
+        self.buffers: Dict[str, bytearray] = {}
+        #: Order book side listening socket and its connections.
+        self.listener: Optional[socket.socket] = None
+        self.listener_path: Optional[pathlib.Path] = None
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.consuming = False
+
+    def get_socket_path(self, pair: str) -> pathlib.Path:
+        name = pair.replace('/', '-').lower()
+        return pathlib.Path(self.directory) / f'iu-order-book-{name}.sock'
+
+    def close(self):
+        for pair in list(self.sockets):
+            self.disconnect(pair)
+        if self.selector:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.selector = None
+        if self.listener:
+            self.listener = None
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.listener_path)
+
+    def connect(self, pair: str) -> socket.socket:
+        sock = self.sockets.get(pair)
+        if not sock:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(str(self.get_socket_path(pair)))
+            except OSError:
+                sock.close()
+                raise
+            self.sockets[pair] = sock
+            self.buffers[pair] = bytearray()
+        return sock
+
+    def disconnect(self, pair: str):
+        sock = self.sockets.pop(pair, None)
+        self.buffers.pop(pair, None)
+        if sock:
+            sock.close()
+
+    def publish(
+        self,
+        pair: str,
+        body: bytes,
+        *,
+        content_type: str,
+        correlation_id: Optional[str] = None,
+        reply_to: Optional[str] = None,
+    ):
+        frame = pack_frame(
+            body, content_type, correlation_id, reply_to, time.time(),
+        )
+        try:
+            self.connect(pair).sendall(frame)
+        except OSError:
+            self.disconnect(pair)
+            raise
+
+    def request(
+        self, requests: Requests, *, timeout: float,
+    ) -> Dict[str, bytes]:
+        replies = {}
+        correlation_ids = {}
+        with selectors.DefaultSelector() as selector:
+            for pair, (body, content_type) in requests.items():
+                correlation_id = str(uuid7())
+                try:
+                    self.publish(
+                        pair, body,
+                        content_type=content_type,
+                        correlation_id=correlation_id,
+                        reply_to=LOCAL_REPLY_TO,
+                    )
+                except OSError:
+                    continue
+                correlation_ids[correlation_id] = pair
+                # The buffer outlives the request, as the connection does.
+                selector.register(
+                    self.sockets[pair], selectors.EVENT_READ, pair,
+                )
+            deadline = time.monotonic() + timeout
+            while len(replies) < len(correlation_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    data = key.fileobj.recv(65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        # The order book has gone away; reconnect next time.
+                        self.disconnect(key.data)
+                        continue
+                    buffer = self.buffers[key.data]
+                    buffer.extend(data)
+                    for delivery in unpack_frames(buffer):
+                        pair = correlation_ids.get(delivery.correlation_id)
+                        if pair:
+                            replies[pair] = delivery.body
+        return replies
+
+    def consume(
+        self, pair: str, *, inactivity_timeout: float,
+    ) -> Iterator[Optional[Delivery]]:
+        self.listener_path = self.get_socket_path(pair)
+        with contextlib.suppress(FileNotFoundError):
+            # Left behind by an order book which did not stop cleanly.
+            os.unlink(self.listener_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(str(self.listener_path))
+        self.listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.consuming = True
+        while self.consuming:
+            events = self.selector.select(inactivity_timeout)
+            if not events:
+                yield None
+                continue
+            for key, _ in events:
+                if key.fileobj is self.listener:
+                    connection, _ = self.listener.accept()
+                    self.selector.register(
+                        connection, selectors.EVENT_READ, bytearray(),
+                    )
+                    continue
+                data = key.fileobj.recv(65536)
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                key.data.extend(data)
+                for delivery in unpack_frames(key.data):
+                    delivery.tag = key.fileobj
+                    yield delivery
+                    if not self.consuming:
+                        return
+
+    def ack(self, delivery: Delivery):
+        pass
+
+    def reply(self, delivery: Delivery, body: bytes, *, content_type: str):
+        if delivery.reply_to != LOCAL_REPLY_TO:
+            return
+        try:
+            delivery.tag.sendall(
+                pack_frame(body, content_type, delivery.correlation_id),
+            )
+        except OSError:
+            # The gateway has gone away; there is no one to reply to.
+            pass
+
+    def cancel(self):
+        self.consuming = False
 
 
 @typechecked
@@ -18,35 +513,163 @@ def get_mq_connection(app) -> BlockingConnection:
     return BlockingConnection(parameters)
 
 
-@typechecked
-def get_mq_channel(
-    mq_connection: BlockingConnection,
-    mq_queue_name: str,
-) -> BlockingChannel:
-    mq_channel = mq_connection.channel()
-    mq_channel.queue_declare(queue=mq_queue_name, durable=True)
-    mq_channel.basic_qos(prefetch_count=1)
-    return mq_channel
-
-
 @typechecked
 def get_mq_queue_name(pair: str) -> str:
     return f'order_book.{pair.lower()}'
 
 
 @typechecked
-def enqueue_place_order(app, order: Order):
-    mq_queue_name = get_mq_queue_name(order.pair)
-    with get_mq_connection(app) as mq_connection, \
-            get_mq_channel(mq_connection, mq_queue_name) as mq_channel:
-        mq_channel.basic_publish(
-            exchange='',
-            routing_key=f'order_book.{order.pair.lower()}',
-            body=json.dumps({
-                'type': 'place',
-                'order': serialize(order),
-            }),
+def get_transport(app) -> Transport:
+    config = app.config['APP_CONFIG'].get('order_book', {})
+    backend = config.get('transport', 'amqp')
+    if backend == 'amqp':
+        return AmqpTransport(app)
+    elif backend == 'local':
+        return LocalTransport(
+            config.get('transport_directory', DEFAULT_LOCAL_DIRECTORY),
         )
+    raise ValueError(f'unknown order book transport: {backend!r}')
+
+
+class TransportPool:
+    """Open transports of a gateway process, shared by its threads.
+
+    At most ``size`` transports are open at once; callers beyond that wait
+    for one to be released.  Under gevent, which the gateway runs on,
+    threads are greenlets and the locks of :mod:`threading` are patched to
+    yield to the other greenlets while waiting, so the pool must be created
+    after monkey-patching, as run.py does.
+
+    """
+
+    @typechecked
+    def __init__(self, app, size: int):
+        self.app = app
+        self.size = size
+        self.pid = os.getpid()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        #: Transports which are open and not in use.
+        self.idle: List[Transport] = []
+        self.closed = False
+
+    def acquire(self) -> Transport:
+        self.slots.acquire()
+        try:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError('the transport pool is closed')
+                if self.idle:
+                    return self.idle.pop()
+            return get_transport(self.app)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, transport: Transport, *, broken: bool = False):
+        with self.lock:
+            keep = not broken and not self.closed
+            if keep:
+                self.idle.append(transport)
+        if not keep:
+            with contextlib.suppress(AMQPError, OSError):
+                transport.close()
+        self.slots.release()
+
+    def use(self, send: Callable[[Transport], T]) -> T:
+        """Call ``send`` with a transport of the pool.
+
+        Transports are kept open, which spares connecting to the broker for
+        every command.  If ``send`` fails on one, e.g. as the broker has
+        dropped an idle connection, it is closed and ``send`` is retried
+        once on another.  It may send commands twice then, which order
+        books drop as duplicates.
+
+        """
+        for retry in (True, False):
+            transport = self.acquire()
+            try:
+                result = send(transport)
+            except (AMQPError, OSError):
+                self.release(transport, broken=True)
+                if not retry:
+                    raise
+                continue
+            except BaseException:
+                self.release(transport)
+                raise
+            self.release(transport)
+            return result
+
+    def close(self):
+        """Close the idle transports, and the others once released."""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for transport in idle:
+            with contextlib.suppress(AMQPError, OSError):
+                transport.close()
+
+
+def get_transport_pool(app) -> TransportPool:
+    # Flask's current_app is a proxy; key by the application itself.
+    app = getattr(app, '_get_current_object', lambda: app)()
+    with transport_pools_lock:
+        pool = transport_pools.get(app)
+        if pool is None or pool.pid != os.getpid():
+            config = app.config['APP_CONFIG'].get('order_book', {})
+            pool = transport_pools[app] = TransportPool(
+                app, config.get('transport_pool_size', 8),
+            )
+        return pool
+
+
+def close_transport_pool(app):
+    """Close the transports of ``app``, e.g. as the gateway stops."""
+    app = getattr(app, '_get_current_object', lambda: app)()
+    with transport_pools_lock:
+        pool = transport_pools.pop(app, None)
+    if pool:
+        pool.close()
+
+
+def use_transport(app, send: Callable[[Transport], T]) -> T:
+    """Call ``send`` with a transport of the pool of ``app``; see
+    :meth:`TransportPool.use`."""
+    return get_transport_pool(app).use(send)
+
+
+@typechecked
+def get_command_encoding(app) -> str:
+    return app.config['APP_CONFIG'].get('order_book', {}).get(
+        'command_encoding', 'json',
+    )
+
+
+@typechecked
+def publish_command(
+    app, transport: Transport, pair: str, command: Mapping[str, Any],
+):
+    stamp(command.get('trace'), 'enqueued')
+    body, content_type = encode_command(
+        command, encoding=get_command_encoding(app),
+    )
+    transport.publish(pair, body, content_type=content_type)
+
+
+@typechecked
+def enqueue_place_order(
+    app, order: Order, *, trace: Optional[Trace] = None,
+):
+    command = {'type': 'place', 'order': order}
+    if trace is not None:
+        command['trace'] = trace
+    use_transport(
+        app,
+        lambda transport: publish_command(
+            app, transport, order.pair, command,
+        ),
+    )
 
 
 @typechecked
@@ -54,17 +677,89 @@ def enqueue_delete_order(app, orders: List[Order]):
     order_id_map = {}
     for order in orders:
         order_id_map.setdefault(order.pair, []).append(order.id)
-    with get_mq_connection(app) as mq_connection:
+
+    def send(transport: Transport):
         for pair, order_ids in order_id_map.items():
-            mq_queue_name = get_mq_queue_name(pair)
-            with get_mq_channel(mq_connection, mq_queue_name) as mq_channel:
-                count = 100
-                for i in range(0, len(order_ids), count):
-                    mq_channel.basic_publish(
-                        exchange='',
-                        routing_key=f'order_book.{pair.lower()}',
-                        body=json.dumps({
-                            'type': 'cancel',
-                            'order_ids': serialize(order_ids[i:i + count]),
-                        }),
-                    )
+            count = 100
+            for i in range(0, len(order_ids), count):
+                publish_command(app, transport, pair, {
+                    'type': 'cancel',
+                    'order_ids': order_ids[i:i + count],
+                })
+    use_transport(app, send)
+
+
+@typechecked
+def enqueue_cancel_all_orders(app, user_id: uuid.UUID, pairs: Iterable[str]):
+    pairs = list(pairs)
+
+    def send(transport: Transport):
+        for pair in pairs:
+            publish_command(app, transport, pair, {
+                'type': 'cancelAll',
+                'user_id': user_id,
+            })
+    use_transport(app, send)
+
+
+@typechecked
+def request_replies(
+    app,
+    commands: Mapping[str, Mapping[str, Any]],
+    *,
+    timeout: float = 1.0,
+) -> Dict[str, Any]:
+    """Send a request to the order book of each pair and wait for replies.
+
+    :param commands: request commands by pair
+    :return: replies by pair.  Pairs whose order book did not answer in
+             ``timeout`` seconds are missing.
+
+    """
+    encoding = get_command_encoding(app)
+    requests = {}
+    for pair, command in commands.items():
+        stamp(command.get('trace'), 'enqueued')
+        requests[pair] = encode_command(command, encoding=encoding)
+    replies = use_transport(
+        app, lambda transport: transport.request(requests, timeout=timeout),
+    )
+    return {pair: json.loads(body) for pair, body in replies.items()}
+
+
+@typechecked
+def request_place_order(
+    app,
+    order: Order,
+    *,
+    timeout: Optional[float] = None,
+    trace: Optional[Trace] = None,
+) -> Optional[Mapping[str, Any]]:
+    """Place ``order`` and wait for the outcome from its order book.
+
+    :param timeout: seconds to wait.  ``order_book.place_order_timeout``
+                    of the configuration, or 2 seconds by default.
+    :param trace: the :mod:`~iu.trace` to send along with the order
+    :return: the outcome, or :const:`None` if the order book did not answer
+             in time.  The order may still be placed after that.
+
+    """
+    if timeout is None:
+        timeout = app.config['APP_CONFIG'].get('order_book', {}).get(
+            'place_order_timeout', 2.0,
+        )
+    command = {'type': 'place', 'order': order}
+    if trace is not None:
+        command['trace'] = trace
+    replies = request_replies(app, {order.pair: command}, timeout=timeout)
+    return replies.get(order.pair)
+
+
+@typechecked
+def request_open_orders(
+    app, user_id: uuid.UUID, pairs: Iterable[str],
+) -> Dict[str, List[Mapping[str, Any]]]:
+    return request_replies(app, {
+        pair: {'type': 'openOrders', 'user_id': user_id}
+        for pair in pairs
+    })
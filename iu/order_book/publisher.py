@@ -0,0 +1,317 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import threading
+from typing import (
+    Any, Hashable, Iterator, List, Mapping, Optional, Sequence, Tuple,
+)
+
+from websockets import connect
+
+from ..typecheck import typechecked
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+#: Types of which only the latest message of each key matters, since each
+#: carries the whole state, e.g. the merged book of a market.  ``bbo`` is
+#: left out on purpose: clients of that channel see every change of the top
+#: of the book.
+CONFLATABLE_TYPES = frozenset({'market', 'order'})
+
+#: Types of which messages are split per user, and merged into the pending
+#: message of the same user instead of queueing another one.  The websocket
+#: server routes them per user anyway, so nothing is lost by merging.
+MERGEABLE_TYPES = frozenset({'balance', 'orderStatus'})
+
+
+@typechecked
+def get_conflation_key(message: Mapping[str, Any]) -> Optional[Hashable]:
+    type_ = message['type']
+    data = message['data']
+    if type_ in MERGEABLE_TYPES:
+        return (type_, *data) if data else None
+    elif type_ not in CONFLATABLE_TYPES:
+        return None
+    elif type_ == 'market':
+        return (type_, *(market['pair'] for market in data))
+    return type_, data['pair']
+
+
+@typechecked
+def split_message(message: Mapping[str, Any]) -> Iterator[Mapping[str, Any]]:
+    """Split a message of a mergeable type into one message per user.  The
+    trace, if any, goes along with the first of them."""
+    if message['type'] not in MERGEABLE_TYPES or len(message['data']) < 2:
+        yield message
+        return
+    trace = message.get('trace')
+    for user_id, payload in message['data'].items():
+        part = {'type': message['type'], 'data': {user_id: payload}}
+        if trace is not None:
+            part['trace'], trace = trace, None
+        yield part
+
+
+@typechecked
+def merge_messages(
+    older: Mapping[str, Any], newer: Mapping[str, Any],
+) -> Mapping[str, Any]:
+    """Merge two messages of the same key, as if both had been sent."""
+    type_ = newer['type']
+    if type_ == 'balance':
+        data = {
+            user_id: {**older['data'].get(user_id, {}), **balances}
+            for user_id, balances in newer['data'].items()
+        }
+    elif type_ == 'orderStatus':
+        data = {
+            user_id: [*older['data'].get(user_id, ()), *events]
+            for user_id, events in newer['data'].items()
+        }
+    else:
+        return newer
+    merged = {'type': type_, 'data': data}
+    # Only one trace fits; the older one has waited longer anyway.
+    trace = older.get('trace', newer.get('trace'))
+    if trace is not None:
+        merged['trace'] = trace
+    return merged
+
+
+class WebsocketPublisher(threading.Thread):
+    """Sends messages of order books to the websocket server.
+
+    Messages are buffered and sent from this thread over a single
+    connection, which is reopened whenever it drops.  Pending messages are
+    coalesced into frames of up to ``batch_size`` messages.  A newer
+    message of a conflatable type replaces the pending one of the same
+    market, and balance and order status messages are merged into the
+    pending one of the same user.
+
+    :meth:`publish` never waits, since a single publisher serves the order
+    books of every market.  When more than ``capacity`` messages are
+    pending, the oldest are dropped; a book or market message is soon
+    superseded anyway, but others are counted in :attr:`overflowed` and
+    logged as errors.
+
+    """
+
+    @typechecked
+    def __init__(
+        self,
+        url: str,
+        *,
+        capacity: int = 10000,
+        batch_size: int = 100,
+        min_retry_interval: float = 0.1,
+        max_retry_interval: float = 5.0,
+    ):
+        super().__init__(name='WebsocketPublisher', daemon=True)
+        self.url = url
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.min_retry_interval = min_retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.lock = threading.Lock()
+        self.pending: collections.OrderedDict = collections.OrderedDict()
+        self.sequence = itertools.count()
+        #: Messages of conflatable types dropped since the last report.
+        self.dropped = 0
+        #: Messages of other types dropped since the last report.
+        self.overflowed = 0
+        self.closing = False
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """Stop after sending what is pending, waiting up to ``timeout``."""
+        with self.lock:
+            self.closing = True
+        self.notify()
+        if self.is_alive():
+            self.join(timeout)
+
+    def notify(self):
+        loop = self.loop
+        if loop and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                # The loop has just been closed.
+                pass
+
+    @typechecked
+    def publish(self, messages: Sequence[Mapping[str, Any]]):
+        """Buffer ``messages`` without waiting, dropping the oldest pending
+        ones beyond ``capacity``."""
+        with self.lock:
+            overflowed = self.overflowed
+            for message in messages:
+                for part in split_message(message):
+                    self.put(part)
+            self.shed()
+            # Logged once when it starts; report_dropped() tells the rest.
+            started_overflowing = not overflowed and self.overflowed > 0
+        self.notify()
+        if started_overflowing:
+            logger.error(
+                f'{self.name}: more than {self.capacity} messages pending; '
+                'dropping the oldest until the websocket server catches up'
+            )
+
+    def put(self, message: Mapping[str, Any]):
+        """Must be called with :attr:`lock` held."""
+        key = get_conflation_key(message)
+        if key is None:
+            self.pending[next(self.sequence)] = message
+        elif message['type'] in MERGEABLE_TYPES:
+            # Merged in place, so a busy user does not keep falling behind.
+            older = self.pending.get(key)
+            self.pending[key] = (
+                message if older is None else merge_messages(older, message)
+            )
+        else:
+            self.pending.pop(key, None)
+            self.pending[key] = message
+
+    def shed(self):
+        """Drop the oldest messages while more than ``capacity`` are
+        pending.  Balances and order status go last, since there is at most
+        one such message per user.  Must be called with :attr:`lock`
+        held."""
+        excess = len(self.pending) - self.capacity
+        if excess <= 0:
+            return
+        stale = list(itertools.islice(
+            (
+                key for key, message in self.pending.items()
+                if message['type'] not in MERGEABLE_TYPES
+            ),
+            excess,
+        ))
+        stale.extend(itertools.islice(
+            (
+                key for key, message in self.pending.items()
+                if message['type'] in MERGEABLE_TYPES
+            ),
+            excess - len(stale),
+        ))
+        for key in stale:
+            if self.pending.pop(key)['type'] in CONFLATABLE_TYPES:
+                self.dropped += 1
+            else:
+                self.overflowed += 1
+
+    def requeue(self, frame: List[Tuple[Hashable, Mapping[str, Any]]]):
+        """Put an unsent frame back before the messages published since."""
+        with self.lock:
+            pending = collections.OrderedDict()
+            for key, message in frame:
+                if key not in self.pending:
+                    pending[key] = message
+                elif message['type'] in MERGEABLE_TYPES:
+                    pending[key] = merge_messages(
+                        message, self.pending.pop(key),
+                    )
+            pending.update(self.pending)
+            self.pending = pending
+            self.shed()
+
+    async def next_frame(
+        self,
+    ) -> Optional[List[Tuple[Hashable, Mapping[str, Any]]]]:
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                if self.pending:
+                    frame = [
+                        self.pending.popitem(last=False)
+                        for _ in range(min(self.batch_size, len(self.pending)))
+                    ]
+                    return frame
+                elif self.closing:
+                    return None
+            await self.wakeup.wait()
+
+    def report_dropped(self):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+            overflowed, self.overflowed = self.overflowed, 0
+        if dropped:
+            logger.warning(
+                f'{self.name}: dropped {dropped} book and market messages; '
+                'the websocket server is not keeping up'
+            )
+        if overflowed:
+            logger.error(
+                f'{self.name}: dropped {overflowed} order status, trade, '
+                'balance and bbo messages; the websocket server fell more '
+                f'than {self.capacity} messages behind'
+            )
+
+    async def serve(self):
+        retry_interval = self.min_retry_interval
+        while True:
+            with self.lock:
+                if self.closing and not self.pending:
+                    return
+            try:
+                async with connect(self.url) as websocket:
+                    retry_interval = self.min_retry_interval
+                    while True:
+                        frame = await self.next_frame()
+                        if frame is None:
+                            return
+                        try:
+                            await websocket.send(json.dumps([
+                                message for _, message in frame
+                            ]))
+                        except BaseException:
+                            self.requeue(frame)
+                            raise
+                        self.report_dropped()
+            except Exception as e:
+                with self.lock:
+                    if self.closing:
+                        # Do not keep a stopping engine waiting for a server
+                        # which is down.
+                        return
+                logger.warning(
+                    f'{self.name}: {self.url}: {e!r}; '
+                    f'reconnecting in {retry_interval}s'
+                )
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(
+                    retry_interval * 2, self.max_retry_interval,
+                )
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.wakeup = asyncio.Event()
+            self.loop = loop
+            loop.run_until_complete(self.serve())
+        finally:
+            self.loop = None
+            loop.close()
+
+
+@typechecked
+def create_websocket_publisher(app) -> WebsocketPublisher:
+    config = app.config['APP_CONFIG']
+    return WebsocketPublisher(
+        config['websocket']['url'],
+        capacity=config.get('order_book', {}).get('websocket_buffer', 10000),
+    )
@@ -1,10 +1,15 @@
 import decimal
-from typing import Any, Mapping
+import time
+from typing import Any, Hashable, Iterable, Mapping, Set
 import uuid
 
-from typeguard import typechecked
-
 from ..order import Order, OrderSide
+from ..typecheck import typechecked
+
+#: Scale of every ``Numeric(36, 18)`` column.
+SCALE = 18
+#: Exact for every value :func:`encode_decimal` can encode.
+ENCODING_CONTEXT = decimal.Context(prec=64)
 
 
 @typechecked
@@ -19,3 +24,69 @@ def parse_order(payload: Mapping[str, Any]) -> Order:
         base_currency=payload['base_currency'],
         quote_currency=payload['quote_currency'],
     )
+
+
+@typechecked
+def encode_decimal(value: decimal.Decimal) -> bytes:
+    """Encode ``value`` as a 128-bit integer scaled by ``10 ** SCALE``.
+
+    :raise ValueError: when ``value`` has more than :data:`SCALE` decimal
+                       places, or does not fit
+
+    """
+    scaled = value.scaleb(SCALE, ENCODING_CONTEXT)
+    if not scaled.is_finite() or scaled != int(scaled):
+        raise ValueError(f'{value} has more than {SCALE} decimal places')
+    try:
+        return int(scaled).to_bytes(16, 'little', signed=True)
+    except OverflowError:
+        raise ValueError(f'{value} is out of range') from None
+
+
+@typechecked
+def decode_decimal(value: bytes) -> decimal.Decimal:
+    return decimal.Decimal(
+        int.from_bytes(value, 'little', signed=True)
+    ).scaleb(-SCALE)
+
+
+class RecentIds:
+    """Bounded set of recently seen ids.
+
+    Ids are added to the current generation of two hash sets.  Once it
+    holds ``capacity`` ids or becomes ``window`` seconds old, the previous
+    generation is dropped and the current one takes its place, so memory
+    is bounded by twice ``capacity`` ids.
+
+    """
+
+    @typechecked
+    def __init__(self, capacity: int = 100000, window: float = 3600.0):
+        self.capacity = capacity
+        self.window = window
+        self.current: Set[Hashable] = set()
+        self.previous: Set[Hashable] = set()
+        self.rotated_at = time.monotonic()
+
+    def __contains__(self, id_: Hashable) -> bool:
+        return id_ in self.current or id_ in self.previous
+
+    def __len__(self) -> int:
+        return len(self.current | self.previous)
+
+    def rotate(self):
+        self.previous = self.current
+        self.current = set()
+        self.rotated_at = time.monotonic()
+
+    def add(self, id_: Hashable):
+        if (
+            len(self.current) >= self.capacity or
+            time.monotonic() - self.rotated_at >= self.window
+        ):
+            self.rotate()
+        self.current.add(id_)
+
+    def update(self, ids: Iterable[Hashable]):
+        for id_ in ids:
+            self.add(id_)
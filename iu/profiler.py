@@ -0,0 +1,83 @@
+"""Stack-sampling profiler for a single thread, run on demand.
+
+Instead of tracing every call like :mod:`cProfile`, a sampler thread reads
+the current frame of the profiled thread at a fixed interval, so the
+profiled thread runs at full speed and nothing is paid while no profile is
+being taken.  Samples are written in the collapsed stack format, one
+``outermost;...;innermost count`` line per distinct stack, which flame graph
+tools such as ``flamegraph.pl`` and speedscope read.
+
+"""
+import collections
+import os
+import pathlib
+import sys
+import time
+import types
+from typing import Dict, Optional, Union
+
+from .typecheck import typechecked
+
+
+@typechecked
+def format_stack(frame: Optional[types.FrameType]) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f'{code.co_name} ({filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+@typechecked
+def sample_stacks(
+    thread_id: int, *, seconds: float, interval: float = 0.005,
+) -> Dict[str, int]:
+    """Sample the stack of the thread of ``thread_id`` for ``seconds``.
+
+    Sampling ends early if the thread ends.
+
+    :return: sample counts by collapsed stack
+
+    """
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        stacks[format_stack(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+@typechecked
+def write_collapsed_stacks(
+    stacks: Dict[str, int], path: Union[str, pathlib.Path],
+) -> None:
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+
+
+@typechecked
+def profile_thread(
+    thread_id: int,
+    directory: Union[str, pathlib.Path],
+    name: str,
+    *,
+    seconds: float,
+    interval: float = 0.005,
+) -> pathlib.Path:
+    """Profile a thread and write its collapsed stacks under ``directory``.
+
+    :return: the path of the written file
+
+    """
+    stacks = sample_stacks(thread_id, seconds=seconds, interval=interval)
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    path = pathlib.Path(directory) / f'iu-profile-{name}-{timestamp}.txt'
+    write_collapsed_stacks(stacks, path)
+    return path
@@ -6,11 +6,11 @@ from typing import Any, Mapping, Union
 import uuid
 
 from sqlalchemy.inspection import inspect
-from typeguard import typechecked
 
 from .market import Market
 from .trade import Trade
 from .orm import Base
+from .typecheck import typechecked
 
 
 @functools.singledispatch
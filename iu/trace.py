@@ -0,0 +1,110 @@
+"""Latency tracing of placed orders, from the web gateway to websockets.
+
+A trace is a dictionary of timestamps by hop, which travels along with the
+``place`` command to the order book, and along with the ``orderStatus``
+message of the order to the websocket server.  Each process stamps the hops
+it passes, and records the time between consecutive hops, so the latency of
+every hop is found in the metrics of the last process the order reached::
+
+    iu_order_latency_seconds{hop="matched",quantile="0.99"} 0.000812
+
+Timestamps are wall clock seconds rather than :func:`time.monotonic`, since
+the web, engine and websocket processes may run on different hosts; keep
+their clocks synchronized to trust the cross-process hops.
+
+"""
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from .metrics import Registry, registry
+from .typecheck import typechecked
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+
+#: Hops of an order in the order they happen.
+HOPS = (
+    'received',   # the web gateway got POST /orders/
+    'enqueued',   # the gateway sent the place command
+    'dequeued',   # the order book took the command
+    'matched',    # the order book matched the order
+    'committed',  # the order book committed the order and its trades
+    'published',  # the websocket server pushed it to clients
+)
+
+METRIC = 'iu_order_latency_seconds'
+
+#: Seconds between summaries of the latencies in the log.
+LOG_INTERVAL = 60.0
+
+Trace = Dict[str, float]
+
+
+class TraceLog:
+    """Log a summary of the hop latencies at most once per ``interval``."""
+
+    def __init__(self, interval: float = LOG_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.logged_at = time.monotonic()
+
+    def maybe_log(self, registry: Registry):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.logged_at < self.interval:
+                return
+            self.logged_at = now
+        summary = format_latencies(registry)
+        if summary:
+            logger.info(f'Order latencies: {summary}')
+
+
+trace_log = TraceLog()
+
+
+@typechecked
+def start_trace() -> Trace:
+    return {'received': time.time()}
+
+
+@typechecked
+def stamp(trace: Optional[Trace], hop: str) -> None:
+    """Stamp ``hop`` on ``trace``, unless the command is not traced."""
+    if trace is not None:
+        trace[hop] = time.time()
+
+
+@typechecked
+def record_trace(trace: Trace, registry: Registry = registry) -> None:
+    """Record the latency of each hop of ``trace`` since the one before, and
+    of the whole trace as the ``total`` hop.
+
+    """
+    hops = [hop for hop in HOPS if hop in trace]
+    for previous, hop in zip(hops, hops[1:]):
+        registry.histogram(METRIC, hop=hop).record(
+            max(0.0, trace[hop] - trace[previous]),
+        )
+    if len(hops) > 1:
+        registry.histogram(METRIC, hop='total').record(
+            max(0.0, trace[hops[-1]] - trace[hops[0]]),
+        )
+    trace_log.maybe_log(registry)
+
+
+@typechecked
+def format_latencies(registry: Registry = registry) -> str:
+    """Format the median and 99th percentile latency of each hop."""
+    with registry.lock:
+        histograms = dict(registry.histograms.get(METRIC, {}))
+    parts = []
+    for hop in HOPS[1:] + ('total',):
+        histogram = histograms.get((('hop', hop),))
+        if histogram is None or not histogram.count:
+            continue
+        (_, p50), (_, p99) = histogram.get_percentiles([0.5, 0.99])
+        parts.append(f'{hop} p50={p50 * 1e3:.3f}ms p99={p99 * 1e3:.3f}ms')
+    return '; '.join(parts)
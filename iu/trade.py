@@ -1,5 +1,3 @@
-import uuid
-
 from sqlalchemy import CheckConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
@@ -13,10 +11,11 @@ from sqlalchemy_utils.types.uuid import UUIDType
 from .mixin import PairMixin
 from .order import OrderSide
 from .orm import Base
+from .uuid7 import uuid7
 
 
 class Trade(Base, PairMixin):
-    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDType, primary_key=True, default=uuid7)
     created_at = Column(
         UtcDateTime, nullable=False, index=True, default=utcnow(),
     )
@@ -16,19 +16,21 @@ from sqlalchemy_enum34 import EnumType
 from sqlalchemy_utc.now import utcnow
 from sqlalchemy_utc.sqltypes import UtcDateTime
 from sqlalchemy_utils.types.uuid import UUIDType
-from typeguard import typechecked
 
 from .balance import Balance
 from .orm import Base, Session, SessionType
+from .typecheck import typechecked
+from .uuid7 import uuid7
 
 
 class TransactionType(enum.Enum):
     blockchain = 'blockchain'
     trade = 'trade'
+    ledger = 'ledger'
 
 
 class Transaction(Base):
-    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDType, primary_key=True, default=uuid7)
     created_at = Column(UtcDateTime, nullable=False, default=utcnow())
     type = Column(
         EnumType(TransactionType, name='transaction_type'),
@@ -57,7 +59,7 @@ class Transaction(Base):
 class BlockchainTransaction(Transaction):
     id = Column(
         UUIDType, ForeignKey('transaction.id'),
-        default=uuid.uuid4, primary_key=True,
+        default=uuid7, primary_key=True,
     )
     tx_id = Column(Unicode, ForeignKey('deposit.tx_id'), unique=True)
 
@@ -70,7 +72,7 @@ class BlockchainTransaction(Transaction):
 class TradeTransaction(Transaction):
     id = Column(
         UUIDType, ForeignKey('transaction.id'),
-        default=uuid.uuid4, primary_key=True,
+        default=uuid7, primary_key=True,
     )
     trade_id = Column(UUIDType, ForeignKey('trade.id'))
     trade = relationship('Trade')
@@ -81,6 +83,27 @@ class TradeTransaction(Transaction):
     }
 
 
+class LedgerTransaction(Transaction):
+    """Compact trade ledger row, written instead of six
+    :class:`TradeTransaction` rows per trade when the order book runs with
+    ``compact_ledger`` on.
+
+    Each row holds the net amount of a trade for a user and currency, fees
+    included, and links to the trade by itself.  Fee credits are rolled up
+    per matching batch and have no :attr:`trade_id`.
+
+    """
+
+    trade_id = Column(
+        UUIDType, ForeignKey('trade.id'), index=True, nullable=True,
+    )
+    trade = relationship('Trade')
+
+    __mapper_args__ = {
+        'polymorphic_identity': TransactionType.ledger,
+    }
+
+
 class Deposit(Base):
     tx_id = Column(Unicode, primary_key=True)
     created_at = Column(UtcDateTime, nullable=False, default=utcnow())
@@ -0,0 +1,86 @@
+"""Process-wide policy of runtime type checks.
+
+Functions of this package are decorated with :func:`typechecked` of this
+module instead of :func:`typeguard.typechecked`, so how much checking they
+cost is decided in one place by the ``IU_TYPECHECK`` environment variable:
+
+``full`` (default)
+   Every call is checked, as in tests and development.
+
+``sampled``
+   One in every ``IU_TYPECHECK_RATE`` (100 by default) calls of each
+   function is checked, e.g. on staging, to still catch type errors there.
+
+``off``
+   Functions are left undecorated, so checks cost nothing in production.
+
+Decorators are applied at import time, so the variable has to be set before
+the process imports the package.
+
+"""
+import asyncio
+import functools
+import itertools
+import os
+from typing import Callable, Optional, Tuple
+
+import typeguard
+
+
+POLICIES = frozenset({'off', 'sampled', 'full'})
+
+
+def get_policy() -> Tuple[str, int]:
+    """Read the policy from the environment.
+
+    :return: the policy name and the sampling rate
+    :raise ValueError: on an unknown policy or a non-positive rate
+
+    """
+    policy = os.environ.get('IU_TYPECHECK', 'full').strip().lower()
+    if policy not in POLICIES:
+        raise ValueError(
+            f'IU_TYPECHECK must be one of {", ".join(sorted(POLICIES))}, '
+            f'not {policy!r}'
+        )
+    rate = int(os.environ.get('IU_TYPECHECK_RATE', '100'))
+    if rate < 1:
+        raise ValueError(f'IU_TYPECHECK_RATE must be positive, not {rate}')
+    return policy, rate
+
+
+def typechecked(
+    func: Optional[Callable] = None,
+    *,
+    policy: Optional[str] = None,
+    rate: Optional[int] = None,
+) -> Callable:
+    """Check the argument and return types of ``func`` by the policy.
+
+    ``policy`` and ``rate`` override the environment for a single function.
+
+    """
+    if func is None:
+        return functools.partial(typechecked, policy=policy, rate=rate)
+    default_policy, default_rate = get_policy()
+    policy = policy or default_policy
+    rate = rate or default_rate
+    if policy == 'off':
+        return func
+    checked = typeguard.typechecked(func)
+    if policy == 'full' or rate == 1 or checked is func:
+        return checked
+    calls = itertools.count()
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if next(calls) % rate:
+                return await func(*args, **kwargs)
+            return await checked(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if next(calls) % rate:
+                return func(*args, **kwargs)
+            return checked(*args, **kwargs)
+    return wrapper
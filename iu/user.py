@@ -1,5 +1,3 @@
-import uuid
-
 from flask_login.mixins import UserMixin
 from sqlalchemy.orm import object_session
 from sqlalchemy.schema import Column
@@ -8,14 +6,15 @@ from sqlalchemy_utc.sqltypes import UtcDateTime
 from sqlalchemy_utils.types.email import EmailType
 from sqlalchemy_utils.types.uuid import UUIDType
 from sqlalchemy_utils.types.password import PasswordType
-from typeguard import typechecked
 
 from .balance import Balance
 from .orm import Base
+from .typecheck import typechecked
+from .uuid7 import uuid7
 
 
 class User(Base, UserMixin):
-    id = Column(UUIDType, primary_key=True, default=uuid.uuid4)
+    id = Column(UUIDType, primary_key=True, default=uuid7)
     created_at = Column(UtcDateTime, nullable=False, default=utcnow())
     email = Column(EmailType, nullable=False, unique=True)
     password = Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False)
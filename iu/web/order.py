@@ -1,20 +1,25 @@
 import decimal
-import uuid
+import itertools
 
 from flask.blueprints import Blueprint
 from flask.globals import request, session as flask_session
 from flask.json import jsonify
 from flask_login.utils import current_user, login_required
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import BadRequest, GatewayTimeout, Unauthorized
 
 from ..context import session
+from ..market import Market
 from ..order import Order, OrderSide
+from ..order_book.util import encode_decimal
+from ..trace import record_trace, start_trace
+from ..uuid7 import uuid7
 
 bp_order = Blueprint('order', __name__, url_prefix='/orders')
 
 
 @bp_order.route('/', methods=['POST'])
 def place_order():
+    trace = start_trace()
     if 'user_id' not in flask_session:
         raise Unauthorized()
     data = request.get_json()
@@ -50,8 +55,14 @@ def place_order():
     else:
         price = min(decimal.Decimal('100000000'), price)
         price = min(decimal.Decimal('0.01'), price)
+    # Order books would otherwise round what they cannot store.
+    for name, value in (('volume', volume), ('price', price)):
+        try:
+            encode_decimal(value)
+        except ValueError as e:
+            raise BadRequest(f'invalid {name}: {e}')
     order = Order(
-        id=uuid.uuid4(),
+        id=uuid7(),
         user_id=flask_session['user_id'],
         side=OrderSide(data['side']),
         volume=volume,
@@ -59,23 +70,48 @@ def place_order():
         price=price,
         pair=data['pair'],
     )
-    from ..order_book.mq import enqueue_place_order
     from flask import current_app
-    enqueue_place_order(current_app, order)
+    if data.get('sync'):
+        # Wait for the order book to tell whether the order was accepted,
+        # and how it was filled right away.
+        from ..order_book.mq import request_place_order
+        reply = request_place_order(current_app, order, trace=trace)
+        record_trace(trace)
+        if reply is None:
+            raise GatewayTimeout()
+        return jsonify(reply)
+    from ..order_book.mq import enqueue_place_order
+    enqueue_place_order(current_app, order, trace=trace)
+    record_trace(trace)
     return jsonify()
 
 
+@bp_order.route('/', methods=['GET'])
+@login_required
+def fetch_open_orders():
+    pair = request.values.get('pair')
+    if pair:
+        pairs = [pair]
+    else:
+        pairs = [p for p, in session.query(Market.pair)]
+    from ..order_book.mq import request_open_orders
+    from flask import current_app
+    replies = request_open_orders(current_app, current_user.id, pairs)
+    if len(replies) < len(pairs):
+        raise GatewayTimeout()
+    return jsonify(list(itertools.chain.from_iterable(replies.values())))
+
+
 @bp_order.route('/', methods=['DELETE'])
 @login_required
 def delete_orders():
-    payload = request.get_json()
-    pair = payload['pair']
-    from ..order_book.mq import enqueue_delete_order
-    orders = session.query(Order).filter(
-        Order.active,
-        Order.user == current_user,
-        Order.pair == pair,
-    )
+    payload = request.get_json(silent=True) or {}
+    pair = payload.get('pair')
+    if pair:
+        pairs = [pair]
+    else:
+        pairs = [p for p, in session.query(Market.pair)]
+    from ..order_book.mq import enqueue_cancel_all_orders
     from flask import current_app
-    enqueue_delete_order(current_app, orders)
+    enqueue_cancel_all_orders(current_app, current_user.id, pairs)
     return jsonify()
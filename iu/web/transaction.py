@@ -16,6 +16,8 @@ bp_transaction = Blueprint('transaction', __name__, url_prefix='/transactions')
 def fetch_transactions():
     payload = request.values
     types = [TransactionType(type_) for type_ in payload.getlist('types[]')]
+    if TransactionType.trade in types:
+        types.append(TransactionType.ledger)
     currency = payload.get('currency')
     transactions = session.query(Transaction).filter(
         Transaction.user == current_user,
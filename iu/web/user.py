@@ -4,10 +4,10 @@ from typing import Optional
 from flask import Blueprint, jsonify, request
 from flask_login.login_manager import LoginManager
 from flask_login.utils import current_user, login_user, logout_user
-from typeguard import typechecked
 
 from ..context import session
 from ..serializer import serialize
+from ..typecheck import typechecked
 from ..user import User
 
 bp_user = Blueprint('user', __name__, url_prefix='/users')
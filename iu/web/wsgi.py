@@ -3,13 +3,14 @@ import json
 from typing import Any, Mapping
 
 from flask import Flask, send_from_directory
-from typeguard import typechecked
+from flask_migrate import Migrate
 from websockets import connect
 from werkzeug.wrappers import Response
 
 from ..context import session, websocket_messages
-from ..orm import Base, migrate
+from ..orm import Base
 from ..serializer import serialize
+from ..typecheck import typechecked
 from .balance import bp_balance
 from .candle import bp_candle
 from .currency import bp_currency
@@ -18,6 +19,9 @@ from .transaction import bp_transaction
 from .user import bp_user, login_manager
 
 
+migrate = Migrate()
+
+
 class JSONEncoder(json.JSONEncoder):
 
     def default(self, o):
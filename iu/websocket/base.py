@@ -1,10 +1,10 @@
 from dataclasses import dataclass
 from typing import Mapping, Optional, Tuple, Union
 
-from typeguard import typechecked
 from websockets import WebSocketServerProtocol
 
 from ..orm import SessionType, create_session
+from ..typecheck import typechecked
 from ..web.wsgi import create_wsgi_app
 
 
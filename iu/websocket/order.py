@@ -1,6 +1,7 @@
 import asyncio
 import datetime
 from dataclasses import dataclass, field
+import functools
 import itertools
 import json
 import time
@@ -8,17 +9,22 @@ import traceback
 from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Set
 
 from flask_login.utils import current_user
-from sqlalchemy.sql.functions import rank, sum as sqlsum
-from typeguard import typechecked
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import true
+from sqlalchemy.sql.functions import sum as sqlsum
 from websockets.exceptions import ConnectionClosed
 from websockets.server import WebSocketServerProtocol
 
 from ..balance import Balance
 from ..candle import Candle
 from ..market import Market
+from ..memory import MemoryTracker
 from ..order import Order, OrderSide
+from ..order_book.depth import DEFAULT_DIRECTORY, DepthSegment
 from ..serializer import serialize
+from ..trace import Trace, record_trace, stamp
 from ..trade import Trade
+from ..typecheck import typechecked
 from .base import BaseWebSocketServer
 
 
@@ -27,6 +33,7 @@ class Client:
     websocket: WebSocketServerProtocol
     user_id: Optional[str] = None
     market: Optional[str] = None
+    bbo_markets: Set[str] = field(default_factory=set)
 
     def __hash__(self):
         return self.websocket.__hash__()
@@ -45,12 +52,15 @@ class OrderWebSocketServer(BaseWebSocketServer):
     trade_lock_time = 0
     trade_locks: Optional[Sequence[Dict[str, Any]]] = None
     market_clients_map: Dict[str, Set[Client]] = field(default_factory=dict)
+    bbo_clients_map: Dict[str, Set[Client]] = field(default_factory=dict)
+    bbo_cache: Dict[str, Mapping[str, Any]] = field(default_factory=dict)
     user_id_client_map: Dict[str, Set[Client]] = field(default_factory=dict)
     anonymous_clients: Set[Client] = field(default_factory=set)
     markets_cache: Dict[str, Dict[str, Any]] = field(default_factory=dict)
     trades_cache: Dict[str, List[Mapping[str, Any]]] = field(
         default_factory=dict,
     )
+    depth_segments: Dict[str, DepthSegment] = field(default_factory=dict)
 
     def __enter__(self):
         rv = super().__enter__()
@@ -59,8 +69,11 @@ class OrderWebSocketServer(BaseWebSocketServer):
         self.market_locks = None
         self.trade_locks = None
         self.market_clients_map = {}
+        self.bbo_clients_map = {}
+        self.bbo_cache = {}
         self.user_id_client_map = {}
         self.anonymous_clients = set()
+        self.depth_segments = {}
         print('Caching markets…')
         self.markets_cache = self.get_markets()
         print('Caching trades…')
@@ -101,6 +114,11 @@ class OrderWebSocketServer(BaseWebSocketServer):
                 self.market_clients_map[client.market].remove(client)
             except KeyError:
                 pass
+        for market in client.bbo_markets:
+            try:
+                self.bbo_clients_map[market].remove(client)
+            except KeyError:
+                pass
 
     @typechecked
     async def send(
@@ -151,22 +169,103 @@ class OrderWebSocketServer(BaseWebSocketServer):
 
     @typechecked
     def get_trades(self, *, count: int) -> Dict[str, List[Mapping[str, Any]]]:
-        _rank = rank().over(
-            partition_by=Trade.pair,
-            order_by=(Trade.created_at.desc(), Trade.index.desc()),
+        # The latest trades of each market come from a backward scan of
+        # ix_trade_sort, where ranking all trades would read the whole table.
+        latest = self.session.query(Trade).filter(
+            Trade.base_currency == Market.base_currency,
+            Trade.quote_currency == Market.quote_currency,
+        ).order_by(
+            Trade.created_at.desc(), Trade.index.desc(),
+        ).limit(count).subquery().lateral()
+        latest_trade = aliased(Trade, latest)
+        query = self.session.query(latest_trade).select_from(Market).join(
+            latest, true(),
+        ).order_by(
+            Market.base_currency,
+            Market.quote_currency,
+            latest_trade.created_at.desc(),
+            latest_trade.index.desc(),
         )
-        query = self.session.query(
-            Trade, _rank
-        ).from_self().order_by(Trade.pair, _rank).filter(_rank <= count)
         trades = {}
-        for trade, _rank in query:
+        for trade in query:
             trades.setdefault(trade.pair, []).append(serialize(trade))
         trades = {pair: list(reversed(t)) for pair, t in trades.items()}
         return trades
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for segment in self.depth_segments.values():
+            segment.close()
+        self.depth_segments = {}
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+    @typechecked
+    def track_structures(self, tracker: MemoryTracker) -> None:
+        """Let ``tracker`` count the caches and client maps, which live as
+        long as the server.
+
+        """
+        tracker.track('trades_cache', lambda: sum(
+            len(trades) for trades in list(self.trades_cache.values())
+        ))
+        tracker.track('markets_cache', lambda: len(self.markets_cache))
+        tracker.track('bbo_cache', lambda: len(self.bbo_cache))
+        tracker.track('order_locks', lambda: len(self.order_locks))
+        tracker.track('depth_segments', lambda: len(self.depth_segments))
+        tracker.track('anonymous_clients', lambda: len(self.anonymous_clients))
+        for name in (
+            'user_id_client_map', 'market_clients_map', 'bbo_clients_map',
+        ):
+            tracker.track(
+                name, functools.partial(self.count_clients, name),
+            )
+
+    @typechecked
+    def count_clients(self, name: str) -> int:
+        clients_map = getattr(self, name)
+        return sum(len(clients) for clients in list(clients_map.values()))
+
+    @typechecked
+    def get_depth_segment(self, pair: str) -> Optional[DepthSegment]:
+        config = self.app.config['APP_CONFIG'].get('order_book', {})
+        if not config.get('depth_segment'):
+            return None
+        segment = self.depth_segments.get(pair)
+        if not segment:
+            try:
+                segment = DepthSegment.open(
+                    pair,
+                    directory=config.get('depth_directory', DEFAULT_DIRECTORY),
+                )
+            except (FileNotFoundError, ValueError):
+                return None
+            self.depth_segments[pair] = segment
+        return segment
+
     @typechecked
     def get_order_book(self, pair: str) -> Mapping[str, List[List[str]]]:
         limit = 8
+        config = self.app.config['APP_CONFIG'].get('order_book', {})
+        max_age = config.get('depth_max_age', 5)
+        segment = self.get_depth_segment(pair)
+        snapshot = segment.read() if segment else None
+        if snapshot and time.time() - snapshot.updated_at > max_age:
+            # The order book has stopped or stalled; query the database
+            # instead, and open the segment anew next time, as a restarted
+            # order book creates another file.
+            segment.close()
+            del self.depth_segments[pair]
+            snapshot = None
+        if snapshot:
+            return {
+                'buy': [
+                    [serialize(p), serialize(v)]
+                    for p, v in snapshot.buy[:limit]
+                ],
+                'sell': [
+                    [serialize(p), serialize(v)]
+                    for p, v in snapshot.sell[:limit]
+                ],
+            }
         query = self.session.query(
             Order.price, sqlsum(Order.remaining_volume)
         ).filter(
@@ -223,6 +322,9 @@ class OrderWebSocketServer(BaseWebSocketServer):
                 if payload['type'] == 'subscribeMarket':
                     market = payload['data']
                     await self.subscribe_market(client, market)
+                elif payload['type'] == 'subscribeBbo':
+                    market = payload['data']
+                    await self.subscribe_bbo(client, market)
         except ConnectionClosed:
             pass
         finally:
@@ -243,11 +345,21 @@ class OrderWebSocketServer(BaseWebSocketServer):
             ),
         ])
 
+    @typechecked
+    async def subscribe_bbo(self, client: Client, market: str):
+        self.bbo_clients_map.setdefault(market, set()).add(client)
+        client.bbo_markets.add(market)
+        bbo = self.bbo_cache.get(market)
+        if bbo:
+            await self.send([client], 'bbo', bbo, silent=False)
+
     def select_publisher(self, type_):
         return {
             'balance': self.publish_balance,
+            'bbo': self.publish_bbo,
             'market': self.publish_market,
             'order': self.publish_order,
+            'orderStatus': self.publish_order_status,
             'trade': self.publish_trade,
         }.get(type_)
 
@@ -269,9 +381,17 @@ class OrderWebSocketServer(BaseWebSocketServer):
                 if not publisher:
                     print(payload)
                     continue
-                futures.append(publisher(data))
+                future = publisher(data)
+                if 'trace' in payload:
+                    future = self.trace_published(future, payload['trace'])
+                futures.append(future)
             await asyncio.gather(*futures)
 
+    async def trace_published(self, future, trace: Trace):
+        await future
+        stamp(trace, 'published')
+        record_trace(trace)
+
     @typechecked
     async def publish_balance(self, data: Mapping[str, Mapping[str, Any]]):
         if self.balance_locks is not None:
@@ -340,6 +460,30 @@ class OrderWebSocketServer(BaseWebSocketServer):
         if require_publish:
             await self.publish_order(require_publish)
 
+    @typechecked
+    async def publish_bbo(self, data: Mapping[str, Any]):
+        # Sent as soon as it arrives; there is no lock time to conflate it.
+        self.bbo_cache[data['pair']] = data
+        clients = self.bbo_clients_map.get(data['pair'])
+        if clients:
+            await self.send(clients, 'bbo', data, silent=True)
+
+    @typechecked
+    async def publish_order_status(
+        self, data: Mapping[str, Sequence[Mapping[str, Any]]],
+    ):
+        # Unlike books and balances, every event matters to the owner, so
+        # they are never conflated.
+        futures = []
+        for user_id, events in data.items():
+            clients = self.user_id_client_map.get(user_id)
+            if clients:
+                futures.append(
+                    self.send(clients, 'orderStatus', events, silent=True)
+                )
+        if futures:
+            await asyncio.wait(futures)
+
     @typechecked
     async def publish_trade(self, data: Sequence[Mapping[str, Any]]):
         if self.trade_locks is not None:
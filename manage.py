@@ -4,8 +4,8 @@ from flask import Flask
 from flask_migrate import MigrateCommand
 from flask_script import Manager
 from toml import load
-from typeguard import typechecked
 
+from iu.typecheck import typechecked
 from iu.web.wsgi import create_wsgi_app
 
 
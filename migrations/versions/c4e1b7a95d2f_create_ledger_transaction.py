@@ -0,0 +1,43 @@
+"""Create LedgerTransaction
+
+Revision ID: c4e1b7a95d2f
+Revises: a3772c7ab76c
+Create Date: 2020-02-03 21:14:52.402116
+
+"""
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.schema import Column
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1b7a95d2f'
+down_revision = 'a3772c7ab76c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE transaction_type ADD VALUE 'ledger'")
+    op.add_column(
+        'transaction', Column('trade_id', UUID(), nullable=True),
+    )
+    op.create_foreign_key(
+        op.f('fk_transaction_trade_id_trade'),
+        'transaction', 'trade', ['trade_id'], ['id'],
+    )
+    op.create_index(
+        op.f('ix_transaction_trade_id'), 'transaction', ['trade_id'],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.execute("DELETE FROM transaction WHERE type = 'ledger'")
+    op.drop_index(op.f('ix_transaction_trade_id'), table_name='transaction')
+    op.drop_constraint(
+        op.f('fk_transaction_trade_id_trade'), 'transaction',
+        type_='foreignkey',
+    )
+    op.drop_column('transaction', 'trade_id')
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import argparse
+import pathlib
+import time
+
+import toml
+
+from iu.order_book.app import create_engine_app
+from iu.order_book.capture import replay_captures
+from iu.order_book.mq import get_transport
+
+parser = argparse.ArgumentParser(
+    description='Publish the commands of capture files to the order book '
+                'queues again.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument('-c', '--config', type=pathlib.Path)
+parser.add_argument('--speed', type=float, default=1.0,
+                    help='times as fast as the commands arrived; '
+                         '0 publishes them as fast as possible')
+parser.add_argument('captures', type=pathlib.Path, nargs='+')
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.config) as f:
+        app = create_engine_app(toml.load(f))
+    started = time.monotonic()
+    with get_transport(app) as transport:
+        count = replay_captures(transport, args.captures, speed=args.speed)
+    elapsed = time.monotonic() - started
+    print(
+        f'Replayed {count} commands in {elapsed:.3f}s: '
+        f'{count / elapsed if elapsed else 0:.0f} commands/s'
+    )
+
+
+if __name__ == '__main__':
+    main()
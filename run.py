@@ -2,12 +2,15 @@
 from gevent.monkey import patch_all  # noqa
 patch_all()  # noqa
 import argparse
+import logging
 import os
 import pathlib
 
 from toml import load as toml_load
 from gevent.pywsgi import WSGIServer
 
+from iu.metrics import serve_metrics
+from iu.order_book.mq import close_transport_pool
 from iu.web.wsgi import create_wsgi_app
 
 parser = argparse.ArgumentParser(
@@ -26,13 +29,22 @@ def main():
     with open(args.config) as f:
         config = toml_load(f)
     app = create_wsgi_app(config)
-    if args.debug:
-        app.run(
-            host=args.host, port=args.port, debug=args.debug, threaded=True,
-        )
-    else:
-        server = WSGIServer((args.host, args.port), app)
-        server.serve_forever()
+    # Modules log through handlers of their own; e.g. traces are logged
+    # at INFO.
+    logging.getLogger().setLevel(logging.INFO)
+    if app.config.get('METRICS_PORT'):
+        serve_metrics(('127.0.0.1', app.config['METRICS_PORT']))
+    try:
+        if args.debug:
+            app.run(
+                host=args.host, port=args.port, debug=args.debug,
+                threaded=True,
+            )
+        else:
+            server = WSGIServer((args.host, args.port), app)
+            server.serve_forever()
+    finally:
+        close_transport_pool(app)
 
 
 if __name__ == '__main__':
@@ -10,6 +10,8 @@ import toml
 
 from iu.blockchain.bitcoin import BitcoinBlockchain
 from iu.blockchain.ethereum import EthereumBlockchain
+from iu.memory import MemoryTracker, create_memory_command
+from iu.metrics import serve_metrics
 from iu.web.wsgi import create_wsgi_app
 
 parser = argparse.ArgumentParser(
@@ -63,6 +65,19 @@ def main():
         currency = 'BTC'
     thread = BlockchainThread(app, currency)
     thread.start()
+    metrics_port = config.get('blockchain', {}).get(args.currency, {}).get(
+        'metrics_port',
+    )
+    if metrics_port:
+        tracker = MemoryTracker()
+        tracker.track(
+            'blocks',
+            lambda: len(thread.blockchain.blocks) if thread.blockchain else 0,
+        )
+        serve_metrics(
+            ('127.0.0.1', metrics_port),
+            commands={'memory': create_memory_command(tracker)},
+        )
     while thread.is_alive():
         try:
             thread.join(1)
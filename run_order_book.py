@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 import argparse
+import contextlib
+import functools
+import logging
 import time
 import threading
 import pathlib
 
 import toml
-import traceback
 
+from iu.memory import MemoryTracker, create_memory_command
+from iu.metrics import serve_metrics
+from iu.order_book.app import create_engine_app
+from iu.order_book.balance import BalanceService
 from iu.order_book.book import OrderBook
-from iu.web.wsgi import create_wsgi_app
+from iu.order_book.publisher import create_websocket_publisher
+from iu.profiler import profile_thread
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -18,53 +28,148 @@ parser.add_argument('-c', '--config', type=pathlib.Path)
 
 class OrderBookThread(threading.Thread):
 
-    def __init__(self, app, pair: str):
+    def __init__(
+        self, app, pair: str, balance_service=None, publisher=None,
+    ):
         super().__init__()
         self.app = app
         self.pair = pair
+        self.balance_service = balance_service
+        self.publisher = publisher
         self.alive = True
         self.order_book = None
 
     def kill(self):
         self.alive = False
-        if self.order_book.mq_channel:
-            self.order_book.mq_channel.cancel()
+        if self.order_book.transport:
+            self.order_book.transport.cancel()
+
+    def create_order_book(self) -> OrderBook:
+        return OrderBook(
+            self.app,
+            balance_service=self.balance_service,
+            publisher=self.publisher,
+        )
 
     def run(self):
-        self.order_book = OrderBook(self.app)
+        self.order_book = self.create_order_book()
         while self.alive:
             try:
                 with self.order_book.context(self.pair):
                     self.order_book.run()
             except Exception:
-                print('closing')
-                traceback.print_exc()
+                logger.exception(
+                    f'Market: {self.pair}; restarting after an error'
+                )
                 time.sleep(1)
 
 
+def create_profile_command(threads, directory: str):
+    """Return the ``profile`` admin command, which samples the stack of the
+    thread of a market, e.g.::
+
+        curl -X POST 'http://127.0.0.1:9101/profile?pair=BTC/USDT&seconds=10'
+
+    """
+    def profile(parameters):
+        pair = parameters['pair']
+        for thread in threads:
+            if thread.pair == pair and thread.is_alive():
+                break
+        else:
+            raise ValueError(f'no order book thread for {pair}')
+        path = profile_thread(
+            thread.ident,
+            directory,
+            pair.replace('/', '-').lower(),
+            seconds=float(parameters.get('seconds', 10)),
+            interval=float(parameters.get('interval', 0.005)),
+        )
+        return f'{path}\n'
+    return profile
+
+
+#: Counts of the objects in each structure an order book keeps.
+ORDER_BOOK_STRUCTURES = {
+    'orders': lambda book: len(book.buy_orders) + len(book.sell_orders),
+    'order_ids': lambda book: len(book.order_ids),
+    'completed_order_ids': lambda book: (
+        len(book.completed_order_ids.current) +
+        len(book.completed_order_ids.previous)
+    ),
+    'user_orders': lambda book: sum(
+        len(orders) for orders in list(book.user_orders.values())
+    ),
+    'candles': lambda book: len(book.candles or {}),
+}
+
+
+def count_order_book_structure(thread: OrderBookThread, count) -> int:
+    if thread.order_book is None:
+        return 0
+    return count(thread.order_book)
+
+
+def track_order_books(tracker: MemoryTracker, threads, publisher):
+    for thread in threads:
+        for name, count in ORDER_BOOK_STRUCTURES.items():
+            tracker.track(
+                f'{thread.pair} {name}',
+                functools.partial(count_order_book_structure, thread, count),
+            )
+    tracker.track('publisher pending', lambda: len(publisher.pending))
+
+
 def main():
     args = parser.parse_args()
     with open(args.config) as f:
         config = toml.load(f)
-    app = create_wsgi_app(config)
+    app = create_engine_app(config)
+    # Modules log through handlers of their own; e.g. traces are logged
+    # at INFO.
+    logging.getLogger().setLevel(logging.INFO)
+    order_book_config = config.get('order_book', {})
+    balance_service = None
+    if order_book_config.get('balance_service'):
+        balance_service = BalanceService(
+            app, partitions=order_book_config.get('balance_partitions', 4),
+        )
     if True:
         from iu.market import Market
         from iu.orm import create_session
 
         session = create_session(app)
         pairs = [pair for pair, in session.query(Market.pair)]
-        threads = []
-        for pair in pairs:
-            thread = OrderBookThread(app, pair)
-            thread.start()
-            threads.append(thread)
-        while any(t.isAlive() for t in threads):
-            try:
-                for t in threads:
-                    t.join()
-            except KeyboardInterrupt:
-                for t in threads:
-                    t.kill()
+        with balance_service or contextlib.nullcontext(), \
+                create_websocket_publisher(app) as publisher:
+            threads = []
+            for pair in pairs:
+                thread = OrderBookThread(
+                    app, pair, balance_service, publisher,
+                )
+                thread.start()
+                threads.append(thread)
+            if order_book_config.get('metrics_port'):
+                profile_directory = order_book_config.get(
+                    'profile_directory', '/tmp',
+                )
+                profile = create_profile_command(threads, profile_directory)
+                tracker = MemoryTracker()
+                track_order_books(tracker, threads, publisher)
+                serve_metrics(
+                    ('127.0.0.1', order_book_config['metrics_port']),
+                    commands={
+                        'profile': profile,
+                        'memory': create_memory_command(tracker),
+                    },
+                )
+            while any(t.isAlive() for t in threads):
+                try:
+                    for t in threads:
+                        t.join()
+                except KeyboardInterrupt:
+                    for t in threads:
+                        t.kill()
         return
     run_order_book_forever(app)
 
@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
+import logging
 import os
 import pathlib
 
 import toml
 from websockets import serve
 
+from iu.memory import MemoryTracker, create_memory_command
+from iu.metrics import serve_metrics
 from iu.websocket.order import OrderWebSocketServer
 
 parser = argparse.ArgumentParser(
@@ -23,7 +26,18 @@ def main():
     args = parser.parse_args()
     with open(args.config) as f:
         config = toml.load(f)
+    # Modules log through handlers of their own; e.g. traces are logged
+    # at INFO.
+    logging.getLogger().setLevel(logging.INFO)
+    metrics_port = config.get('websocket', {}).get('metrics_port')
     with OrderWebSocketServer(config) as server:
+        if metrics_port:
+            tracker = MemoryTracker()
+            server.track_structures(tracker)
+            serve_metrics(
+                ('127.0.0.1', metrics_port),
+                commands={'memory': create_memory_command(tracker)},
+            )
         trade_server = serve(
             server, args.host, args.port,
             process_request=server.process_request,
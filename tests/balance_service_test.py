@@ -0,0 +1,179 @@
+import decimal
+import time
+import uuid
+
+import ormeasy.sqlalchemy
+from flask import Flask
+from pytest import fixture, raises
+from sqlalchemy import create_engine
+
+from iu.balance import Balance
+from iu.currency import Currency
+from iu.exc import NotEnoughBalance
+from iu.order_book.balance import BalanceService
+from iu.orm import Base, create_session
+from iu.user import User
+
+
+user_ids = [uuid.UUID(int=1), uuid.UUID(int=2)]
+zero = decimal.Decimal(0)
+
+
+@fixture
+def fx_balance_app(fx_wsgi_app: Flask) -> Flask:
+    """Partitions have sessions of their own, so the fixtures are committed
+    for real."""
+    url = fx_wsgi_app.config['APP_CONFIG']['database']['url']
+    # Not imported by name, or it would be collected as a test.
+    with ormeasy.sqlalchemy.test_connection(
+        fx_wsgi_app, Base.metadata, create_engine(url), real_transaction=True,
+    ):
+        session = create_session(fx_wsgi_app)
+        for currency in ('BTC', 'USDT'):
+            session.add(Currency(
+                id=currency, name=currency, decimals=8, confirmations=1,
+                minimum_deposit_amount=decimal.Decimal('0.001'),
+                minimum_withdrawal_amount=decimal.Decimal('0.001'),
+                withdrawal_fee=decimal.Decimal('0.0005'),
+                latest_synced_block_number=0,
+            ))
+        for user_id in user_ids:
+            session.add(User(
+                id=user_id, email=f'user-{user_id.int}@iu.exchange',
+                password='iu-exchange!',
+            ))
+        session.flush()
+        session.execute(Balance.__table__.insert(), [{
+            'user_id': user_ids[0], 'currency': 'USDT',
+            'amount': decimal.Decimal(100), 'locked_amount': 0,
+        }])
+        session.commit()
+        session.close()
+        yield fx_wsgi_app
+
+
+def get_balances(app):
+    session = create_session(app)
+    try:
+        return {
+            (user_id, currency): (amount, locked_amount)
+            for user_id, currency, amount, locked_amount in session.query(
+                Balance.user_id, Balance.currency,
+                Balance.amount, Balance.locked_amount,
+            )
+        }
+    finally:
+        session.close()
+
+
+def test_balance_service_reserve_settle_release(fx_balance_app: Flask):
+    usdt = (user_ids[0], 'USDT')
+    with BalanceService(fx_balance_app, partitions=2) as service:
+        # The users live on different partitions.
+        assert service.partition_of(user_ids[0]) is not \
+            service.partition_of(user_ids[1])
+        reserved = service.apply({usdt: (zero, decimal.Decimal(60))})
+        assert reserved[usdt]['locked_amount'] == 60
+        with raises(NotEnoughBalance):
+            service.apply({usdt: (zero, decimal.Decimal(50))})
+        settled = service.apply(
+            {
+                usdt: (decimal.Decimal(-60), decimal.Decimal(-60)),
+                (user_ids[1], 'USDT'): (decimal.Decimal(60), zero),
+            },
+            check=False,
+        )
+        assert settled[usdt]['amount'] == 40
+        assert settled[usdt]['locked_amount'] == 0
+        assert settled[user_ids[1], 'USDT']['amount'] == 60
+        service.apply({usdt: (zero, decimal.Decimal(40))})
+        released = service.apply({usdt: (zero, decimal.Decimal(-40))})
+        assert released[usdt]['locked_amount'] == 0
+    assert get_balances(fx_balance_app) == {
+        usdt: (40, 0),
+        (user_ids[1], 'USDT'): (60, 0),
+    }
+
+
+def test_balance_service_rollback(fx_balance_app: Flask, monkeypatch):
+    usdt = (user_ids[0], 'USDT')
+    with BalanceService(fx_balance_app, partitions=2) as service:
+        with raises(NotEnoughBalance):
+            service.apply({
+                usdt: (zero, decimal.Decimal(10)),
+                (user_ids[1], 'BTC'): (zero, decimal.Decimal(1)),
+            })
+        assert service.apply({usdt: (zero, zero)})[usdt]['locked_amount'] == 0
+
+        def fail(changes, *, check=True, order_ids=()):
+            raise RuntimeError('partition failed')
+        monkeypatch.setattr(
+            service.partition_of(user_ids[1]), 'apply', fail,
+        )
+        with raises(RuntimeError):
+            service.apply({
+                usdt: (zero, decimal.Decimal(10)),
+                (user_ids[1], 'USDT'): (zero, decimal.Decimal(1)),
+            })
+        assert service.apply({usdt: (zero, zero)})[usdt]['locked_amount'] == 0
+    assert get_balances(fx_balance_app) == {usdt: (100, 0)}
+
+
+def test_balance_service_flush(fx_balance_app: Flask):
+    usdt = (user_ids[0], 'USDT')
+    with BalanceService(
+        fx_balance_app, partitions=1, flush_interval=0.05,
+    ) as service:
+        # Keep the partition busy, so that its queue is never idle for a
+        # whole flush interval.
+        deadline = time.monotonic() + 0.5
+        applied = 0
+        while time.monotonic() < deadline:
+            service.apply({usdt: (decimal.Decimal(1), zero)})
+            applied += 1
+        amount, _ = get_balances(fx_balance_app)[usdt]
+        assert 100 < amount <= 100 + applied
+    assert get_balances(fx_balance_app)[usdt] == (100 + applied, 0)
+
+
+def test_balance_service_withdrawal(fx_balance_app: Flask):
+    usdt = (user_ids[0], 'USDT')
+    with BalanceService(fx_balance_app, partitions=1) as service:
+        service.apply({usdt: (zero, decimal.Decimal(10))})
+        # A withdrawal locks funds in the table while the partition holds
+        # the entry, like transaction_before_flush() does.
+        session = create_session(fx_balance_app)
+        table = Balance.__table__
+        session.execute(table.update().where(
+            (table.c.user_id == user_ids[0]) & (table.c.currency == 'USDT')
+        ).values(locked_amount=table.c.locked_amount + 50))
+        session.commit()
+        session.close()
+        with raises(NotEnoughBalance):
+            service.apply({usdt: (zero, decimal.Decimal(60))})
+        service.apply({usdt: (zero, decimal.Decimal(40))})
+    assert get_balances(fx_balance_app) == {usdt: (100, 100)}
+
+
+def test_balance_service_refused_flush(fx_balance_app: Flask, caplog):
+    usdt = (user_ids[0], 'USDT')
+    btc = (user_ids[1], 'BTC')
+    order_id = uuid.uuid4()
+    with BalanceService(
+        fx_balance_app, partitions=1, flush_interval=0.01,
+    ) as service:
+        service.apply(
+            {
+                usdt: (decimal.Decimal(5), zero),
+                btc: (decimal.Decimal(-1), zero),
+            },
+            check=False, order_ids=[order_id],
+        )
+        time.sleep(0.1)
+        # The other balances are not held up.
+        assert get_balances(fx_balance_app) == {usdt: (105, 0)}
+        service.apply({btc: (decimal.Decimal(2), zero)}, check=False)
+    assert get_balances(fx_balance_app) == {usdt: (105, 0), btc: (1, 0)}
+    refused = [r for r in caplog.records if 'refused' in r.getMessage()]
+    assert len(refused) == 1
+    assert str(order_id) in refused[0].getMessage()
@@ -0,0 +1,245 @@
+import collections
+import datetime
+import decimal
+import uuid
+from typing import Any, Mapping
+
+import ormeasy.sqlalchemy
+from flask import Flask
+from sqlalchemy import create_engine
+
+from benchmarks.dataset import (
+    COLUMNS, create_user_ids, format_value, generate_market,
+)
+from benchmarks.matching import (
+    NullSession, StubbedOrderBook, generate_flow, get_depth_bucket,
+    run_benchmark,
+)
+from benchmarks.micro import CASES, measure
+from benchmarks.recovery import FAULTS, create_commands, run_recovery
+from iu.candle import CandleUnitType
+from iu.market import Market
+from iu.order import OrderSide
+from iu.order_book.app import EngineApp
+from iu.orm import Base
+
+
+def summarize(events):
+    return [
+        (
+            event.at,
+            event.cancel_id,
+            event.order and (
+                event.order.id, event.order.side, event.order.volume,
+                event.order.price,
+            ),
+        )
+        for event in events
+    ]
+
+
+def test_generate_flow():
+    events = list(generate_flow(1, 1000, cancel_ratio=0.2))
+    same = generate_flow(1, 1000, cancel_ratio=0.2)
+    other = generate_flow(2, 1000, cancel_ratio=0.2)
+    assert summarize(events) == summarize(same)
+    assert summarize(events) != summarize(other)
+    cancels = sum(event.order is None for event in events)
+    assert 100 < cancels < 300
+    assert all(event.order.volume > 0 for event in events if event.order)
+    assert all(a.at < b.at for a, b in zip(events, events[1:]))
+
+
+def test_get_depth_bucket():
+    assert get_depth_bucket(0) == '0-9'
+    assert get_depth_bucket(10) == '10-99'
+    assert get_depth_bucket(4321) == '1000-9999'
+
+
+def test_run_benchmark():
+    def run():
+        market = Market(
+            pair='BTC/USDT',
+            maker_fee=decimal.Decimal('0.001'),
+            taker_fee=decimal.Decimal('0.002'),
+            minimum_order_amount=decimal.Decimal(0),
+        )
+        order_book = StubbedOrderBook(
+            EngineApp({}), session=NullSession(), market=market,
+        )
+        result = run_benchmark(order_book, list(generate_flow(3, 2000)))
+        # Canceled volume leaves the merged depth.
+        for side, merged_orders in (
+            (OrderSide.buy, order_book.merged_buy_orders),
+            (OrderSide.sell, order_book.merged_sell_orders),
+        ):
+            resting = collections.Counter()
+            for order in side.choice(
+                buy=order_book.buy_orders, sell=order_book.sell_orders,
+            ):
+                resting[order.price] += order.remaining_volume
+            assert merged_orders == resting
+        return result
+
+    result = run()
+    assert result.orders + result.cancels <= 2000
+    assert result.trades
+    assert sum(h.count for h in result.latencies.values()) == result.orders
+    again = run()
+    assert (again.trades, again.traded_volume) == (
+        result.trades, result.traded_volume,
+    )
+
+
+def test_micro_cases():
+    for name, setup in CASES.items():
+        setup()()
+    assert 'serialized_merged_orders[1000]' in CASES
+    assert measure(CASES['OrderSide.choice'](), repeat=1) > 0
+
+
+def test_generate_market():
+    def generate(compact_ledger=False):
+        rows = collections.defaultdict(list)
+        result = generate_market(
+            'BTC/USDT',
+            lambda table, row: rows[table].append(
+                dict(zip(COLUMNS[table], row)),
+            ),
+            seed=1,
+            user_ids=create_user_ids(1, 20, 1500000000.0),
+            trades=500,
+            start=1500000000.0,
+            end=1500000000.0 + 2 * 24 * 60 * 60,
+            price=decimal.Decimal(10000),
+            maker_fee=decimal.Decimal('0.001'),
+            taker_fee=decimal.Decimal('0.002'),
+            open_orders=30,
+            compact_ledger=compact_ledger,
+        )
+        return result, rows
+
+    result, rows = generate()
+    assert result.trades == len(rows['trade']) == 500
+    assert result.orders == len(rows['order'])
+    again, same_rows = generate()
+    assert same_rows == rows
+    traded_at = [
+        (trade['created_at'], trade['index']) for trade in rows['trade']
+    ]
+    assert traded_at == sorted(set(traded_at))
+    assert traded_at[-1][0].timestamp() < 1500000000.0 + 2 * 24 * 60 * 60
+    trade_ids = {trade['id'] for trade in rows['trade']}
+    order_ids = {order['id'] for order in rows['order']}
+    assert all(
+        trade['buy_order_id'] in order_ids and
+        trade['sell_order_id'] in order_ids
+        for trade in rows['trade']
+    )
+    assert len(rows['transaction']) == 6 * len(rows['trade'])
+    assert {t['trade_id'] for t in rows['trade_transaction']} == trade_ids
+    # Trades move currencies between users, so the ledger nets to zero.
+    totals = collections.defaultdict(decimal.Decimal)
+    for transaction in rows['transaction']:
+        totals[transaction['currency']] += transaction['amount']
+    assert totals == {'BTC': 0, 'USDT': 0}
+    amounts = collections.defaultdict(decimal.Decimal)
+    for transaction in rows['transaction']:
+        amounts[
+            transaction['user_id'], transaction['currency']
+        ] += transaction['amount']
+    assert amounts == result.amounts
+    open_orders = [
+        order for order in rows['order']
+        if order['filled_at'] is None and order['canceled_at'] is None
+    ]
+    assert len(open_orders) == 30
+    assert sum(result.locked_amounts.values()) == sum(
+        order['remaining_volume'] * order['side'].choice(
+            buy=order['price'], sell=decimal.Decimal(1),
+        )
+        for order in open_orders
+    )
+    traded_volume = sum(trade['volume'] for trade in rows['trade'])
+    units = collections.defaultdict(decimal.Decimal)
+    for candle in rows['candle']:
+        assert candle['unit_type'] is CandleUnitType.minutes
+        assert candle['low'] <= candle['open'] <= candle['high']
+        assert candle['low'] <= candle['close'] <= candle['high']
+        assert candle['timestamp'].timestamp() % (candle['unit'] * 60) == 0
+        units[candle['unit']] += candle['volume']
+    assert len(units) == 10
+    assert set(units.values()) == {traded_volume}
+    compact, compact_rows = generate(compact_ledger=True)
+    assert compact.amounts == result.amounts
+    assert not compact_rows['trade_transaction']
+    assert len(compact_rows['transaction']) < len(rows['transaction'])
+
+
+def test_format_value():
+    assert format_value(None) == '\\N'
+    assert format_value(decimal.Decimal('1.50')) == '1.50'
+    assert format_value(b'$pbkdf2') == '\\\\x2470626b646632'
+    assert format_value(CandleUnitType.minutes) == 'minutes'
+    assert format_value(datetime.datetime(
+        2020, 1, 1, tzinfo=datetime.timezone.utc,
+    )) == '2020-01-01T00:00:00+00:00'
+
+
+def test_create_commands():
+    events = list(generate_flow(5, 300, users=3, cancel_ratio=0.3))
+    user_ids = [uuid.UUID(int=i + 1) for i in range(3)]
+    commands = create_commands(events, user_ids)
+    again = create_commands(events, user_ids)
+    assert len(commands) == len(events) + 3
+    assert [c['type'] for c in commands[-3:]] == ['cancelAll'] * 3
+    placed = {}
+    for event, command, other in zip(events, commands, again):
+        if event.order is None:
+            assert command['order_ids'] == [placed[event.cancel_id]]
+            continue
+        order = command['order']
+        assert order.id != event.order.id
+        assert order.id != other['order'].id
+        assert (order.side, order.volume, order.price) == (
+            event.order.side, event.order.volume, event.order.price,
+        )
+        placed[event.order.id] = order.id
+
+
+def test_run_recovery(fx_wsgi_app: Flask, fx_config: Mapping[str, Any]):
+    url = fx_config['database']['url']
+    events = list(generate_flow(6, 120, users=4, aggressive_ratio=0.5))
+    user_ids = [uuid.UUID(int=i + 1) for i in range(4)]
+    engine = create_engine(url)
+    # Not imported by name, or it would be collected as a test.
+    with ormeasy.sqlalchemy.test_connection(
+        fx_wsgi_app, Base.metadata, engine, real_transaction=True,
+    ):
+        result = run_recovery(url, events, user_ids, every=15, timeout=60)
+        # A run leaves no open orders, so the flow can be run again.
+        again = run_recovery(
+            url, events, user_ids, faults=['unacked'], every=40, timeout=60,
+        )
+        balanced = run_recovery(
+            url, events, user_ids, every=15, balance_service=True, timeout=60,
+        )
+    assert not result.problems
+    assert result.commands == len(events) + len(user_ids)
+    assert {r.fault for r in result.recoveries} == set(FAULTS)
+    assert all(
+        r.injected_at <= r.ready_at <= r.resumed_at
+        for r in result.recoveries
+    )
+    assert result.redelivered
+    assert sum(result.outcomes.values()) == sum(
+        event.order is not None for event in events
+    )
+    assert not again.problems
+    assert {r.fault for r in again.recoveries} == {'unacked'}
+    assert not balanced.problems
+    assert {r.fault for r in balanced.recoveries} == set(FAULTS)
+    # Redelivered orders which are stored already, even by an order book
+    # which has been restarted since, are dropped as duplicates.
+    for run in (result, again, balanced):
+        assert 'rejected (conflict)' not in run.outcomes
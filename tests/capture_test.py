@@ -0,0 +1,88 @@
+import gzip
+import threading
+import time
+
+from pytest import raises
+
+from iu.order_book.capture import (
+    CaptureWriter, create_capture_writer, read_capture, replay_captures,
+)
+from iu.order_book.codec import JSON_CONTENT_TYPE
+from iu.order_book.mq import LocalTransport
+
+
+def test_capture_round_trip(tmpdir):
+    with create_capture_writer(str(tmpdir), 'BTC/USDT') as writer:
+        writer.write(1600000000.5, b'place', 'application/octet-stream')
+        writer.write(1600000001.25, b'{"type": "cancel"}', None)
+    assert writer.path.name.startswith('iu-capture-btc-usdt-')
+    first, second = read_capture(writer.path)
+    assert first.pair == second.pair == 'BTC/USDT'
+    assert first.arrived_at == 1600000000.5
+    assert first.body == b'place'
+    assert first.content_type == 'application/octet-stream'
+    assert second.arrived_at == 1600000001.25
+    assert second.body == b'{"type": "cancel"}'
+    assert second.content_type is None
+    # A capture cut short ends at its last complete record.
+    with gzip.open(writer.path, 'rb') as f:
+        data = f.read()
+    truncated = tmpdir / 'truncated.gz'
+    with gzip.open(str(truncated), 'wb') as f:
+        f.write(data[:-1])
+    assert [c.body for c in read_capture(str(truncated))] == [b'place']
+    with gzip.open(str(truncated), 'wb') as f:
+        f.write(b'not a capture')
+    with raises(ValueError):
+        list(read_capture(str(truncated)))
+
+
+def test_replay_captures(tmpdir):
+    directory = str(tmpdir)
+    paths = [str(tmpdir / 'btc.gz'), str(tmpdir / 'eth.gz')]
+    with CaptureWriter(paths[0], 'BTC/USDT') as writer:
+        writer.write(1.0, b'first', None)
+        writer.write(3.0, b'third', JSON_CONTENT_TYPE)
+    with CaptureWriter(paths[1], 'ETH/USDT') as writer:
+        writer.write(2.0, b'second', None)
+    received = []
+    order_books = []
+    threads = []
+
+    def consume(order_book, pair, listening):
+        with order_book:
+            consumer = order_book.consume(pair, inactivity_timeout=0.01)
+            for delivery in consumer:
+                listening.set()
+                if delivery is None:
+                    continue
+                received.append((delivery.body, delivery.content_type))
+                order_book.ack(delivery)
+
+    for pair in ('BTC/USDT', 'ETH/USDT'):
+        order_book = LocalTransport(directory)
+        listening = threading.Event()
+        thread = threading.Thread(
+            target=consume, args=(order_book, pair, listening),
+        )
+        thread.start()
+        order_books.append(order_book)
+        threads.append(thread)
+        assert listening.wait(1)
+    try:
+        with LocalTransport(directory) as gateway:
+            count = replay_captures(gateway, paths, speed=0)
+        assert count == 3
+        deadline = time.monotonic() + 1
+        while len(received) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(received) == [
+            (b'first', JSON_CONTENT_TYPE),
+            (b'second', JSON_CONTENT_TYPE),
+            (b'third', JSON_CONTENT_TYPE),
+        ]
+    finally:
+        for order_book in order_books:
+            order_book.cancel()
+        for thread in threads:
+            thread.join()
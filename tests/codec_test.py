@@ -0,0 +1,82 @@
+import decimal
+import uuid
+
+from pytest import mark, raises
+
+from iu.order import Order, OrderSide
+from iu.order_book.codec import (
+    BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, decode_command, encode_command,
+)
+from iu.order_book.util import decode_decimal, encode_decimal
+
+
+@mark.parametrize('encoding, content_type', [
+    ('json', JSON_CONTENT_TYPE),
+    ('binary', BINARY_CONTENT_TYPE),
+])
+def test_command_codec(encoding: str, content_type: str):
+    order = Order(
+        id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        side=OrderSide.sell,
+        volume=decimal.Decimal('1.5'),
+        remaining_volume=decimal.Decimal('0.000000000000000001'),
+        price=decimal.Decimal('12345678.9'),
+        base_currency='BTC',
+        quote_currency='USDT',
+    )
+    body, actual_content_type = encode_command(
+        {'type': 'place', 'order': order}, encoding=encoding,
+    )
+    assert actual_content_type == content_type
+    command = decode_command(body, content_type)
+    assert command['type'] == 'place'
+    decoded = command['order']
+    for attr in (
+        'id', 'user_id', 'side', 'volume', 'remaining_volume', 'price',
+        'base_currency', 'quote_currency',
+    ):
+        assert getattr(decoded, attr) == getattr(order, attr)
+    assert 'trace' not in command
+    trace = {'received': 1600000000.123456, 'enqueued': 1600000000.5}
+    body, _ = encode_command(
+        {'type': 'place', 'order': order, 'trace': trace}, encoding=encoding,
+    )
+    assert decode_command(body, content_type)['trace'] == trace
+    order_ids = [uuid.uuid4() for _ in range(3)]
+    body, _ = encode_command(
+        {'type': 'cancel', 'order_ids': order_ids}, encoding=encoding,
+    )
+    assert decode_command(body, content_type) == {
+        'type': 'cancel', 'order_ids': order_ids,
+    }
+    body, _ = encode_command(
+        {'type': 'cancelAll', 'user_id': order.user_id}, encoding=encoding,
+    )
+    assert decode_command(body, content_type) == {
+        'type': 'cancelAll', 'user_id': order.user_id,
+    }
+
+
+def test_decode_command_without_content_type():
+    user_id = uuid.uuid4()
+    body = f'{{"type": "openOrders", "user_id": "{user_id}"}}'.encode()
+    assert decode_command(body) == {'type': 'openOrders', 'user_id': user_id}
+
+
+def test_encode_decimal():
+    for value in (
+        decimal.Decimal('0.000000000000000001'),
+        decimal.Decimal('-12345678901234567.5'),
+        decimal.Decimal('123456789012345678.123456789012345678'),
+        decimal.Decimal('1.0000000000000000000000'),
+    ):
+        assert decode_decimal(encode_decimal(value)) == value
+    for value in (
+        decimal.Decimal('0.0000000000000000001'),
+        decimal.Decimal('12345678901234567890.1234567890123456789'),
+        decimal.Decimal('1e30'),
+        decimal.Decimal('NaN'),
+    ):
+        with raises(ValueError):
+            encode_decimal(value)
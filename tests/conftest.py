@@ -19,6 +19,14 @@ from iu.user import User
 from iu.web.wsgi import create_wsgi_app
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        '--plan-database-url',
+        help='database seeded at scale to check query plans against; '
+             'see tests/plan_test.py',
+    )
+
+
 @fixture
 @typechecked
 def fx_config() -> Mapping[str, Any]:
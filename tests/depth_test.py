@@ -0,0 +1,46 @@
+import decimal
+import time
+
+from iu.order_book.depth import DepthSegment
+
+
+def test_depth_segment(tmpdir):
+    sell = [
+        (decimal.Decimal('10000.5'), decimal.Decimal('0.000000000000000001')),
+        (decimal.Decimal('10001'), decimal.Decimal('25')),
+    ]
+    buy = [
+        (decimal.Decimal('9999'), decimal.Decimal('3')),
+        (decimal.Decimal('9000'), decimal.Decimal('15')),
+        (decimal.Decimal('8000'), decimal.Decimal('5')),
+    ]
+    directory = str(tmpdir)
+    with DepthSegment.create('BTC/USDT', capacity=2, directory=directory) \
+            as w, DepthSegment.open('BTC/USDT', directory=directory) as r:
+        snapshot = r.read()
+        assert snapshot.sell == snapshot.buy == []
+        assert snapshot.last_price is None
+        w.write(sell, buy, decimal.Decimal('10000'))
+        snapshot = r.read()
+        assert snapshot.sequence == 2
+        assert snapshot.sell == sell
+        assert snapshot.buy == buy[:2]
+        assert snapshot.last_price == decimal.Decimal('10000')
+
+
+def test_depth_segment_freshness(tmpdir):
+    directory = str(tmpdir)
+    w = DepthSegment.create('BTC/USDT', directory=directory)
+    with DepthSegment.open('BTC/USDT', directory=directory) as r:
+        assert r.read().updated_at == 0
+        w.write([], [], None)
+        written = r.read()
+        assert written.updated_at == w.updated_at
+        time.sleep(0.01)
+        w.touch()
+        touched = r.read()
+        assert touched.updated_at > written.updated_at
+        assert touched.sequence > written.sequence
+        w.close()
+        assert r.read().updated_at == 0
+    assert not tmpdir.listdir()
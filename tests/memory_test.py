@@ -0,0 +1,28 @@
+import tracemalloc
+
+from iu.memory import MemoryTracker, create_memory_command
+
+
+def test_memory_tracker():
+    cache = []
+    tracker = MemoryTracker()
+    tracker.track('cache', lambda: len(cache))
+    tracker.track('broken', lambda: 1 // 0)
+    memory = create_memory_command(tracker)
+    try:
+        report = memory({})
+        assert 'cache 0\n' in report
+        assert 'broken -1\n' in report
+        assert '# Started tracing allocations' in report
+        assert tracemalloc.is_tracing()
+        cache.extend(bytearray(1024) for _ in range(1000))
+        report = memory({'limit': '5'})
+        assert 'cache 1000\n' in report
+        top, growth = report.split('# Growth since the last report\n')
+        assert 'memory_test.py:' in top
+        assert 'memory_test.py:' in growth
+        assert len(growth.splitlines()) <= 5
+        assert memory({'stop': '1'}) == 'Stopped tracing allocations\n'
+        assert not tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,76 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from iu.metrics import Histogram, Registry, serve_metrics
+
+
+def test_histogram():
+    histogram = Histogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1e6)
+    histogram.record(0.5)
+    assert histogram.count == 1001
+    assert histogram.max == 0.5
+    percentiles = dict(histogram.get_percentiles([0.5, 0.99, 1.0]))
+    assert abs(percentiles[0.5] - 500e-6) <= 500e-6 / 64
+    assert abs(percentiles[0.99] - 991e-6) <= 991e-6 / 64
+    assert abs(percentiles[1.0] - 0.5) <= 0.5 / 64
+    assert len(histogram.counts) < 400
+
+
+def test_empty_histogram():
+    assert Histogram().get_percentiles([0.99]) == [(0.99, 0.0)]
+
+
+def test_registry_render():
+    registry = Registry()
+    registry.counter('commands_total', pair='BTC/USDT').increment(3)
+    histogram = registry.histogram('stage_seconds', stage='match')
+    assert registry.histogram('stage_seconds', stage='match') is histogram
+    histogram.record(0.001)
+    text = registry.render()
+    assert '# TYPE commands_total counter\n' in text
+    assert 'commands_total{pair="BTC/USDT"} 3\n' in text
+    assert '# TYPE stage_seconds summary\n' in text
+    assert 'stage_seconds{stage="match",quantile="0.99"} 0.001' in text
+    assert 'stage_seconds_count{stage="match"} 1\n' in text
+
+
+def test_serve_metrics():
+    registry = Registry()
+    registry.counter('commands_total').increment()
+    server = serve_metrics(('127.0.0.1', 0), registry)
+    try:
+        host, port = server.server_address
+        with urllib.request.urlopen(f'http://{host}:{port}/metrics') as r:
+            assert r.read().decode() == (
+                '# TYPE commands_total counter\ncommands_total 1\n'
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_serve_metrics_commands():
+    def echo(parameters):
+        return parameters['text']
+
+    server = serve_metrics(
+        ('127.0.0.1', 0), Registry(), commands={'echo': echo},
+    )
+    try:
+        host, port = server.server_address
+        url = f'http://{host}:{port}'
+        request = urllib.request.Request(f'{url}/echo?text=hi', method='POST')
+        with urllib.request.urlopen(request) as r:
+            assert r.read() == b'hi'
+        for path, status in [('/echo', 400), ('/unknown', 404)]:
+            request = urllib.request.Request(url + path, method='POST')
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(request)
+            assert e.value.code == status
+    finally:
+        server.shutdown()
+        server.server_close()
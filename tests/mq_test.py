@@ -0,0 +1,232 @@
+import decimal
+import json
+import pathlib
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import uuid
+
+from pytest import raises
+
+from iu.order import Order, OrderSide
+from iu.order_book.app import create_engine_app
+from iu.order_book.codec import JSON_CONTENT_TYPE, decode_command
+from iu.order_book.mq import (
+    LocalTransport, Transport, close_transport_pool, pack_frame,
+    request_place_order, unpack_frames,
+)
+
+
+def test_unpack_frames():
+    buffer = bytearray(
+        pack_frame(b'first', 'application/json', published_at=1600000000.5) +
+        pack_frame(b'second', correlation_id='1', reply_to='connection')
+    )
+    partial = pack_frame(b'third')
+    buffer.extend(partial[:-1])
+    first, second = unpack_frames(buffer)
+    assert first.body == b'first'
+    assert first.content_type == 'application/json'
+    assert first.correlation_id is None
+    assert first.published_at == 1600000000.5
+    assert second.body == b'second'
+    assert second.content_type is None
+    assert second.correlation_id == '1'
+    assert second.reply_to == 'connection'
+    assert second.published_at is None
+    assert buffer == partial[:-1]
+    buffer.extend(partial[-1:])
+    third, = unpack_frames(buffer)
+    assert third.body == b'third'
+    assert not buffer
+
+
+def test_transport_is_abstract():
+    class IncompleteTransport(Transport):
+
+        def publish(self, pair, body, *, content_type, **kwargs):
+            pass
+
+    # Fails as it is created, rather than in the middle of a command.
+    with raises(TypeError):
+        IncompleteTransport()
+
+
+def test_local_transport(tmpdir):
+    directory = str(tmpdir)
+    order_book = LocalTransport(directory)
+    received = []
+    published_at = []
+    listening = threading.Event()
+
+    def consume():
+        with order_book:
+            consumer = order_book.consume('BTC/USDT', inactivity_timeout=0.01)
+            for delivery in consumer:
+                listening.set()
+                if delivery is None:
+                    continue
+                received.append(delivery.body)
+                published_at.append(delivery.published_at)
+                order_book.reply(
+                    delivery, b'reply:' + delivery.body,
+                    content_type='application/json',
+                )
+                order_book.ack(delivery)
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    try:
+        assert listening.wait(1)
+        published = time.time()
+        with LocalTransport(directory) as gateway:
+            gateway.publish(
+                'BTC/USDT', b'place', content_type='application/json',
+            )
+            replies = gateway.request(
+                {
+                    'BTC/USDT': (b'openOrders', 'application/json'),
+                    'ETH/USDT': (b'openOrders', 'application/json'),
+                },
+                timeout=1,
+            )
+        assert replies == {'BTC/USDT': b'reply:openOrders'}
+        assert received == [b'place', b'openOrders']
+        assert all(published <= t <= time.time() for t in published_at)
+    finally:
+        order_book.cancel()
+        thread.join()
+    assert not tmpdir.listdir()
+
+
+def test_request_place_order(fx_config, tmpdir):
+    app = create_engine_app({
+        **fx_config,
+        'order_book': {
+            'transport': 'local',
+            'transport_directory': str(tmpdir),
+            'command_encoding': 'binary',
+        },
+    })
+    order = Order(
+        id=uuid.uuid4(), user_id=uuid.uuid4(), side=OrderSide.buy,
+        volume=decimal.Decimal('1'), remaining_volume=decimal.Decimal('1'),
+        price=decimal.Decimal('100'), pair='BTC/USDT',
+    )
+    for restart in range(2):
+        order_book = LocalTransport(str(tmpdir))
+        listening = threading.Event()
+
+        def consume():
+            with order_book:
+                consumer = order_book.consume(
+                    'BTC/USDT', inactivity_timeout=0.01,
+                )
+                for delivery in consumer:
+                    listening.set()
+                    if delivery is None:
+                        continue
+                    command = decode_command(
+                        delivery.body, delivery.content_type,
+                    )
+                    reply = {
+                        'id': str(command['order'].id),
+                        'status': 'accepted',
+                        'events': [],
+                    }
+                    order_book.reply(
+                        delivery,
+                        json.dumps(reply).encode(),
+                        content_type=JSON_CONTENT_TYPE,
+                    )
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        try:
+            assert listening.wait(1)
+            # The gateway keeps its connection, and reconnects once the
+            # order book has restarted.
+            for _ in range(2):
+                assert request_place_order(app, order, timeout=1) == {
+                    'id': str(order.id), 'status': 'accepted', 'events': [],
+                }
+        finally:
+            order_book.cancel()
+            thread.join()
+        assert request_place_order(app, order, timeout=0.1) is None
+    close_transport_pool(app)
+
+
+#: Run in a process of its own, as monkey-patching would leak into the other
+#: tests.
+TRANSPORT_POOL_SCRIPT = textwrap.dedent('''
+    from gevent.monkey import patch_all
+    patch_all()
+    import sys
+
+    import gevent
+
+    from iu.order_book import mq
+
+
+    class App:
+        config = {
+            'APP_CONFIG': {
+                'order_book': {
+                    'transport': 'local',
+                    'transport_directory': sys.argv[1],
+                    'transport_pool_size': 2,
+                },
+            },
+        }
+
+
+    opened = []
+    closed = []
+    in_use = set()
+    peak = 0
+    get_transport = mq.get_transport
+
+
+    def open_transport(app):
+        transport = get_transport(app)
+        transport.close = lambda: closed.append(transport)
+        opened.append(transport)
+        return transport
+
+
+    def send(transport):
+        global peak
+        in_use.add(transport)
+        peak = max(peak, len(in_use))
+        gevent.sleep(0.01)
+        in_use.remove(transport)
+        if transport is opened[0] and transport not in closed:
+            raise OSError('connection reset')
+        return transport
+
+
+    mq.get_transport = open_transport
+    app = App()
+    greenlets = [gevent.spawn(mq.use_transport, app, send) for _ in range(20)]
+    gevent.joinall(greenlets, timeout=5, raise_error=True)
+    assert all(greenlet.successful() for greenlet in greenlets)
+    # Each request is a greenlet, and they share two transports, but the
+    # broken one which was replaced.
+    assert peak == 2
+    assert len(opened) == 3
+    assert closed == opened[:1]
+    mq.close_transport_pool(app)
+    assert sorted(map(id, closed)) == sorted(map(id, opened))
+''')
+
+
+def test_transport_pool_greenlets(tmpdir):
+    subprocess.run(
+        [sys.executable, '-c', TRANSPORT_POOL_SCRIPT, str(tmpdir)],
+        cwd=str(pathlib.Path(__file__).parent.parent),
+        check=True,
+        timeout=30,
+    )
@@ -1,7 +1,22 @@
+import datetime
+import decimal
+import time
 import uuid
 
+from iu.market import Market
 from iu.order import Order, OrderSide
 from iu.order_book import OrderBook
+from iu.order_book.app import create_engine_app
+from iu.order_book.book import (
+    create_ledger_transactions, create_order_event, create_place_order_reply,
+    group_order_events,
+)
+from iu.order_book.codec import (
+    BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, encode_command,
+)
+from iu.order_book.mq import Delivery
+from iu.order_book.util import RecentIds
+from iu.transaction import TransactionType
 
 
 def test_order_book_insert(fx_wsgi_app):
@@ -39,3 +54,338 @@ def test_order_book_insert(fx_wsgi_app):
         order_book.insert(order)
     expected = list(reversed([0, 5, 6, 1, 2, 9, 3, 4, 7, 8]))
     assert [o.id.int for o in order_book.buy_orders] == expected
+
+
+def test_order_book_get_balance_changes(fx_wsgi_app):
+    user_ids = [uuid.UUID(int=1), uuid.UUID(int=2)]
+    buy_order = Order(
+        id=uuid.UUID(int=0), user_id=user_ids[0], side=OrderSide.buy,
+        pair='BTC/USDT', price=decimal.Decimal('10'),
+        volume=decimal.Decimal('2'),
+    )
+    sell_order = Order(
+        id=uuid.UUID(int=1), user_id=user_ids[1], side=OrderSide.sell,
+        pair='BTC/USDT', price=decimal.Decimal('9'),
+        volume=decimal.Decimal('1'),
+    )
+    trade = {
+        'buy_order': buy_order,
+        'sell_order': sell_order,
+        'volume': decimal.Decimal('1'),
+        'price': decimal.Decimal('9'),
+        'base_currency': 'BTC',
+        'quote_currency': 'USDT',
+    }
+    transactions = [
+        {'user_id': user_ids[0], 'currency': 'USDT',
+         'amount': decimal.Decimal('-9')},
+        {'user_id': user_ids[0], 'currency': 'BTC',
+         'amount': decimal.Decimal('1')},
+    ]
+    order_book = OrderBook(fx_wsgi_app)
+    changes = order_book.get_balance_changes(
+        buy_order, [trade], transactions,
+    )
+    assert changes == {
+        (user_ids[0], 'USDT'): (decimal.Decimal('-9'), decimal.Decimal('10')),
+        (user_ids[0], 'BTC'): (decimal.Decimal('1'), decimal.Decimal('0')),
+        (user_ids[1], 'BTC'): (decimal.Decimal('0'), decimal.Decimal('-1')),
+    }
+
+
+def test_create_ledger_transactions():
+    buyer_id, seller_id = uuid.UUID(int=1), uuid.UUID(int=2)
+    buy_order = Order(id=uuid.UUID(int=0), user_id=buyer_id)
+    sell_order = Order(id=uuid.UUID(int=1), user_id=seller_id)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    trades = [
+        {
+            'id': uuid.UUID(int=index),
+            'buy_order': buy_order,
+            'sell_order': sell_order,
+            'side': OrderSide.buy,
+            'volume': decimal.Decimal('1'),
+            'price': decimal.Decimal('100'),
+            'base_currency': 'BTC',
+            'quote_currency': 'USDT',
+        }
+        for index in range(2)
+    ]
+    transactions = create_ledger_transactions(
+        trades,
+        maker_fee=decimal.Decimal('0.001'),
+        taker_fee=decimal.Decimal('0.002'),
+        now=now,
+    )
+    amounts = {
+        (t['trade_id'], t['user_id'], t['currency']): t['amount']
+        for t in transactions
+    }
+    fee_user_id = uuid.UUID(int=0)
+    assert amounts == {
+        (trades[0]['id'], seller_id, 'USDT'): decimal.Decimal('99.9'),
+        (trades[0]['id'], seller_id, 'BTC'): decimal.Decimal('-1'),
+        (trades[0]['id'], buyer_id, 'USDT'): decimal.Decimal('-100'),
+        (trades[0]['id'], buyer_id, 'BTC'): decimal.Decimal('0.998'),
+        (trades[1]['id'], seller_id, 'USDT'): decimal.Decimal('99.9'),
+        (trades[1]['id'], seller_id, 'BTC'): decimal.Decimal('-1'),
+        (trades[1]['id'], buyer_id, 'USDT'): decimal.Decimal('-100'),
+        (trades[1]['id'], buyer_id, 'BTC'): decimal.Decimal('0.998'),
+        (None, fee_user_id, 'USDT'): decimal.Decimal('0.2'),
+        (None, fee_user_id, 'BTC'): decimal.Decimal('0.004'),
+    }
+    assert all(t['type'] is TransactionType.ledger for t in transactions)
+    assert all(t['created_at'] == now for t in transactions)
+
+
+def test_group_order_events():
+    orders = [
+        Order(
+            id=uuid.UUID(int=index), user_id=uuid.UUID(int=index % 2),
+            side=OrderSide.buy, pair='BTC/USDT', price=decimal.Decimal('10'),
+            volume=decimal.Decimal('2'), remaining_volume=decimal.Decimal('1'),
+        )
+        for index in range(3)
+    ]
+    events = [
+        create_order_event(orders[0], 'accepted'),
+        create_order_event(
+            orders[1], 'partiallyFilled',
+            fill_volume=decimal.Decimal('1'), fill_price=decimal.Decimal('9'),
+        ),
+        create_order_event(orders[2], 'canceled'),
+    ]
+    grouped = group_order_events(events)
+    assert list(grouped) == [str(uuid.UUID(int=0)), str(uuid.UUID(int=1))]
+    assert grouped[str(uuid.UUID(int=0))] == [events[0], events[2]]
+    assert events[1]['fillVolume'] == decimal.Decimal('1')
+    assert events[1]['fillPrice'] == decimal.Decimal('9')
+    assert 'fillVolume' not in events[0]
+
+
+def test_order_book_user_orders(fx_wsgi_app):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    user_ids = [uuid.UUID(int=1), uuid.UUID(int=2)]
+    orders = [
+        Order(
+            id=uuid.UUID(int=index), user_id=user_ids[index % 2],
+            created_at=now + datetime.timedelta(seconds=index),
+            side=OrderSide.sell, pair='BTC/USDT',
+            price=decimal.Decimal(index + 1), volume=decimal.Decimal('1'),
+            remaining_volume=decimal.Decimal('1'),
+        )
+        for index in range(4)
+    ]
+    order_book = OrderBook(fx_wsgi_app)
+    for order in orders:
+        order_book.insert(order)
+    open_orders = order_book.get_open_orders(user_ids[0])
+    assert [o['id'] for o in open_orders] == [
+        str(orders[2].id), str(orders[0].id),
+    ]
+    order_book.remove(OrderSide.sell, orders[0].id)
+    order_book.remove(OrderSide.sell, orders[2].id)
+    assert order_book.get_open_orders(user_ids[0]) == []
+    assert user_ids[0] not in order_book.user_orders
+    assert len(order_book.get_open_orders(user_ids[1])) == 2
+
+
+def test_order_book_completed_order_ids(fx_wsgi_app):
+    orders = [
+        Order(
+            id=uuid.UUID(int=index), user_id=uuid.UUID(int=1),
+            side=OrderSide.sell, price=decimal.Decimal(index + 1),
+            volume=decimal.Decimal('1'),
+        )
+        for index in range(2)
+    ]
+    order_book = OrderBook(fx_wsgi_app)
+    for order in orders:
+        order_book.insert(order)
+    order_book.remove(OrderSide.sell, orders[0].id)
+    # Not until the command commits.
+    assert orders[0].id not in order_book.completed_order_ids
+    order_book.discard_effects()
+    assert orders[0].id not in order_book.completed_order_ids
+    order_book.remove(OrderSide.sell, orders[1].id)
+    order_book.apply_effects()
+    assert orders[1].id in order_book.completed_order_ids
+    assert not order_book.effects.completed_order_ids
+
+
+def test_order_book_process_cancel_all_orders(fx_wsgi_app):
+    user_id = uuid.UUID(int=1)
+    orders = [
+        Order(
+            id=uuid.UUID(int=index), user_id=user_id, side=OrderSide.buy,
+            price=decimal.Decimal(index + 1), volume=decimal.Decimal('1'),
+        )
+        for index in range(3)
+    ]
+    order_book = OrderBook(fx_wsgi_app)
+    for order in orders:
+        order_book.insert(order)
+    canceled = []
+    order_book.process_cancel_order = lambda order_ids: canceled.extend(
+        order_ids
+    )
+    order_book.process_cancel_all_orders(user_id=user_id)
+    assert sorted(canceled) == [o.id for o in orders]
+    canceled.clear()
+    order_book.process_cancel_all_orders(user_id=uuid.UUID(int=2))
+    assert canceled == []
+
+
+def test_order_book_process_undecodable(fx_wsgi_app):
+    order_book = OrderBook(fx_wsgi_app, market=Market(pair='BTC/USDT'))
+    for body, content_type in [
+        (b'\x02\x04' + bytes(16), BINARY_CONTENT_TYPE),
+        (b'\x01\x09' + bytes(16), BINARY_CONTENT_TYPE),
+        (b'\x01\x01', BINARY_CONTENT_TYPE),
+        (b'{"type": "cancel"', JSON_CONTENT_TYPE),
+        (b'{"type": "place", "order": {"id": "1"}}', JSON_CONTENT_TYPE),
+    ]:
+        delivery = Delivery(tag=None, body=body, content_type=content_type)
+        assert order_book.process(delivery, time.perf_counter()) == \
+            'undecodable'
+
+
+def test_order_book_run_trace(fx_wsgi_app):
+    order = Order(
+        id=uuid.UUID(int=1), user_id=uuid.UUID(int=2), side=OrderSide.buy,
+        volume=decimal.Decimal('1'), remaining_volume=decimal.Decimal('1'),
+        price=decimal.Decimal('100'), base_currency='BTC',
+        quote_currency='USDT',
+    )
+    body, content_type = encode_command({
+        'type': 'place', 'order': order, 'trace': {'received': time.time()},
+    })
+    traces = []
+    commits = []
+
+    class Session:
+        transaction = type('Transaction', (), {'nested': False})
+
+        def begin_nested(self):
+            pass
+
+        def commit(self):
+            commits.append(dict(traces[0]))
+
+    class Transport:
+        def consume(self, pair, inactivity_timeout):
+            yield Delivery(tag=1, body=body, content_type=content_type)
+
+        def ack(self, delivery):
+            pass
+
+    def process_place_order(order, trace):
+        traces.append(trace)
+        return {}
+
+    order_book = OrderBook(fx_wsgi_app, market=Market(pair='BTC/USDT'))
+    order_book.session = Session()
+    order_book.transport = Transport()
+    order_book.process_place_order = process_place_order
+    order_book.run()
+    trace, = traces
+    # Not until the command's transaction commits.
+    assert [list(c) for c in commits] == [['received', 'dequeued']]
+    assert list(trace) == ['received', 'dequeued', 'committed']
+
+
+def test_order_book_get_bbo_message(fx_wsgi_app):
+    order_book = OrderBook(fx_wsgi_app, market=Market(pair='BTC/USDT'))
+    assert order_book.get_bbo_message() == {
+        'type': 'bbo',
+        'data': {'pair': 'BTC/USDT', 'bid': None, 'ask': None},
+    }
+    assert order_book.get_bbo_message() is None
+    order_book.add_to_merged_orders(
+        OrderSide.buy, decimal.Decimal('9000'), decimal.Decimal('2'),
+    )
+    order_book.add_to_merged_orders(
+        OrderSide.buy, decimal.Decimal('8000'), decimal.Decimal('1'),
+    )
+    assert order_book.get_bbo_message() == {
+        'type': 'bbo',
+        'data': {'pair': 'BTC/USDT', 'bid': ['9000', '2'], 'ask': None},
+    }
+    order_book.add_to_merged_orders(
+        OrderSide.buy, decimal.Decimal('8000'), decimal.Decimal('1'),
+    )
+    assert order_book.get_bbo_message() is None
+    order_book.add_to_merged_orders(
+        OrderSide.sell, decimal.Decimal('10000'), decimal.Decimal('3'),
+    )
+    assert order_book.get_bbo_message()['data']['ask'] == ['10000', '3']
+
+
+def test_recent_ids():
+    recent_ids = RecentIds(capacity=2)
+    recent_ids.update([1, 2])
+    assert 1 in recent_ids and 2 in recent_ids
+    recent_ids.add(3)
+    assert 1 in recent_ids and 3 in recent_ids
+    recent_ids.update([4, 5])
+    assert 1 not in recent_ids and 2 not in recent_ids
+    assert {3, 4, 5} == {i for i in range(6) if i in recent_ids}
+    assert len(recent_ids) == 3
+    recent_ids = RecentIds(window=0)
+    recent_ids.add(1)
+    recent_ids.add(2)
+    recent_ids.add(3)
+    assert 1 not in recent_ids
+
+
+def test_engine_app(fx_config, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql:///iu-exchange-engine')
+    app = create_engine_app(fx_config)
+    assert app.config['APP_CONFIG']['database']['url'] == (
+        'postgresql:///iu-exchange-engine'
+    )
+    assert fx_config['database']['url'] != 'postgresql:///iu-exchange-engine'
+    order_book = OrderBook(app)
+    assert order_book.config == fx_config.get('order_book', {})
+
+
+def test_create_place_order_reply():
+    order = Order(
+        id=uuid.UUID(int=1), user_id=uuid.UUID(int=2), side=OrderSide.buy,
+        volume=decimal.Decimal('2'), remaining_volume=decimal.Decimal('1'),
+        price=decimal.Decimal('100'), base_currency='BTC',
+        quote_currency='USDT',
+    )
+    maker = Order(
+        id=uuid.UUID(int=3), user_id=uuid.UUID(int=4), side=OrderSide.sell,
+        volume=decimal.Decimal('1'), remaining_volume=decimal.Decimal('0'),
+        price=decimal.Decimal('100'), base_currency='BTC',
+        quote_currency='USDT',
+    )
+    events = [
+        create_order_event(order, 'accepted'),
+        create_order_event(
+            maker, 'filled',
+            fill_volume=decimal.Decimal('1'),
+            fill_price=decimal.Decimal('100'),
+        ),
+        create_order_event(
+            order, 'partiallyFilled',
+            fill_volume=decimal.Decimal('1'),
+            fill_price=decimal.Decimal('100'),
+        ),
+    ]
+    reply = create_place_order_reply(order, 'accepted', order_events=events)
+    assert reply == {
+        'id': order.id,
+        'status': 'accepted',
+        'events': [events[0], events[2]],
+    }
+    assert create_place_order_reply(
+        order, 'rejected', reason='notEnoughBalance',
+    ) == {
+        'id': order.id,
+        'status': 'rejected',
+        'reason': 'notEnoughBalance',
+        'events': [],
+    }
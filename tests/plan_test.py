@@ -0,0 +1,396 @@
+"""Guardrails on the query plans of hot SQL paths.
+
+These tests run the hot queries against a database seeded at scale, e.g. by
+``python -m benchmarks.dataset``, and check their ``EXPLAIN (ANALYZE,
+BUFFERS)`` plans: that they use the indices they are meant to, that they
+scan no large table sequentially, and that the planner's row estimates are
+not far off.  They are skipped unless the database is given::
+
+    pytest tests/plan_test.py --plan-database-url postgresql:///iu-perf
+
+Statements are captured as the code under test runs them, so a change to
+a query, a model or the schema which loses an index fails here, and not in
+production.  Everything runs in a transaction which is rolled back.
+
+"""
+import contextlib
+import datetime
+import json
+import uuid
+from typing import Any, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+from flask_login.utils import login_user
+from pytest import fixture, skip
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection
+from typeguard import typechecked
+
+from iu.balance import Balance
+from iu.candle import Candle, CandleUnitType
+from iu.market import Market
+from iu.order import Order
+from iu.order_book.app import EngineApp
+from iu.order_book.book import OrderBook, create_cancel_statement
+from iu.orm import Base, Session, SessionType
+from iu.user import User
+from iu.web.transaction import fetch_transactions
+from iu.web.wsgi import create_wsgi_app
+from iu.websocket.order import OrderWebSocketServer
+
+#: Tables with at least this many rows must not be scanned sequentially.
+LARGE_TABLE_ROWS = 100000
+#: Scans of fewer rows than this are too cheap to care about misestimates.
+MINIMUM_ROWS = 1000
+#: How many times off the estimated rows of a scan may be.
+MAXIMUM_MISESTIMATE = 100
+
+Plan = Mapping[str, Any]
+Statement = Tuple[str, Any]
+
+
+@fixture
+def fx_plan_connection(request) -> Connection:
+    url = request.config.getoption('plan_database_url')
+    if not url:
+        skip('needs --plan-database-url')
+    engine = create_engine(url)
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+        engine.dispose()
+
+
+@fixture
+def fx_plan_session(fx_plan_connection: Connection) -> SessionType:
+    session = Session(bind=fx_plan_connection)
+    if session.query(Order.id).first() is None:
+        skip('the database is not seeded; see benchmarks.dataset')
+    yield session
+    session.close()
+
+
+@fixture
+def fx_large_tables(fx_plan_connection: Connection) -> List[str]:
+    return [
+        name
+        for name, in fx_plan_connection.execute(
+            'SELECT relname FROM pg_class '
+            'WHERE relkind = %(kind)s AND relname = ANY(%(names)s) '
+            'AND reltuples >= %(rows)s',
+            kind='r', names=list(Base.metadata.tables), rows=LARGE_TABLE_ROWS,
+        )
+    ]
+
+
+@fixture
+def fx_plan_market(fx_plan_session: SessionType) -> Market:
+    return fx_plan_session.query(Market).order_by(
+        Market.base_currency, Market.quote_currency,
+    ).first()
+
+
+@fixture
+def fx_plan_user(fx_plan_session: SessionType) -> User:
+    user_id = fx_plan_session.query(Order.user_id).filter(
+        Order.active,
+    ).order_by(Order.created_at.desc()).limit(1).scalar()
+    return fx_plan_session.query(User).get(user_id)
+
+
+@contextlib.contextmanager
+def capture_statements(connection: Connection) -> Iterator[List[Statement]]:
+    """Collect the queries run on ``connection`` with their parameters."""
+    statements = []
+
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany,
+    ):
+        if statement.lstrip().split(None, 1)[0].upper() in (
+            'SELECT', 'UPDATE', 'INSERT', 'DELETE', 'WITH',
+        ):
+            statements.append((statement, parameters))
+
+    event.listen(connection, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            connection, 'before_cursor_execute', before_cursor_execute,
+        )
+
+
+@typechecked
+def explain(connection: Connection, statement: Statement) -> Plan:
+    sql, parameters = statement
+    # The driver's cursor, so the captured parameters bind as they did.
+    with connection.connection.cursor() as cursor:
+        cursor.execute(
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, parameters,
+        )
+        result, = cursor.fetchone()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]['Plan']
+
+
+def iter_nodes(
+    plan: Plan, limited: bool = False,
+) -> Iterator[Tuple[Plan, bool]]:
+    """Walk ``plan``, telling whether each node is under a ``Limit``, which
+    stops it before it returns the rows it was estimated to.
+
+    """
+    yield plan, limited
+    limited = limited or plan['Node Type'] == 'Limit'
+    for child in plan.get('Plans', ()):
+        yield from iter_nodes(child, limited)
+
+
+def format_plan(plan: Plan, depth: int = 0) -> str:
+    """Outline ``plan`` a node per line, for assertion messages."""
+    line = '  ' * depth + plan['Node Type']
+    if 'Relation Name' in plan:
+        line += f' on {plan["Relation Name"]}'
+    if 'Index Name' in plan:
+        line += f' using {plan["Index Name"]}'
+    line += f' (rows={plan["Plan Rows"]} actual={plan["Actual Rows"]})'
+    return '\n'.join(
+        [line] +
+        [format_plan(child, depth + 1) for child in plan.get('Plans', ())]
+    )
+
+
+@typechecked
+def find_problems(plan: Plan, large_tables: List[str]) -> List[str]:
+    problems = []
+    for node, limited in iter_nodes(plan):
+        relation = node.get('Relation Name')
+        if node['Node Type'] == 'Seq Scan' and relation in large_tables:
+            problems.append(f'sequential scan on {relation}')
+        if relation is None or limited:
+            continue
+        estimated = node['Plan Rows']
+        actual = node['Actual Rows']
+        if max(estimated, actual) < MINIMUM_ROWS:
+            continue
+        if max(estimated, actual) > MAXIMUM_MISESTIMATE * max(
+            min(estimated, actual), 1,
+        ):
+            problems.append(
+                f'{node["Node Type"]} on {relation} estimated {estimated} '
+                f'rows, but returned {actual}'
+            )
+    return problems
+
+
+@typechecked
+def get_indices(plan: Plan) -> List[str]:
+    return [
+        node['Index Name']
+        for node, _ in iter_nodes(plan)
+        if 'Index Name' in node
+    ]
+
+
+@typechecked
+def check_plans(
+    connection: Connection,
+    statements: List[Statement],
+    large_tables: List[str],
+    *,
+    match: str,
+    indices: Sequence[str] = (),
+) -> Dict[str, Plan]:
+    """Explain the captured statements which contain ``match``, and assert
+    that their plans are sound and use one of ``indices``.
+
+    """
+    plans = {
+        sql: explain(connection, (sql, parameters))
+        for sql, parameters in statements
+        if match in sql
+    }
+    assert plans, f'no statement contains {match!r}'
+    for sql, plan in plans.items():
+        problems = find_problems(plan, large_tables)
+        if indices and not set(indices) & set(get_indices(plan)):
+            problems.append(f'none of {", ".join(indices)} is used')
+        assert not problems, '\n'.join([sql, *problems, format_plan(plan)])
+    return plans
+
+
+def test_fetch_orders_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    order_book = OrderBook(
+        EngineApp({}), session=fx_plan_session, market=fx_plan_market,
+    )
+    with capture_statements(fx_plan_connection) as statements:
+        order_book.fetch_orders()
+    assert order_book.order_ids
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM "order"', indices=['ix_order_book'],
+    )
+
+
+def test_fetch_completed_order_ids_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    order_book = OrderBook(
+        EngineApp({}), session=fx_plan_session, market=fx_plan_market,
+    )
+    with capture_statements(fx_plan_connection) as statements:
+        order_book.fetch_completed_order_ids()
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM "order"', indices=['ix_order_created_at'],
+    )
+
+
+def test_balance_get_or_create_bulk_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    user_ids = [
+        user_id for user_id, in fx_plan_session.query(Balance.user_id).filter(
+            Balance.currency == fx_plan_market.quote_currency,
+        ).limit(50)
+    ]
+    keys = [
+        (user_id, currency)
+        for user_id in user_ids
+        for currency in (
+            fx_plan_market.base_currency, fx_plan_market.quote_currency,
+        )
+    ]
+    with capture_statements(fx_plan_connection) as statements:
+        balances = Balance.get_or_create_bulk(
+            fx_plan_session, keys, lock=True,
+        )
+    assert len(balances) == len(keys)
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM balance', indices=['balance_pkey'],
+    )
+
+
+def test_cancel_order_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    order_ids = [
+        order_id for order_id, in fx_plan_session.query(Order.id).filter(
+            Order.active, Order.pair == fx_plan_market.pair,
+        ).limit(20)
+    ]
+    with capture_statements(fx_plan_connection) as statements:
+        canceled = fx_plan_session.execute(
+            create_cancel_statement(order_ids),
+        ).fetchall()
+    assert len(canceled) == len(order_ids)
+    # The statement is explained once canceled, so it updates nothing, but
+    # its plan is the same.
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='UPDATE "order"', indices=['order_pkey'],
+    )
+
+
+def test_candle_query_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with capture_statements(fx_plan_connection) as statements:
+        Candle.query(
+            session=fx_plan_session,
+            pair=fx_plan_market.pair,
+            unit_key=(1, CandleUnitType.minutes),
+            created_at=now - datetime.timedelta(hours=6),
+        )
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM trade', indices=['ix_trade_sort'],
+    )
+
+
+def test_candle_get_daily_candle_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_market: Market,
+    fx_large_tables: List[str],
+):
+    with capture_statements(fx_plan_connection) as statements:
+        candle = Candle.get_daily_candle(
+            fx_plan_session, fx_plan_market.pair,
+        )
+    assert candle is not None
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM candle', indices=['candle_pkey'],
+    )
+    # Trades of the last minute, which either index narrows down.
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM trade', indices=['ix_trade_sort', 'ix_trade_created_at'],
+    )
+
+
+def test_get_trades_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_large_tables: List[str],
+):
+    server = OrderWebSocketServer({
+        'web': {},
+        'database': {'url': str(fx_plan_connection.engine.url)},
+    })
+    server.session = fx_plan_session
+    with capture_statements(fx_plan_connection) as statements:
+        trades = server.get_trades(count=14)
+    assert trades
+    assert all(len(t) == 14 for t in trades.values())
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM trade', indices=['ix_trade_sort'],
+    )
+
+
+def test_fetch_transactions_plan(
+    fx_plan_connection: Connection,
+    fx_plan_session: SessionType,
+    fx_plan_user: User,
+    fx_large_tables: List[str],
+):
+    app = create_wsgi_app({
+        'web': {'SECRET_KEY': uuid.uuid4().hex},
+        'database': {'url': str(fx_plan_connection.engine.url)},
+    })
+    app._test_fx_connection = fx_plan_connection
+    with capture_statements(fx_plan_connection) as statements:
+        for query_string in ('', 'types[]=trade', 'currency=BTC'):
+            with app.test_request_context(f'/transactions/?{query_string}'):
+                login_user(fx_plan_user)
+                response = fetch_transactions()
+                assert response.status_code == 200
+    check_plans(
+        fx_plan_connection, statements, fx_large_tables,
+        match='FROM transaction', indices=['ix_transaction_user_id'],
+    )
@@ -0,0 +1,42 @@
+import threading
+
+from iu.profiler import profile_thread, sample_stacks
+
+
+def spin(stopped: threading.Event):
+    while not stopped.is_set():
+        sum(range(100))
+
+
+def test_sample_stacks():
+    stopped = threading.Event()
+    thread = threading.Thread(target=spin, args=(stopped,))
+    thread.start()
+    try:
+        stacks = sample_stacks(thread.ident, seconds=0.1, interval=0.001)
+    finally:
+        stopped.set()
+        thread.join()
+    assert stacks
+    assert all('spin (profiler_test.py:' in stack for stack in stacks)
+    assert sample_stacks(thread.ident, seconds=1) == {}
+
+
+def test_profile_thread(tmpdir):
+    stopped = threading.Event()
+    thread = threading.Thread(target=spin, args=(stopped,))
+    thread.start()
+    try:
+        path = profile_thread(
+            thread.ident, str(tmpdir), 'btc-usdt', seconds=0.05,
+            interval=0.001,
+        )
+    finally:
+        stopped.set()
+        thread.join()
+    assert path.parent == tmpdir
+    assert path.name.startswith('iu-profile-btc-usdt-')
+    for line in path.read_text().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert 'spin (profiler_test.py:' in stack
+        assert int(count) > 0
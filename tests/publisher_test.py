@@ -0,0 +1,164 @@
+import asyncio
+import threading
+
+from iu.order_book.publisher import (
+    WebsocketPublisher, get_conflation_key, merge_messages,
+)
+
+
+def order_message(pair: str, book: str):
+    return {'type': 'order', 'data': {'pair': pair, 'book': book}}
+
+
+def balance_message(user_id: str, **balances):
+    return {'type': 'balance', 'data': {user_id: balances}}
+
+
+def order_status_message(user_id: str, *order_ids: str):
+    return {
+        'type': 'orderStatus',
+        'data': {user_id: [{'id': order_id} for order_id in order_ids]},
+    }
+
+
+def trade_message(trade_id: str):
+    return {'type': 'trade', 'data': [{'id': trade_id}]}
+
+
+def test_get_conflation_key():
+    assert get_conflation_key(order_message('BTC/USDT', '')) == (
+        'order', 'BTC/USDT',
+    )
+    assert get_conflation_key({
+        'type': 'market',
+        'data': [{'pair': 'BTC/USDT', 'currentPrice': '1'}],
+    }) == ('market', 'BTC/USDT')
+    assert get_conflation_key(balance_message('1')) == ('balance', '1')
+    assert get_conflation_key(order_status_message('1', 'a')) == (
+        'orderStatus', '1',
+    )
+    assert get_conflation_key(trade_message('a')) is None
+    assert get_conflation_key({
+        'type': 'bbo',
+        'data': {'pair': 'BTC/USDT', 'bid': None, 'ask': None},
+    }) is None
+
+
+def test_merge_messages():
+    assert merge_messages(
+        balance_message('1', BTC='1', USDT='2'),
+        balance_message('1', USDT='3'),
+    ) == balance_message('1', BTC='1', USDT='3')
+    assert merge_messages(
+        dict(order_status_message('1', 'a'), trace={'id': 'first'}),
+        dict(order_status_message('1', 'b'), trace={'id': 'second'}),
+    ) == dict(order_status_message('1', 'a', 'b'), trace={'id': 'first'})
+    assert merge_messages(
+        order_message('BTC/USDT', 'first'),
+        order_message('BTC/USDT', 'second'),
+    ) == order_message('BTC/USDT', 'second')
+
+
+def test_websocket_publisher_buffer():
+    publisher = WebsocketPublisher('ws://localhost/publish/', capacity=3)
+    publisher.publish([
+        order_message('BTC/USDT', 'first'),
+        balance_message('1', BTC='1'),
+        order_message('ETH/USDT', 'first'),
+    ])
+    publisher.publish([order_message('BTC/USDT', 'second')])
+    assert list(publisher.pending.values()) == [
+        balance_message('1', BTC='1'),
+        order_message('ETH/USDT', 'first'),
+        order_message('BTC/USDT', 'second'),
+    ]
+    # Split per user, and merged into the pending message of the same user.
+    publisher.publish([{
+        'type': 'balance',
+        'data': {'1': {'USDT': '2'}, '2': {'BTC': '3'}},
+        'trace': {'id': 'trace'},
+    }])
+    # The oldest message is dropped, sparing balances and order status.
+    assert publisher.dropped == 1
+    assert publisher.overflowed == 0
+    assert list(publisher.pending.values()) == [
+        dict(balance_message('1', BTC='1', USDT='2'), trace={'id': 'trace'}),
+        order_message('BTC/USDT', 'second'),
+        balance_message('2', BTC='3'),
+    ]
+
+
+def test_websocket_publisher_backpressure():
+    publisher = WebsocketPublisher(
+        'ws://localhost/publish/', capacity=100, batch_size=1,
+    )
+    # Nothing drains the publisher, as if the websocket server were down;
+    # order books must keep going regardless.
+    engine = threading.Thread(target=lambda: [
+        publisher.publish([
+            order_message('BTC/USDT', str(i)),
+            order_status_message(str(i % 10), str(i)),
+            balance_message(str(i % 10), USDT=str(i)),
+            trade_message(str(i)),
+        ])
+        for i in range(1000)
+    ])
+    engine.start()
+    engine.join(5)
+    assert not engine.is_alive()
+    # The latest book, order status and balances of each of ten users,
+    # and as many of the latest trades as fit.
+    pending = list(publisher.pending.values())
+    assert pending[-2:] == [
+        order_message('BTC/USDT', '999'), trade_message('999'),
+    ]
+    assert pending[20:-2] == [trade_message(str(i)) for i in range(921, 999)]
+    assert balance_message('9', USDT='999') in pending
+    assert order_status_message(
+        '9', *(str(i) for i in range(9, 1000, 10)),
+    ) in pending
+    assert publisher.dropped == 0
+    assert publisher.overflowed == 921
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        publisher.wakeup = asyncio.Event()
+        loop.run_until_complete(publisher.next_frame())
+        publisher.report_dropped()
+        assert publisher.dropped == publisher.overflowed == 0
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_websocket_publisher_frame():
+    publisher = WebsocketPublisher('ws://localhost/publish/', batch_size=2)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        publisher.wakeup = asyncio.Event()
+        publisher.publish([
+            order_message('BTC/USDT', 'first'),
+            balance_message('1'),
+            balance_message('2'),
+        ])
+        frame = loop.run_until_complete(publisher.next_frame())
+        assert [message for _, message in frame] == [
+            order_message('BTC/USDT', 'first'),
+            balance_message('1'),
+        ]
+        publisher.publish([order_message('BTC/USDT', 'second')])
+        # A failed frame goes back in front, except for what was superseded.
+        publisher.requeue(frame)
+        assert list(publisher.pending.values()) == [
+            balance_message('1'),
+            balance_message('2'),
+            order_message('BTC/USDT', 'second'),
+        ]
+        publisher.closing = True
+        loop.run_until_complete(publisher.next_frame())
+        loop.run_until_complete(publisher.next_frame())
+        assert loop.run_until_complete(publisher.next_frame()) is None
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
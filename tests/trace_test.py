@@ -0,0 +1,32 @@
+from iu.metrics import Registry
+from iu.trace import format_latencies, record_trace, stamp, start_trace
+
+
+def test_stamp():
+    trace = start_trace()
+    stamp(trace, 'enqueued')
+    assert list(trace) == ['received', 'enqueued']
+    assert trace['received'] <= trace['enqueued']
+    stamp(None, 'enqueued')
+
+
+def test_record_trace():
+    registry = Registry()
+    record_trace({
+        'received': 100.0,
+        'enqueued': 100.001,
+        'dequeued': 100.003,
+        'committed': 100.01,
+    }, registry)
+    text = registry.render()
+    assert 'iu_order_latency_seconds_count{hop="enqueued"} 1\n' in text
+    assert 'iu_order_latency_seconds_count{hop="committed"} 1\n' in text
+    assert 'hop="matched"' not in text
+    assert 'iu_order_latency_seconds_sum{hop="total"} 0.010000\n' in text
+    summary = format_latencies(registry)
+    assert summary.startswith('enqueued p50=1.0')
+    assert 'committed p50=7.' in summary
+    assert 'total p50=10.' in summary
+    record_trace({'dequeued': 100.0}, registry)
+    total = registry.histogram('iu_order_latency_seconds', hop='total')
+    assert total.count == 1
@@ -0,0 +1,58 @@
+import asyncio
+
+from pytest import raises
+
+from iu.typecheck import get_policy, typechecked
+
+
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+async def async_add(a: int, b: int) -> int:
+    return a + b
+
+
+def test_typechecked_off():
+    assert typechecked(add, policy='off') is add
+    assert typechecked(policy='off')(add) is add
+
+
+def test_typechecked_full():
+    checked = typechecked(add, policy='full')
+    assert checked(1, 2) == 3
+    with raises(TypeError):
+        checked('1', '2')
+
+
+def test_typechecked_sampled():
+    sampled = typechecked(add, policy='sampled', rate=3)
+    with raises(TypeError):
+        sampled('1', '2')
+    assert sampled('1', '2') == '12'
+    assert sampled('1', '2') == '12'
+    with raises(TypeError):
+        sampled('1', '2')
+
+
+def test_typechecked_sampled_coroutine():
+    sampled = typechecked(async_add, policy='sampled', rate=2)
+    loop = asyncio.new_event_loop()
+    try:
+        with raises(TypeError):
+            loop.run_until_complete(sampled('1', '2'))
+        assert loop.run_until_complete(sampled('1', '2')) == '12'
+    finally:
+        loop.close()
+
+
+def test_get_policy(monkeypatch):
+    monkeypatch.delenv('IU_TYPECHECK', raising=False)
+    monkeypatch.delenv('IU_TYPECHECK_RATE', raising=False)
+    assert get_policy() == ('full', 100)
+    monkeypatch.setenv('IU_TYPECHECK', 'Sampled')
+    monkeypatch.setenv('IU_TYPECHECK_RATE', '10')
+    assert get_policy() == ('sampled', 10)
+    monkeypatch.setenv('IU_TYPECHECK', 'sometimes')
+    with raises(ValueError):
+        get_policy()
@@ -0,0 +1,17 @@
+import time
+
+from iu.uuid7 import uuid7
+
+
+def test_uuid7():
+    before = time.time_ns() // 1_000_000
+    uuid_ = uuid7()
+    after = time.time_ns() // 1_000_000
+    assert uuid_.version == 7
+    assert before <= uuid_.int >> 80 <= after
+
+
+def test_uuid7_monotonic():
+    uuids = [uuid7() for _ in range(10000)]
+    assert uuids == sorted(uuids)
+    assert len(set(uuids)) == len(uuids)